@@ -1,34 +1,87 @@
 import os
+import atexit
+import json
 import logging
+import time
+from contextlib import nullcontext
 
-from cs50 import SQL
-from flask import Flask, flash, redirect, render_template, request, session, url_for
-from mistralai.models.chat_completion import ChatMessage
+from flask import (Flask, Response, flash, g, jsonify, redirect, render_template, request, session,
+                   stream_with_context, url_for)
 
 from flask_session import Session
 
-from chatbot import ChatBot, DEFAULT_MODEL, DEFAULT_TEMPERATURE
-from helpers import apology, login_required, register_helper, login_helper, create_tables_if_not_exist
+from chatbot import ChatBot, DEFAULT_MODEL, DEFAULT_TEMPERATURE, MODEL_CONTEXT_WINDOWS, MODEL_LIST
+from conversations import ConversationStore, DEFAULT_MAX_CONVERSATIONS, DEFAULT_MAX_BYTES
+from helpers import apology, login_required, register_helper, login_helper
+from logs import DEFAULT_LEVEL, DEFAULT_MAX_LENGTH, configure_logging, parse_levels
+from maintenance import DEFAULT_ARCHIVE_AFTER_DAYS, DEFAULT_INTERVAL as DEFAULT_MAINTENANCE_INTERVAL, open_scheduler
+from metrics import ACTIVE_STREAMS, CONTENT_TYPE, REGISTRY, REQUEST_SECONDS, CallbackMetric
+from persistence import load_history, persist_new_messages
+from ratelimit import (DEFAULT_REQUEST_BURST, DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKEN_BURST,
+                       DEFAULT_TOKENS_PER_MINUTE, open_limiter, retry_after)
+from repositories import (DEFAULT_CACHE_ENTRIES, DEFAULT_CACHE_TTL, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, CachedRepository,
+                          open_repository)
+from resilient import (DEFAULT_CONNECT_TIMEOUT, DEFAULT_FAILURE_THRESHOLD, DEFAULT_MAX_ATTEMPTS, DEFAULT_READ_TIMEOUT,
+                       DEFAULT_RESET_TIMEOUT, open_client)
+from response_cache import DEFAULT_MAX_ENTRIES, DEFAULT_TTL, open_cache
+from router import DEFAULT_LATENCY_THRESHOLD, ModelRouter, parse_rate_limits
+from search import highlight
+from semantic_cache import DEFAULT_DIMENSIONS, DEFAULT_THRESHOLD, HashingEmbedder, MistralEmbedder, SemanticCache
+from sessions import DEFAULT_MAX_ENTRIES as DEFAULT_MAX_SESSIONS, DEFAULT_TTL as DEFAULT_SESSION_TTL, open_session_interface
+from storage import DEFAULT_POOL_SIZE, DEFAULT_POOL_TIMEOUT, PoolTimeout
+from summarizer import ConversationSummarizer, DEFAULT_RECENT_MESSAGES, DEFAULT_REFRESH_AFTER
+from transfer import CONTENT_TYPES, check_format, format_of, import_chats, read_chats, stream_export
+from writebehind import DEFAULT_BATCH_SIZE, DEFAULT_QUEUE_SIZE, open_writer
 
 # Configure application
 app = Flask(__name__)
 
-# Configure session to use filesystem (instead of signed cookies)
+# Keep sessions on the server (instead of signed cookies). SESSION_STORE is "sqlite" (the default, shared by
+# every worker), "memory" for a single worker, or "filesystem" for the old Flask-Session directory
 app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
-
-# Initialize logging
-logging.basicConfig(level=logging.DEBUG)
+app.config["SESSION_STORE"] = os.environ.get("SESSION_STORE", "sqlite")
+if app.config["SESSION_STORE"] == "filesystem":
+    app.config["SESSION_TYPE"] = "filesystem"
+    Session(app)
+else:
+    app.session_interface = open_session_interface(app.config["SESSION_STORE"],
+                                                   os.environ.get("SESSION_PATH", "sessions.db"),
+                                                   ttl=int(os.environ.get("SESSION_TTL", DEFAULT_SESSION_TTL)),
+                                                   max_entries=int(os.environ.get("SESSION_MAX_ENTRIES",
+                                                                                  DEFAULT_MAX_SESSIONS)))
+
+# Limits for the in-memory conversation store
+app.config["CONVERSATION_MAX_COUNT"] = int(os.environ.get("CONVERSATION_MAX_COUNT", DEFAULT_MAX_CONVERSATIONS))
+app.config["CONVERSATION_MAX_BYTES"] = int(os.environ.get("CONVERSATION_MAX_BYTES", DEFAULT_MAX_BYTES))
+
+# Chats listed and messages rendered per page, older ones are fetched as the user scrolls
+app.config["CHAT_PAGE_SIZE"] = int(os.environ.get("CHAT_PAGE_SIZE", DEFAULT_PAGE_SIZE))
+app.config["MESSAGE_PAGE_SIZE"] = int(os.environ.get("MESSAGE_PAGE_SIZE", DEFAULT_PAGE_SIZE))
+
+# Initialize logging: records go through a queue to a writer thread so requests never wait on output.
+# LOG_LEVELS sets levels per logger, e.g. "chatbot.storage=DEBUG,werkzeug=WARNING", and
+# LOG_DEBUG_SAMPLE_RATE keeps only that fraction of debug records. Message contents are only
+# logged, cut short, with LOG_PAYLOADS=1.
+configure_logging(
+    level=os.environ.get("LOG_LEVEL", DEFAULT_LEVEL),
+    levels=parse_levels(os.environ.get("LOG_LEVELS")),
+    json_format=os.environ.get("LOG_FORMAT") == "json",
+    max_length=int(os.environ.get("LOG_MAX_LENGTH", DEFAULT_MAX_LENGTH)),
+    debug_sample_rate=float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", 1.0)),
+    payloads=os.environ.get("LOG_PAYLOADS") == "1",
+)
 logger = logging.getLogger("chatbot")
 
-db = SQL("sqlite:///chat.db")
-
-# Call the function to create tables
-create_tables_if_not_exist(db)
+# A SQLite file path, or a postgresql:// URL so that several app instances can share state
+DATABASE = os.environ.get("DATABASE", "chat.db")
 
-# Initialize current chat control variable
-current_chat_id = 0
+# Users, chats and messages; opening a SQLite database also brings its schema up to date. Users and chat lists
+# are cached for DATABASE_CACHE_TTL seconds, 0 turns the cache off. A request that waits DATABASE_POOL_TIMEOUT
+# seconds for a pooled connection gets a 503
+db = open_repository(DATABASE, pool_size=int(os.environ.get("DATABASE_POOL_SIZE", DEFAULT_POOL_SIZE)),
+                     pool_timeout=float(os.environ.get("DATABASE_POOL_TIMEOUT", DEFAULT_POOL_TIMEOUT)),
+                     cache_ttl=float(os.environ.get("DATABASE_CACHE_TTL", DEFAULT_CACHE_TTL)),
+                     cache_entries=int(os.environ.get("DATABASE_CACHE_ENTRIES", DEFAULT_CACHE_ENTRIES)))
 
 # To use with SQLAlchemy
 #
@@ -62,9 +115,186 @@ current_chat_id = 0
 #     user = db.relationship('User', backref=db.backref('messages', lazy=True))
 
 
-# ChatBot initialization (global scope)
-bot = ChatBot(api_key=os.environ["MISTRAL_API_KEY"], model=DEFAULT_MODEL, system_message="",
-              temperature=DEFAULT_TEMPERATURE)
+# One Mistral client shared by every conversation, retrying transient failures and failing fast
+# per model while the upstream is down. MISTRAL_ENDPOINT points it elsewhere, e.g. at a fake server for benchmarks
+# The async client of asgi.py is opened with the same options
+UPSTREAM_OPTIONS = {
+    "connect_timeout": float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)),
+    "read_timeout": float(os.environ.get("UPSTREAM_READ_TIMEOUT", DEFAULT_READ_TIMEOUT)),
+    "max_attempts": int(os.environ.get("UPSTREAM_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)),
+    "failure_threshold": int(os.environ.get("UPSTREAM_FAILURE_THRESHOLD", DEFAULT_FAILURE_THRESHOLD)),
+    "reset_timeout": float(os.environ.get("UPSTREAM_RESET_TIMEOUT", DEFAULT_RESET_TIMEOUT)),
+}
+client = open_client(os.environ["MISTRAL_API_KEY"], endpoint=os.environ.get("MISTRAL_ENDPOINT"), **UPSTREAM_OPTIONS)
+
+# Opt-in completion cache: RESPONSE_CACHE is "memory" or "sqlite". Only temperature 0 requests
+# are cached unless RESPONSE_CACHE_ALLOW_SAMPLED is set.
+response_cache = open_cache(os.environ.get("RESPONSE_CACHE"), os.environ.get("RESPONSE_CACHE_PATH", "cache.db"),
+                            ttl=int(os.environ.get("RESPONSE_CACHE_TTL", DEFAULT_TTL)),
+                            max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+                            allow_sampled=os.environ.get("RESPONSE_CACHE_ALLOW_SAMPLED") == "1")
+
+# Opt-in semantic cache: SEMANTIC_CACHE is "hashing" for the local embedder or "mistral" for mistral-embed
+semantic_cache = None
+if os.environ.get("SEMANTIC_CACHE") in ("hashing", "mistral"):
+    if os.environ["SEMANTIC_CACHE"] == "mistral":
+        embedder, dimensions = MistralEmbedder(client), 1024
+    else:
+        embedder, dimensions = HashingEmbedder(), DEFAULT_DIMENSIONS
+    semantic_cache = SemanticCache(embedder, dimensions,
+                                   threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", DEFAULT_THRESHOLD)),
+                                   path=os.environ.get("SEMANTIC_CACHE_PATH", "semantic_cache.npz"))
+    atexit.register(semantic_cache.save)
+
+# Opt-in model routing: with MODEL_ROUTING=1 each turn goes to the user's model while it is healthy and fits the
+# conversation, and otherwise to the cheapest model that does
+router = None
+if os.environ.get("MODEL_ROUTING") == "1":
+    router = ModelRouter(MODEL_LIST, MODEL_CONTEXT_WINDOWS, breaker=client.breaker,
+                         latency_threshold=float(os.environ.get("MODEL_LATENCY_THRESHOLD", DEFAULT_LATENCY_THRESHOLD)),
+                         rate_limits=parse_rate_limits(os.environ.get("MODEL_RATE_LIMITS")))
+
+# Per-user and per-IP budgets for chat requests and estimated model tokens. RATE_LIMIT is "memory" (the default),
+# "sqlite" to share the budgets between worker processes, or "off"
+limiter = open_limiter(os.environ.get("RATE_LIMIT", "memory"), os.environ.get("RATE_LIMIT_PATH", "ratelimit.db"),
+                       requests_per_minute=float(os.environ.get("RATE_LIMIT_REQUESTS_PER_MINUTE",
+                                                                DEFAULT_REQUESTS_PER_MINUTE)),
+                       request_burst=float(os.environ.get("RATE_LIMIT_REQUEST_BURST", DEFAULT_REQUEST_BURST)),
+                       tokens_per_minute=float(os.environ.get("RATE_LIMIT_TOKENS_PER_MINUTE", DEFAULT_TOKENS_PER_MINUTE)),
+                       token_burst=float(os.environ.get("RATE_LIMIT_TOKEN_BURST", DEFAULT_TOKEN_BURST)))
+# Endpoints that reach the model and so count against the budgets
+RATE_LIMITED_ENDPOINTS = {"do_chat", "stream_chat"}
+
+
+def make_bot():
+    return ChatBot(api_key=None, model=DEFAULT_MODEL, system_message="", temperature=DEFAULT_TEMPERATURE,
+                   client=client, cache=response_cache, semantic_cache=semantic_cache, router=router)
+
+
+# Live ChatBots keyed by (user_id, chat_id)
+conversations = ConversationStore(make_bot, max_conversations=app.config["CONVERSATION_MAX_COUNT"],
+                                  max_bytes=app.config["CONVERSATION_MAX_BYTES"])
+
+# Background summaries of long chats, sent in place of their older turns
+summarizer = ConversationSummarizer(client, db, model=DEFAULT_MODEL,
+                                    recent_messages=int(os.environ.get("SUMMARY_RECENT_MESSAGES",
+                                                                       DEFAULT_RECENT_MESSAGES)),
+                                    refresh_after=int(os.environ.get("SUMMARY_REFRESH_AFTER", DEFAULT_REFRESH_AFTER)))
+
+# Completed turns are stored by a background writer in batched transactions, journaled to WRITE_BEHIND_JOURNAL
+# first so none is lost if the process dies. WRITE_BEHIND=0 stores each turn before its request finishes instead
+writer = None
+if os.environ.get("WRITE_BEHIND", "1") == "1":
+    writer = open_writer(db, os.environ.get("WRITE_BEHIND_JOURNAL", "writebehind.journal"),
+                         queue_size=int(os.environ.get("WRITE_BEHIND_QUEUE_SIZE", DEFAULT_QUEUE_SIZE)),
+                         batch_size=int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", DEFAULT_BATCH_SIZE)))
+    atexit.register(writer.close)
+
+# Every MAINTENANCE_INTERVAL seconds (0 turns it off) chats idle for ARCHIVE_AFTER_DAYS are compressed out of Messages,
+# free pages are given back to the file system and the planner's statistics are refreshed. Archived chats are restored
+# the first time they are opened
+maintenance = open_scheduler(db,
+                             interval=float(os.environ.get("MAINTENANCE_INTERVAL", DEFAULT_MAINTENANCE_INTERVAL)),
+                             archive_after_days=float(os.environ.get("ARCHIVE_AFTER_DAYS", DEFAULT_ARCHIVE_AFTER_DAYS)))
+if maintenance is not None:
+    atexit.register(maintenance.stop)
+
+
+def cache_counts():
+    """Hits and misses of every cache in front of the database and the model, read when metrics are scraped"""
+    counts = {}
+    for name, cache in [("conversation", conversations), ("completion", response_cache), ("semantic", semantic_cache),
+                        ("repository", db if isinstance(db, CachedRepository) else None)]:
+        if cache is not None:
+            counts[(name, "hit")] = cache.hits
+            counts[(name, "miss")] = cache.misses
+    return counts
+
+
+CallbackMetric("chatbot_cache_requests_total", "Cache lookups by cache and result.", "counter", ("cache", "result"),
+               cache_counts)
+CallbackMetric("chatbot_routed_requests_total", "Requests routed per model and routing decision.", "counter",
+               ("model", "decision"), lambda: dict(router.decisions) if router is not None else {})
+CallbackMetric("chatbot_rate_limited_requests_total", "Requests refused by the rate limiter per exhausted budget.",
+               "counter", ("budget",),
+               lambda: {(budget,): count for budget, count in limiter.limited.items()} if limiter is not None else {})
+CallbackMetric("chatbot_maintenance_total", "Chats and messages archived and bytes reclaimed by database maintenance.",
+               "counter", ("item",),
+               lambda: {(item,): count for item, count in maintenance.totals.items()} if maintenance is not None else {})
+
+
+def save_turn(conversation, chat_id, user_id):
+    """Store the conversation's new messages, then refresh its summary when it has grown enough"""
+    if load_history(db, conversation, chat_id, user_id, writer):
+        persist_new_messages(db, conversation, chat_id, user_id, writer,
+                             on_stored=lambda: summarizer.schedule(conversation, chat_id, user_id))
+
+
+def wait_for_writes(chat_id, user_id):
+    """Let turns still queued for the chat reach the database before reading or deleting it"""
+    if writer is not None:
+        writer.wait(chat_id, user_id)
+
+
+def charge_turn(bot, user_id, ip):
+    """Count the model tokens of the bot's last turn against the user's and the address's budgets"""
+    if limiter is not None:
+        limiter.charge(user_id, ip, bot.turn_tokens)
+
+
+def page_size(default):
+    """The limit query argument, kept within what one page may hold"""
+    return max(1, min(request.args.get('limit', default, type=int), MAX_PAGE_SIZE))
+
+
+def chat_json(chat):
+    return {"chat_id": chat["chat_id"], "chat_name": chat["chat_name"],
+            "url": url_for('do_chat', chat_id=chat["chat_id"])}
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.before_request
+def rate_limit():
+    """Refuse chat requests from users and addresses that used up their budget, telling them when to retry"""
+    if limiter is None or request.method != "POST" or request.endpoint not in RATE_LIMITED_ENDPOINTS:
+        return None
+    wait = limiter.check(session.get('user_id'), request.remote_addr)
+    if not wait:
+        return None
+    logger.info("Rate limited user %s from %s for %.1fs", session.get('user_id'), request.remote_addr, wait)
+    if request.endpoint == "stream_chat":
+        # The browser reads the body as a stream of events, so the refusal is one too
+        response = Response(sse({"error": f"Too many requests, try again in {retry_after(wait)}s"}, event="error"),
+                            status=429, mimetype="text/event-stream")
+    else:
+        body, status = apology("too many requests", 429)
+        response = app.make_response((body, status))
+    response.headers["Retry-After"] = retry_after(wait)
+    return response
+
+
+@app.errorhandler(PoolTimeout)
+def database_busy(e):
+    """Tell the client to come back when every database connection stayed busy"""
+    logger.warning("Refused %s %s: %s", request.method, request.path, e)
+    body, status = apology("server busy", 503)
+    response = app.make_response((body, status))
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+@app.after_request
+def record_latency(response):
+    """Observe how long the route took, streamed responses until their first byte"""
+    if "request_started" in g:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, method=request.method, route=route,
+                                status=response.status_code)
+    return response
 
 
 @app.after_request
@@ -80,12 +310,18 @@ def after_request(response):
 def index():
     if 'user_id' in session:
         user_id = session['user_id']
-        user = db.execute("SELECT username FROM Users WHERE user_id = ?", user_id)
+        user = db.get_user(user_id)
         if user:
             return redirect(url_for("chats"))
     return render_template("index.html")
 
 
+@app.route("/metrics")
+def metrics():
+    """Expose request, database, inference and cache metrics to Prometheus"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     """Log user in"""
@@ -128,73 +364,174 @@ def register():
 def chats():
     if 'user_id' in session:
         user_id = session['user_id']
-        user = db.execute("SELECT username FROM Users WHERE user_id = ?", user_id)
+        user = db.get_user(user_id)
         if user:
-            user_chats = db.execute("SELECT chat_id, chat_name FROM chats WHERE user_id = ? ORDER BY created_at DESC",
-                                    user_id)
-            return render_template('chats.html', chats=user_chats)
+            user_chats, cursor = db.page_chats(user_id, limit=app.config["CHAT_PAGE_SIZE"])
+            return render_template('chats.html', chats=user_chats, cursor=cursor)
         else:
-            logger.error(f"User {user_id} not found in the db")
+            logger.error("User %s not found in the db", user_id)
             return apology("User not found", 404)
     else:
-        logger.error(f"User not logged in")
+        logger.error("User not logged in")
         return apology("Unauthorized access", 401)
 
 
+@app.route('/chats/page')
+@login_required
+def chats_page():
+    """The page of the user's chats after cursor, as JSON"""
+    try:
+        user_chats, cursor = db.page_chats(session['user_id'], request.args.get('cursor'),
+                                           limit=page_size(app.config["CHAT_PAGE_SIZE"]))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    return jsonify({"chats": [chat_json(chat) for chat in user_chats], "cursor": cursor})
+
+
+@app.route('/search')
+@login_required
+def search():
+    """Find messages across the user's chats"""
+    query = request.args.get('q', '').strip()
+    results = []
+    if query:
+        results = db.search_messages(session['user_id'], query)
+        for result in results:
+            result['snippet'] = highlight(result['snippet'])
+    return render_template('search.html', query=query, results=results)
+
+
 @app.route('/chat/<int:chat_id>', methods=['GET', 'POST'])
 def do_chat(chat_id):
-    global bot
-    global current_chat_id
-    if chat_id != current_chat_id:
-        bot.new_chat()
-    current_chat_id = chat_id
-    if request.method == 'GET':
-        if 'user_id' in session:
-            user_id = session['user_id']
-            user = db.execute("SELECT username FROM Users WHERE user_id = ?", user_id)
+    user_id = session.get('user_id')
+    session['chat_id'] = chat_id
+    # A message or command holds the chat's turn lock, so it never interleaves with a streamed turn
+    turn = conversations.turn_lock(user_id, chat_id) if request.method == 'POST' else nullcontext()
+    with turn, conversations.checkout(user_id, chat_id) as conversation:
+        bot = conversation.bot
+        if request.method == 'GET':
+            user = None
+            if user_id is not None:
+                user = db.get_user(user_id)
             if user:
-                user_chats = db.execute(
-                    "SELECT chat_id, chat_name FROM chats WHERE user_id = ? ORDER BY created_at DESC", user_id)
-                selected_chat = db.execute("SELECT * FROM Chats WHERE Chats.chat_id = ? ORDER BY created_at DESC "
-                                           "LIMIT 1", chat_id)
-                if selected_chat:
-                    # Retrieve messages for the last created chat
-                    db_messages = db.execute(
-                        "SELECT message_text, role FROM Messages WHERE chat_id = ? AND user_id = ?",
-                        chat_id, user_id)
-                    for message in bot.messages:
-                        l = {"message_text": message.content, "role": message.role}
-                        if l not in db_messages:
-                            db_messages.append(l)
-                            db.execute(
-                                "INSERT INTO messages (chat_id, user_id, message_text, role) VALUES (?, ?, ?, ?)",
-                                chat_id, user_id, message.content, message.role)
-                            logger.info(
-                                f'Inserted into messages: chat_id: {chat_id} for user: {user_id} message: {message.content} role: {message.role}')
-                            new_chat_name = db.execute(
-                                "SELECT message_text FROM messages WHERE chat_id = ? AND user_id = ? AND role = "
-                                "'user' ORDER BY created_at DESC LIMIT 1",
-                                chat_id, user_id)
-                            db.execute("UPDATE chats SET chat_name = ? WHERE chat_id = ? AND user_id = ?",
-                                       new_chat_name[0]["message_text"], chat_id, user_id)
-                            logger.info(f'Updated chats: chat_id: {chat_id} for user: {user_id}')
-                    for message in db_messages:
-                        if message["message_text"] not in [msg.content for msg in bot.messages]:
-                            bot.messages.append(ChatMessage(role=message["role"], content=message["message_text"]))
-        else:
-            user_chats = [{"chat_id": 0, "chat_name": "New Chat"}]
-        return render_template('chat.html', chat_id=chat_id, messages=bot.messages, chats=user_chats)
-    elif request.method == 'POST':
-        if 'user_input' in request.form:
-            user_input = request.form['user_input']
-            if bot is None:
-                return redirect(url_for('index'))
+                user_chats, cursor = db.page_chats(user_id, limit=app.config["CHAT_PAGE_SIZE"])
+            else:
+                user_chats, cursor = [{"chat_id": 0, "chat_name": "New Chat"}], None
+            # Turns not stored yet, such as commands run on a cold conversation, are appended first
+            if bot.messages is not conversation.marked_messages or len(bot.messages) > conversation.queued:
+                save_turn(conversation, chat_id, user_id)
+            wait_for_writes(chat_id, user_id)
+            # Only the newest page of a stored chat is rendered, the browser asks for older ones on scroll
+            if user and (conversation.loaded or db.chat_exists(chat_id, user_id)):
+                rows, before = db.page_messages(chat_id, user_id, limit=app.config["MESSAGE_PAGE_SIZE"])
+                messages = [{"role": row["role"], "content": row["message_text"]} for row in rows]
+            else:
+                messages, before = bot.messages[-app.config["MESSAGE_PAGE_SIZE"]:], None
+            return render_template('chat.html', chat_id=chat_id, messages=messages, before=before,
+                                   chats=user_chats, cursor=cursor)
+        elif request.method == 'POST':
+            if 'user_input' in request.form:
+                user_input = request.form['user_input']
+                if bot.is_command(user_input):
+                    bot.execute_command(user_input)
+                else:
+                    load_history(db, conversation, chat_id, user_id, writer)
+                    bot.run_inference(user_input)
+                    save_turn(conversation, chat_id, user_id)
+                    charge_turn(bot, user_id, request.remote_addr)
+            return redirect(url_for('do_chat', chat_id=chat_id))
+
+
+@app.route('/chat/<int:chat_id>/messages')
+@login_required
+def chat_messages(chat_id):
+    """The page of a chat's messages before the given message_id, oldest first, as JSON"""
+    wait_for_writes(chat_id, session['user_id'])
+    rows, before = db.page_messages(chat_id, session['user_id'], request.args.get('before', type=int),
+                                    limit=page_size(app.config["MESSAGE_PAGE_SIZE"]))
+    messages = [{"message_id": row["message_id"], "role": row["role"], "content": row["message_text"]}
+                for row in rows]
+    return jsonify({"messages": messages, "before": before})
+
+
+@app.route('/export')
+@login_required
+def export():
+    """Download all of the user's chats with their messages, streamed as JSONL or Parquet"""
+    fmt = request.args.get('format', 'jsonl')
+    try:
+        check_format(fmt)
+    except (ValueError, RuntimeError) as e:
+        return jsonify({"error": str(e)}), 400
+    if writer is not None:
+        # Include turns that are still queued, without holding the download up for long
+        writer.flush(timeout=5)
+    response = Response(stream_export(db, fmt, session['user_id']), mimetype=CONTENT_TYPES[fmt])
+    response.headers["Content-Disposition"] = f"attachment; filename=chats.{fmt}"
+    return response
+
+
+@app.route('/import', methods=['POST'])
+@login_required
+def import_file():
+    """Add the chats of an uploaded export to the user's chats, as new chats"""
+    upload = request.files.get('file')
+    if upload is None:
+        return jsonify({"error": "No file uploaded"}), 400
+    fmt = request.form.get('format') or format_of(upload.filename)
+    try:
+        counts = import_chats(db, read_chats(upload.stream, fmt), user_id=session['user_id'])
+    except (ValueError, RuntimeError) as e:
+        return jsonify({"error": str(e)}), 400
+    logger.info("Imported %s chats with %s messages for user: %s", counts["chats"], counts["messages"],
+                session['user_id'])
+    return jsonify(counts)
+
+
+def sse(data, event=None):
+    """Format one Server-Sent Events frame"""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+
+@app.route('/chat/<int:chat_id>/stream', methods=['POST'])
+def stream_chat(chat_id):
+    """Forward the assistant's reply to the browser as Server-Sent Events while it is generated"""
+    user_id = session.get('user_id')
+    user_input = request.form.get('user_input', '')
+    ip = request.remote_addr
+
+    def generate():
+        with ACTIVE_STREAMS.track(), conversations.turn_lock(user_id, chat_id), \
+                conversations.checkout(user_id, chat_id) as conversation:
+            bot = conversation.bot
+            if not user_input:
+                yield sse({}, event="done")
+                return
             if bot.is_command(user_input):
                 bot.execute_command(user_input)
-            else:
-                bot.run_inference(user_input)
-        return redirect(url_for('do_chat', chat_id=chat_id))
-    bot.exit()
+                yield sse({"reload": True}, event="done")
+                return
+            # A cold conversation needs its history before the model sees the new message
+            load_history(db, conversation, chat_id, user_id, writer)
+            try:
+                for delta in bot.stream_inference(user_input):
+                    yield sse({"delta": delta})
+            except Exception:
+                logger.exception("Inference failed for chat_id: %s", chat_id)
+                # Store the question, and whatever part of the answer arrived, so neither is lost
+                save_turn(conversation, chat_id, user_id)
+                charge_turn(bot, user_id, ip)
+                yield sse({"error": "Inference failed"}, event="error")
+                return
+            # The turn is complete, store it before telling the browser we are done
+            save_turn(conversation, chat_id, user_id)
+            charge_turn(bot, user_id, ip)
+            yield sse({}, event="done")
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
 
 @app.route('/start_chat', methods=['GET'])
@@ -203,42 +540,38 @@ def start_chat():
     # Redirect to a new chat page or handle form submission
     chat_id = 0
     chat_name = "New chat"
-    bot.new_chat()
     if 'user_id' in session:
         user_id = session['user_id']
-        user = db.execute("SELECT username FROM Users WHERE user_id = ?", user_id)
+        user = db.get_user(user_id)
         if user:
-            db.execute("INSERT INTO chats (chat_name, user_id) VALUES (?, ?)", chat_name, user_id)
-            logger.info(logger.info(f'Inserted into db: chat_name: {chat_name} for user: {user_id}'))
+            chat_id = db.create_chat(user_id, chat_name)
+            logger.info("Inserted into db: chat_name: %s for user: %s", chat_name, user_id)
             flash('New chat created successfully!', 'success')
-            chat_id = db.execute(
-                "SELECT chat_id FROM Chats WHERE chat_name = ? AND user_id = ? ORDER BY created_at DESC LIMIT 1",
-                chat_name, user_id)
-            return redirect(url_for('do_chat', chat_id=int(chat_id[0]['chat_id'])))
+            return redirect(url_for('do_chat', chat_id=int(chat_id)))
+    conversations.discard(session.get('user_id'), chat_id)
     return redirect(url_for('do_chat', chat_id=chat_id))
 
 
 @app.route('/delete_chat', methods=['POST'])
 def delete_chat():
-    global current_chat_id
+    current_chat_id = session.get('chat_id', 0)
     if 'user_id' in session:
         user_id = session['user_id']
-        user = db.execute("SELECT username FROM Users WHERE user_id = ?", user_id)
+        user = db.get_user(user_id)
         if user:
-            db.execute("DELETE FROM messages WHERE chat_id = ? AND user_id = ?", current_chat_id, user_id)
-            db.execute("DELETE FROM chats WHERE chat_id = ? AND user_id = ?", current_chat_id, user_id)
+            wait_for_writes(current_chat_id, user_id)
+            db.delete_chat(current_chat_id, user_id)
+            conversations.discard(user_id, current_chat_id)
             flash('Deleted successfully!', 'success')
-            logger.info(f'Deleted chat and messages: chat_id: {current_chat_id} for user: {user_id}')
-            chat_id = db.execute(
-                "SELECT chat_id FROM Chats WHERE user_id = ? ORDER BY created_at DESC LIMIT 1", user_id)
-            bot.new_chat()
+            logger.info("Deleted chat and messages: chat_id: %s for user: %s", current_chat_id, user_id)
+            chat_id = db.latest_chat_id(user_id)
             if chat_id:
-                current_chat_id = int(chat_id[0]['chat_id'])
+                current_chat_id = int(chat_id)
             else:
                 current_chat_id = 0
             return redirect(url_for('do_chat', chat_id=current_chat_id))
-    chat_id = 0;
-    bot.new_chat()
+    chat_id = 0
+    conversations.discard(session.get('user_id'), chat_id)
     return redirect(url_for('do_chat', chat_id=chat_id))
 
 
@@ -0,0 +1,177 @@
+"""
+ASGI entry point.
+
+Streaming chat completions are served from the event loop by the async
+inference engine, everything else is handed to the Flask app.
+
+Run with an ASGI server, for example: uvicorn asgi:application
+"""
+import asyncio
+import os
+import re
+import time
+from tempfile import SpooledTemporaryFile
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask import request, session
+
+from app import (UPSTREAM_OPTIONS, app, charge_turn, client, conversations, db, limiter, logger, response_cache, router,
+                 save_turn, sse, writer)
+from persistence import load_history
+from ratelimit import retry_after
+from metrics import ACTIVE_STREAMS, REQUEST_SECONDS
+from resilient import open_async_client
+from async_engine import AsyncInferenceEngine, DEFAULT_CONCURRENCY, holding, parse_model_concurrency
+
+STREAM_PATH = re.compile(r"^/chat/(\d+)/stream$")
+
+# Retries and timeouts like the Flask app's client, sharing its circuit breakers so the router sees async failures too
+engine = AsyncInferenceEngine(
+    open_async_client(os.environ["MISTRAL_API_KEY"], endpoint=os.environ.get("MISTRAL_ENDPOINT"), share=client,
+                      **UPSTREAM_OPTIONS),
+    concurrency=int(os.environ.get("INFERENCE_CONCURRENCY", DEFAULT_CONCURRENCY)),
+    model_concurrency=parse_model_concurrency(os.environ.get("INFERENCE_MODEL_CONCURRENCY")),
+    cache=response_cache,
+    router=router,
+)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi that runs each request on a thread of its own."""
+
+    async def __call__(self, scope, receive, send):
+        # asgiref runs every WSGI request on one shared thread unless it is given a context to run in,
+        # and then a blocking do_chat POST would hold up every other page
+        async with ThreadSensitiveContext():
+            await super().__call__(scope, receive, send)
+
+
+wsgi_application = ThreadedWsgiToAsgi(app)
+
+
+async def read_body(receive):
+    body = SpooledTemporaryFile(max_size=65536)
+    while True:
+        message = await receive()
+        body.write(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    body.seek(0)
+    return body
+
+
+def begin_turn(user_id, chat_id, user_input):
+    """Record the user's message, returns the request to send upstream or None for commands"""
+    with conversations.checkout(user_id, chat_id) as conversation:
+        bot = conversation.bot
+        if bot.is_command(user_input):
+            bot.execute_command(user_input)
+            return None
+        # A cold conversation needs its history before the model sees the new message
+        load_history(db, conversation, chat_id, user_id, writer)
+        messages = bot.begin_turn(user_input)
+        return bot.turn_model, bot.temperature, messages
+
+
+def end_turn(user_id, chat_id, assistant_response, ip):
+    with conversations.checkout(user_id, chat_id) as conversation:
+        conversation.bot.end_turn(assistant_response)
+        save_turn(conversation, chat_id, user_id)
+        charge_turn(conversation.bot, user_id, ip)
+
+
+async def stream_chat(scope, receive, send, chat_id):
+    started = time.perf_counter()
+    body = await read_body(receive)
+    instance = WsgiToAsgiInstance(app)
+    instance.scope = scope
+    environ = instance.build_environ(scope, body)
+    with app.request_context(environ):
+        user_id = session.get("user_id")
+        user_input = request.form.get("user_input", "")
+        ip = request.remote_addr
+    body.close()
+
+    if limiter is not None:
+        wait = await asyncio.to_thread(limiter.check, user_id, ip)
+        if wait:
+            logger.info("Rate limited user %s from %s for %.1fs", user_id, ip, wait)
+            await send({
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"text/event-stream; charset=utf-8"),
+                    (b"retry-after", retry_after(wait).encode()),
+                ],
+            })
+            REQUEST_SECONDS.observe(time.perf_counter() - started, method="POST",
+                                    route="/chat/<int:chat_id>/stream", status=429)
+            frame = sse({"error": f"Too many requests, try again in {retry_after(wait)}s"}, event="error")
+            await send({"type": "http.response.body", "body": frame.encode("utf-8"), "more_body": False})
+            return
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache, no-store, must-revalidate"),
+            (b"x-accel-buffering", b"no"),
+        ],
+    })
+    # Measured like the Flask routes, until the response starts
+    REQUEST_SECONDS.observe(time.perf_counter() - started, method="POST", route="/chat/<int:chat_id>/stream",
+                            status=200)
+
+    async def emit(frame):
+        await send({"type": "http.response.body", "body": frame.encode("utf-8"), "more_body": True})
+
+    if user_input:
+        # The same lock the Flask routes take, so a turn never interleaves with one from a worker thread
+        async with holding(conversations.turn_lock(user_id, chat_id)):
+            # Conversation state is guarded by thread locks, so touch it off the event loop
+            turn = await asyncio.to_thread(begin_turn, user_id, chat_id, user_input)
+            if turn is None:
+                await emit(sse({"reload": True}, event="done"))
+            else:
+                model, temperature, messages = turn
+                assistant_response = ""
+                failed = False
+                try:
+                    with ACTIVE_STREAMS.track():
+                        async for delta in engine.stream(model, temperature, messages, user_id=user_id):
+                            assistant_response += delta
+                            await emit(sse({"delta": delta}))
+                except Exception:
+                    logger.exception("Inference failed for chat_id: %s", chat_id)
+                    failed = True
+                # Store the question, and whatever part of the answer arrived, so neither is lost
+                await asyncio.to_thread(end_turn, user_id, chat_id, assistant_response, ip)
+                if failed:
+                    await emit(sse({"error": "Inference failed"}, event="error"))
+                else:
+                    await emit(sse({}, event="done"))
+    else:
+        await emit(sse({}, event="done"))
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await engine.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    match = STREAM_PATH.match(scope.get("path", ""))
+    if scope["type"] == "http" and scope["method"] == "POST" and match:
+        return await stream_chat(scope, receive, send, int(match.group(1)))
+    return await wsgi_application(scope, receive, send)
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from metrics import StreamTimer
+from response_cache import replay
+
+DEFAULT_CONCURRENCY = 8
+# Seconds between attempts at a thread lock that holding() is waiting for
+LOCK_POLL = 0.05
+
+logger = logging.getLogger("chatbot.async_engine")
+
+
+def parse_model_concurrency(value):
+    """Parse "model=limit,model=limit" into a dictionary of per-model limits."""
+    limits = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            model, limit = item.split("=", 1)
+            limits[model.strip()] = int(limit)
+    return limits
+
+
+@asynccontextmanager
+async def holding(lock):
+    """
+    Hold a threading lock from the event loop. It is polled rather than waited for on a worker
+    thread, so coroutines queued on one lock never tie up the threads its holder needs to finish.
+    """
+    while not lock.acquire(blocking=False):
+        await asyncio.sleep(LOCK_POLL)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+class FairScheduler:
+    """
+    A semaphore that hands free slots to waiting users in round-robin order.
+
+    Each user has their own queue of waiters, so a user with many requests in
+    flight only ever gets one turn per round while others are waiting.
+    Must be used from a single event loop.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._waiting = OrderedDict()
+
+    def waiting(self):
+        return sum(len(queue) for queue in self._waiting.values())
+
+    async def acquire(self, user_id):
+        if self.active < self.limit and not self._waiting:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_id, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we were cancelled, pass it on
+                self.release()
+            else:
+                self._forget(user_id, future)
+            raise
+
+    def release(self):
+        while self._waiting:
+            user_id, queue = next(iter(self._waiting.items()))
+            future = queue.popleft()
+            if queue:
+                self._waiting.move_to_end(user_id)
+            else:
+                del self._waiting[user_id]
+            if not future.done():
+                # Hand the slot over directly, the active count stays the same
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def _forget(self, user_id, future):
+        queue = self._waiting.get(user_id)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self._waiting[user_id]
+
+
+class AsyncInferenceEngine:
+    """Run many streaming completions on one event loop with bounded per-model concurrency."""
+
+    def __init__(self, client, concurrency=DEFAULT_CONCURRENCY, model_concurrency=None, cache=None, router=None):
+        self.client = client
+        self.cache = cache
+        # Optional ModelRouter that is told how long each model takes to start answering
+        self.router = router
+        self.concurrency = concurrency
+        self.model_concurrency = model_concurrency or {}
+        self._schedulers = {}
+
+    def scheduler(self, model):
+        if model not in self._schedulers:
+            self._schedulers[model] = FairScheduler(self.model_concurrency.get(model, self.concurrency))
+        return self._schedulers[model]
+
+    @asynccontextmanager
+    async def slot(self, model, user_id):
+        scheduler = self.scheduler(model)
+        await scheduler.acquire(user_id)
+        try:
+            yield
+        finally:
+            scheduler.release()
+
+    async def stream(self, model, temperature, messages, user_id=None):
+        """Yield the reply to messages chunk by chunk once a slot for the model is free."""
+        use_cache = self.cache is not None and self.cache.applies(temperature)
+        if use_cache:
+            # The cache may be on disk, so it is read and written off the event loop
+            cached = await asyncio.to_thread(self.cache.get, model, temperature, messages)
+            if cached is not None:
+                for response in replay(cached):
+                    yield response
+                return
+
+        assistant_response = ""
+        async with self.slot(model, user_id):
+            logger.debug("Running async inference with model: %s, temperature: %s", model, temperature)
+            timer = StreamTimer(model)
+            async for chunk in self.client.chat_stream(model=model, temperature=temperature, messages=messages):
+                first_token = timer.chunk()
+                if first_token is not None and self.router is not None:
+                    self.router.observe(model, first_token)
+                response = chunk.choices[0].delta.content
+                if response is not None:
+                    assistant_response += response
+                    yield response
+            timer.finish(assistant_response)
+        if use_cache:
+            await asyncio.to_thread(self.cache.put, model, temperature, messages, assistant_response)
+
+    async def close(self):
+        await self.client.close()
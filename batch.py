@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from mistralai.models.chat_completion import ChatMessage
+
+DEFAULT_CONCURRENCY = 8
+
+logger = logging.getLogger("chatbot.batch")
+
+
+def completed_ids(output_path):
+    """Ids already answered in an earlier run's output, so a restarted run can skip them."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line of a run that crashed mid-write
+                continue
+            if record.get("error") is None:
+                done.add(record["id"])
+    return done
+
+
+def read_prompts(input_path, id_field="id", prompt_field="prompt"):
+    """Yield (id, record) for each line of a JSONL file, one line at a time."""
+    with open(input_path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "messages" not in record and prompt_field not in record:
+                logger.warning("Skipping line %d of %s without %s or messages", number, input_path, prompt_field)
+                continue
+            yield record.get(id_field, number), record
+
+
+def build_messages(record, prompt_field, system_message=None):
+    if "messages" in record:
+        return [ChatMessage(role=message["role"], content=message["content"]) for message in record["messages"]]
+    messages = []
+    system_message = record.get("system", system_message)
+    if system_message:
+        messages.append(ChatMessage(role="system", content=system_message))
+    messages.append(ChatMessage(role="user", content=record[prompt_field]))
+    return messages
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class BatchRunner:
+    """
+    Answer every prompt of a JSONL file and append one result per line to an output JSONL file.
+
+    Prompts are read lazily and at most a few per worker are in flight, so input
+    files of any size run in constant memory. Results are written as they arrive,
+    and ids that already have a successful result are skipped, so a crashed run
+    picks up where it stopped when started again with the same output file.
+    """
+
+    def __init__(self, client, model, temperature, system_message=None, concurrency=DEFAULT_CONCURRENCY,
+                 id_field="id", prompt_field="prompt"):
+        self.client = client
+        self.model = model
+        self.temperature = temperature
+        self.system_message = system_message
+        self.concurrency = concurrency
+        self.id_field = id_field
+        self.prompt_field = prompt_field
+        self.latencies = []
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def complete(self, request_id, record):
+        model = record.get("model", self.model)
+        temperature = record.get("temperature", self.temperature)
+        result = {"id": request_id, "model": model, "response": None, "error": None}
+        started = time.perf_counter()
+        try:
+            response = self.client.chat(model=model, temperature=temperature,
+                                        messages=build_messages(record, self.prompt_field, self.system_message))
+            result["response"] = response.choices[0].message.content
+            usage = response.usage
+            result["prompt_tokens"] = usage.prompt_tokens if usage else None
+            result["completion_tokens"] = usage.completion_tokens if usage else None
+        except Exception as e:
+            result["error"] = str(e) or type(e).__name__
+        result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return result
+
+    def record(self, result, output):
+        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output.flush()
+        if result["error"] is not None:
+            self.failed += 1
+            logger.warning("Request %s failed: %s", result["id"], result["error"])
+            return
+        self.succeeded += 1
+        self.latencies.append(result["latency_ms"])
+        self.prompt_tokens += result.get("prompt_tokens") or 0
+        self.completion_tokens += result.get("completion_tokens") or 0
+
+    def run(self, input_path, output_path):
+        """Run every prompt not yet answered in output_path and return the run's stats."""
+        done = completed_ids(output_path)
+        started = time.perf_counter()
+        # A crash can leave the last line without its newline, start the next record on a line of its own
+        if os.path.exists(output_path) and os.path.getsize(output_path):
+            with open(output_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                partial = f.read(1) != b"\n"
+        else:
+            partial = False
+
+        with open(output_path, "a", encoding="utf-8") as output, \
+                ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch") as executor:
+            if partial:
+                output.write("\n")
+            in_flight = set()
+            for request_id, record in read_prompts(input_path, self.id_field, self.prompt_field):
+                if request_id in done:
+                    self.skipped += 1
+                    continue
+                done.add(request_id)
+                in_flight.add(executor.submit(self.complete, request_id, record))
+                if len(in_flight) >= self.concurrency * 2:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        self.record(future.result(), output)
+            for future in wait(in_flight).done:
+                self.record(future.result(), output)
+        return self.stats(time.perf_counter() - started)
+
+    def stats(self, elapsed):
+        latencies = sorted(self.latencies)
+        return {
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "elapsed_s": round(elapsed, 2),
+            "latency_ms": {
+                "mean": round(sum(latencies) / len(latencies), 1) if latencies else 0.0,
+                "p50": percentile(latencies, 0.50),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "max": latencies[-1] if latencies else 0.0,
+            },
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "completion_tokens_per_s": round(self.completion_tokens / elapsed, 1) if elapsed else 0.0,
+        }
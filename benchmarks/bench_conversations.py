@@ -0,0 +1,105 @@
+"""
+Measure chat page throughput with many users talking at once.
+
+Runs the Flask app against a throwaway database and a fake Mistral client,
+once with the conversation store disabled (every request rebuilds the bot
+from the database, as the old global bot did) and once with it enabled.
+
+Usage: python benchmarks/bench_conversations.py [--users 50] [--messages 40] [--threads 8] [--requests 2000]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCHEMA = [
+    """CREATE TABLE Users (user_id INTEGER PRIMARY KEY AUTOINCREMENT, username VARCHAR(50) UNIQUE,
+       email VARCHAR(100) UNIQUE, password_hash VARCHAR(100), created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""",
+    """CREATE TABLE Chats (chat_id INTEGER PRIMARY KEY AUTOINCREMENT, chat_name VARCHAR(100), user_id INTEGER,
+       created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""",
+    """CREATE TABLE Messages (message_id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, user_id INTEGER,
+       message_text TEXT, role TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""",
+]
+
+
+class FakeClient:
+    """Stand-in for MistralClient that streams a fixed reply."""
+
+    def chat_stream(self, model, temperature, messages):
+        for word in "this is a canned reply".split():
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word + " "))])
+
+
+def seed(path, users, messages):
+    conn = sqlite3.connect(path)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    for user_id in range(1, users + 1):
+        conn.execute("INSERT INTO Users (user_id, username) VALUES (?, ?)", (user_id, f"user{user_id}"))
+        conn.execute("INSERT INTO Chats (chat_id, chat_name, user_id) VALUES (?, ?, ?)",
+                     (user_id, "chat", user_id))
+        conn.executemany(
+            "INSERT INTO Messages (chat_id, user_id, message_text, role) VALUES (?, ?, ?, ?)",
+            [(user_id, user_id, f"message {i} " * 20, "user" if i % 2 == 0 else "assistant")
+             for i in range(messages)])
+    conn.commit()
+    conn.close()
+
+
+def run(app_module, users, threads, requests):
+    counter = iter(range(requests))
+    lock = threading.Lock()
+
+    def worker():
+        client = app_module.app.test_client()
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            user_id = random.randint(1, users)
+            with client.session_transaction() as sess:
+                sess["user_id"] = user_id
+            client.get(f"/chat/{user_id}")
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=40)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    seed(os.path.join(workdir, "chat.db"), args.users, args.messages)
+    os.chdir(workdir)
+    os.environ.setdefault("MISTRAL_API_KEY", "benchmark")
+
+    import app as app_module
+    app_module.client = FakeClient()
+
+    for label, max_conversations in [("no store (old global bot)", 0), ("conversation store", args.users * 2)]:
+        app_module.conversations.clear()
+        app_module.conversations.max_conversations = max_conversations
+        rps = run(app_module, args.users, args.threads, args.requests)
+        print(f"{label:30s} {rps:8.1f} req/s  {app_module.conversations.stats()}")
+
+
+if __name__ == "__main__":
+    main()
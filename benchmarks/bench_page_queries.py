@@ -0,0 +1,75 @@
+"""
+Count the database round-trips of each page, with and without the repository cache.
+
+Seeds a throwaway database, then requests every page twice as a logged-in
+user, with DATABASE_CACHE_TTL=0 and with the default TTL, and prints how many
+statements each request ran. The second request of a page is the warm one.
+
+Usage: python benchmarks/bench_page_queries.py [--users 5] [--messages 40]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_conversations import FakeClient, seed  # noqa: E402
+
+PAGES = ["/", "/chats", "/chat/1", "/chats/page?limit=10", "/chat/1/messages?limit=10"]
+
+
+def count_queries(workdir):
+    """Runs in a child process so each cache setting gets a freshly imported app."""
+    os.chdir(workdir)
+    os.environ.setdefault("MISTRAL_API_KEY", "benchmark")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import storage
+    import app as app_module
+    app_module.client = FakeClient()
+
+    statements = []
+    execute = storage.Database.execute
+
+    def counting_execute(self, sql, *args, **kwargs):
+        # Sessions live in a database of their own, only the chat database is counted
+        if self.path == "chat.db":
+            statements.append(sql)
+        return execute(self, sql, *args, **kwargs)
+
+    storage.Database.execute = counting_execute
+    client = app_module.app.test_client()
+    with client.session_transaction() as sess:
+        sess["user_id"] = 1
+    for page in PAGES:
+        for attempt in ("cold", "warm"):
+            statements.clear()
+            client.get(page)
+            print(f"  {page:28s} {attempt}: {len(statements)} queries")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=40)
+    parser.add_argument("--child", metavar="WORKDIR", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        count_queries(args.child)
+        return
+
+    for label, ttl in [("no cache", "0"), ("repository cache", None)]:
+        workdir = tempfile.mkdtemp()
+        seed(os.path.join(workdir, "chat.db"), args.users, args.messages)
+        env = dict(os.environ)
+        env.pop("DATABASE_CACHE_TTL", None)
+        if ttl is not None:
+            env["DATABASE_CACHE_TTL"] = ttl
+        print(label)
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--child", workdir], env=env, check=True)
+
+
+if __name__ == "__main__":
+    main()
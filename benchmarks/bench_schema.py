@@ -0,0 +1,87 @@
+"""
+Measure the hot chat queries before and after the schema migrations.
+
+Seeds a throwaway database with the original, unindexed schema, times the
+queries the routes issue, applies the remaining migrations and times them again.
+
+Usage: python benchmarks/bench_schema.py [--users 1000] [--chats 10] [--messages 1000000]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from migrations import MIGRATIONS, migrate  # noqa: E402
+
+QUERIES = {
+    "chat list": ("SELECT chat_id, chat_name FROM chats WHERE user_id = ? ORDER BY created_at DESC", "user"),
+    "chat history": ("SELECT message_id, message_text, role FROM Messages WHERE chat_id = ? AND user_id = ? "
+                     "ORDER BY message_id", "chat"),
+    "latest chat": ("SELECT chat_id FROM Chats WHERE user_id = ? ORDER BY created_at DESC LIMIT 1", "user"),
+}
+
+
+def seed(path, users, chats, messages):
+    migrate(path, MIGRATIONS[:1])
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO Users (user_id, username) VALUES (?, ?)",
+                     ((user_id, f"user{user_id}") for user_id in range(1, users + 1)))
+    total_chats = users * chats
+    conn.executemany("INSERT INTO Chats (chat_id, chat_name, user_id) VALUES (?, ?, ?)",
+                     ((chat_id, "chat", (chat_id - 1) // chats + 1) for chat_id in range(1, total_chats + 1)))
+    rows = ((chat_id, (chat_id - 1) // chats + 1, "benchmark message text", "user" if i % 2 else "assistant")
+            for i in range(messages) for chat_id in [random.randint(1, total_chats)])
+    conn.executemany("INSERT INTO Messages (chat_id, user_id, message_text, role) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+    return total_chats
+
+
+def time_queries(path, users, chats, total_chats, repeat):
+    conn = sqlite3.connect(path)
+    results = {}
+    for label, (sql, kind) in QUERIES.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            if kind == "user":
+                conn.execute(sql, (random.randint(1, users),)).fetchall()
+            else:
+                chat_id = random.randint(1, total_chats)
+                conn.execute(sql, (chat_id, (chat_id - 1) // chats + 1)).fetchall()
+        results[label] = (time.perf_counter() - start) / repeat * 1000
+    conn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--chats", type=int, default=10, help="chats per user")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "chat.db")
+    start = time.perf_counter()
+    total_chats = seed(path, args.users, args.chats, args.messages)
+    print(f"Seeded {args.messages} messages in {time.perf_counter() - start:.1f}s")
+
+    before = time_queries(path, args.users, args.chats, total_chats, args.repeat)
+    start = time.perf_counter()
+    migrate(path)
+    print(f"Migrated in {time.perf_counter() - start:.1f}s")
+    after = time_queries(path, args.users, args.chats, total_chats, args.repeat)
+
+    print(f"{'query':15s} {'before ms':>10s} {'after ms':>10s}")
+    for label in QUERIES:
+        print(f"{label:15s} {before[label]:10.3f} {after[label]:10.3f}")
+
+
+if __name__ == "__main__":
+    main()
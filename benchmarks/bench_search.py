@@ -0,0 +1,80 @@
+"""
+Measure full-text search latency over a large message table.
+
+Seeds a throwaway database with random text, backfills the FTS5 index and
+times ranked, snippeted, per-user searches for common and rare words.
+
+Usage: python benchmarks/bench_search.py [--users 1000] [--messages 1000000] [--queries 200]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from repositories import SQLiteRepository  # noqa: E402
+from search import backfill  # noqa: E402
+
+# Zipf-like vocabulary so that some words are common and most are rare
+VOCABULARY = [f"word{i}" for i in range(20000)]
+WEIGHTS = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+
+
+def seed(path, users, messages):
+    SQLiteRepository(path).close()
+    conn = sqlite3.connect(path)
+    # Load without the sync triggers and index everything at once afterwards, as a migration of old data would
+    conn.execute("DROP TRIGGER messages_search_insert")
+    conn.executemany("INSERT INTO Users (user_id, username) VALUES (?, ?)",
+                     ((user_id, f"user{user_id}") for user_id in range(1, users + 1)))
+    conn.executemany("INSERT INTO Chats (chat_id, chat_name, user_id) VALUES (?, ?, ?)",
+                     ((user_id, "chat", user_id) for user_id in range(1, users + 1)))
+    batch = 50000
+    for start in range(0, messages, batch):
+        rows = []
+        for _ in range(min(batch, messages - start)):
+            user_id = random.randint(1, users)
+            text = " ".join(random.choices(VOCABULARY, WEIGHTS, k=random.randint(5, 40)))
+            rows.append((user_id, user_id, text, "user"))
+        conn.executemany("INSERT INTO Messages (chat_id, user_id, message_text, role) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+    # Put the trigger back by re-running the migration that created it
+    sqlite3.connect(path).execute("DELETE FROM SchemaVersion WHERE version = 5").connection.commit()
+    SQLiteRepository(path).close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "chat.db")
+    start = time.perf_counter()
+    seed(path, args.users, args.messages)
+    print(f"Seeded {args.messages} messages in {time.perf_counter() - start:.1f}s")
+    print(f"Backfilled the search index in {backfill(path):.1f}s")
+
+    repo = SQLiteRepository(path)
+    for label, words in [("common word", VOCABULARY[:10]), ("rare word", VOCABULARY[5000:]),
+                         ("two words", VOCABULARY[:200]), ("prefix", ["word12"])]:
+        timings = []
+        for _ in range(args.queries):
+            query = " ".join(random.sample(words, 2)) if label == "two words" else random.choice(words)
+            started = time.perf_counter()
+            repo.search_messages(random.randint(1, args.users), query)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        print(f"{label:12s} p50 {timings[len(timings) // 2]:7.2f} ms  p95 {timings[int(len(timings) * 0.95)]:7.2f} ms")
+    repo.close()
+
+
+if __name__ == "__main__":
+    main()
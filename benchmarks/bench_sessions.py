@@ -0,0 +1,114 @@
+"""
+Compare session stores: per-request overhead and disk usage after many logins.
+
+Each store backs a minimal Flask app. Every login clears the session and
+stores a user_id under a fresh cookie, as app.py's /login does, then a page
+that only reads the session is requested repeatedly with the last cookie.
+Sessions kept shows how many logins are still valid at the end: Flask-Session's
+filesystem store prunes files beyond its threshold of 500 whether or not they
+are still in use.
+
+Usage: python benchmarks/bench_sessions.py [--logins 100000] [--requests 5000] [--stores filesystem,memory,sqlite]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from flask import Flask, session
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sessions import open_session_interface  # noqa: E402
+
+
+def make_app(kind, workdir):
+    app = Flask(__name__)
+    app.config["SESSION_PERMANENT"] = False
+    if kind == "filesystem":
+        from flask_session import Session
+        app.config["SESSION_TYPE"] = "filesystem"
+        app.config["SESSION_FILE_DIR"] = os.path.join(workdir, "flask_session")
+        Session(app)
+    else:
+        app.session_interface = open_session_interface(kind, os.path.join(workdir, "sessions.db"))
+
+    @app.route("/login/<int:user_id>")
+    def login(user_id):
+        session.clear()
+        session["user_id"] = user_id
+        return ""
+
+    @app.route("/page")
+    def page():
+        return str(session.get("user_id"))
+
+    return app
+
+
+def disk_usage(workdir):
+    """Bytes and number of files under workdir."""
+    total = count = 0
+    for directory, _, files in os.walk(workdir):
+        total += sum(os.path.getsize(os.path.join(directory, name)) for name in files)
+        count += len(files)
+    return total, count
+
+
+def sessions_kept(app, workdir):
+    store = getattr(app.session_interface, "store", None)
+    if store is not None:
+        return len(store)
+    # Flask-Session's cachelib directory holds one file per session plus a counter file
+    return disk_usage(os.path.join(workdir, "flask_session"))[1] - 1
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(kind, logins, requests):
+    workdir = tempfile.mkdtemp(prefix=f"sessions-{kind}-")
+    app = make_app(kind, workdir)
+
+    start = time.perf_counter()
+    for user_id in range(logins):
+        # A new client per login, like a new browser
+        app.test_client().get(f"/login/{user_id}")
+    login_seconds = time.perf_counter() - start
+
+    client = app.test_client()
+    client.get(f"/login/{logins}")
+    timings = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        client.get("/page")
+        timings.append((time.perf_counter() - started) * 1e6)
+    timings.sort()
+    return {
+        "kept": sessions_kept(app, workdir),
+        "logins_per_s": logins / login_seconds,
+        "p50_us": percentile(timings, 0.50),
+        "p95_us": percentile(timings, 0.95),
+        "disk_mb": disk_usage(workdir)[0] / 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--logins", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--stores", default="filesystem,memory,sqlite")
+    args = parser.parse_args()
+
+    print(f"{'store':12s} {'logins/s':>10s} {'page p50':>10s} {'page p95':>10s} {'disk':>10s} {'kept':>8s}")
+    for kind in args.stores.split(","):
+        result = measure(kind, args.logins, args.requests)
+        print(f"{kind:12s} {result['logins_per_s']:10.0f} {result['p50_us']:8.0f}us {result['p95_us']:8.0f}us "
+              f"{result['disk_mb']:8.2f}MB {result['kept']:8d}")
+
+
+if __name__ == "__main__":
+    main()
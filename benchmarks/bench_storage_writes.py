@@ -0,0 +1,95 @@
+"""
+Measure write throughput with N concurrent chat POSTs.
+
+Each simulated POST stores a user and an assistant message and renames the
+chat, the writes persist_new_messages makes at the end of a turn. Compares a
+default sqlite3 connection per request (rollback journal, synchronous=FULL,
+no busy timeout) against the pooled, WAL-mode connections from storage.py.
+
+Usage: python benchmarks/bench_storage_writes.py [--threads 1 4 16] [--posts 200]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from migrations import migrate  # noqa: E402
+from storage import Database  # noqa: E402
+
+INSERT = "INSERT INTO messages (chat_id, user_id, message_text, role) VALUES (?, ?, ?, ?), (?, ?, ?, ?)"
+RENAME = "UPDATE chats SET chat_name = ? WHERE chat_id = ? AND user_id = ?"
+
+
+def setup(threads):
+    path = os.path.join(tempfile.mkdtemp(), "chat.db")
+    migrate(path)
+    conn = sqlite3.connect(path)
+    for user_id in range(1, threads + 1):
+        conn.execute("INSERT INTO Users (user_id, username) VALUES (?, ?)", (user_id, f"user{user_id}"))
+        conn.execute("INSERT INTO Chats (chat_id, chat_name, user_id) VALUES (?, ?, ?)", (user_id, "chat", user_id))
+    conn.commit()
+    conn.close()
+    return path
+
+
+def default_post(path, user_id):
+    conn = sqlite3.connect(path, timeout=0)
+    try:
+        conn.execute(INSERT, (user_id, user_id, "question", "user", user_id, user_id, "answer", "assistant"))
+        conn.execute(RENAME, ("question", user_id, user_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def pooled_post(db, user_id):
+    with db.transaction():
+        db.execute(INSERT, user_id, user_id, "question", "user", user_id, user_id, "answer", "assistant")
+        db.execute(RENAME, "question", user_id, user_id)
+
+
+def run(post, threads, posts):
+    errors = []
+
+    def worker(user_id):
+        for _ in range(posts):
+            try:
+                post(user_id)
+            except sqlite3.OperationalError as e:
+                errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=(user_id,)) for user_id in range(1, threads + 1)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return (threads * posts - len(errors)) / elapsed, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--posts", type=int, default=200, help="posts per thread")
+    args = parser.parse_args()
+
+    print(f"{'threads':>7s} {'default posts/s':>16s} {'locked':>7s} {'pooled posts/s':>15s} {'locked':>7s}")
+    for threads in args.threads:
+        path = setup(threads)
+        default_rate, default_errors = run(lambda user_id: default_post(path, user_id), threads, args.posts)
+        path = setup(threads)
+        db = Database(path, pool_size=threads)
+        pooled_rate, pooled_errors = run(lambda user_id: pooled_post(db, user_id), threads, args.posts)
+        db.close()
+        print(f"{threads:7d} {default_rate:16.1f} {default_errors:7d} {pooled_rate:15.1f} {pooled_errors:7d}")
+
+
+if __name__ == "__main__":
+    main()
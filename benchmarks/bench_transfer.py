@@ -0,0 +1,100 @@
+"""
+Measure chat export and import throughput in MB/s, and the memory they take.
+
+Seeds a throwaway database, exports every chat to each format, then imports
+the file into a fresh database for one new user. Throughput is the size of the
+message text moved per second, so formats compare fairly whatever their
+compression (the seeded messages repeat a lot and compress far better than real
+chats). Peak is the most Python memory allocated during a second, traced run;
+it should stay flat as --messages grows, since rows are streamed.
+
+Usage: python benchmarks/bench_transfer.py [--users 20] [--messages 5000] [--formats jsonl,parquet] [--chunk-size 1000]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_conversations import seed  # noqa: E402
+from repositories import SQLiteRepository  # noqa: E402
+from transfer import import_chats, read_chats, stream_export  # noqa: E402
+
+
+def export(repository, fmt, path, chunk_size):
+    with open(path, "wb") as f:
+        for data in stream_export(repository, fmt, chunk_size=chunk_size):
+            f.write(data)
+
+
+def import_file(repository, fmt, path, chunk_size):
+    user_id = repository.create_user(f"importer-{time.time_ns()}", "")
+    with open(path, "rb") as f:
+        return import_chats(repository, read_chats(f, fmt, chunk_size), user_id=user_id, chunk_size=chunk_size)
+
+
+def timed(run, traced):
+    """Seconds run() took, or the peak bytes it allocated when traced."""
+    if traced:
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+def text_mb(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT SUM(LENGTH(message_text)) FROM Messages").fetchone()[0] / 1e6
+    finally:
+        conn.close()
+
+
+def measure(fmt, source, workdir, chunk_size):
+    path = os.path.join(workdir, f"chats.{fmt}")
+    result = {}
+    for traced in (False, True):
+        result["export_peak" if traced else "export_s"] = timed(lambda: export(source, fmt, path, chunk_size),
+                                                               traced)
+        target = SQLiteRepository(os.path.join(workdir, f"import-{fmt}-{traced}.db"))
+        result["import_peak" if traced else "import_s"] = timed(
+            lambda: import_file(target, fmt, path, chunk_size), traced)
+        target.close()
+    result["file_mb"] = os.path.getsize(path) / 1e6
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=5000, help="Messages per user")
+    parser.add_argument("--formats", default="jsonl,parquet")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="transfer-")
+    path = os.path.join(workdir, "chat.db")
+    seed(path, args.users, args.messages)
+    source = SQLiteRepository(path)
+    mb = text_mb(path)
+    print(f"{args.users * args.messages} messages, {mb:.1f}MB of text, database {os.path.getsize(path) / 1e6:.1f}MB")
+    print(f"{'format':8s} {'file':>9s} {'export':>11s} {'import':>11s} {'export peak':>12s} {'import peak':>12s}")
+    for fmt in args.formats.split(","):
+        result = measure(fmt, source, workdir, args.chunk_size)
+        print(f"{fmt:8s} {result['file_mb']:7.1f}MB {mb / result['export_s']:7.1f}MB/s "
+              f"{mb / result['import_s']:7.1f}MB/s {result['export_peak'] / 1e6:10.1f}MB "
+              f"{result['import_peak'] / 1e6:10.1f}MB")
+    source.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Local stand-in for the Mistral chat completions API, for benchmarks.
+
+Streams a fixed number of tokens per reply after a configurable delay and at a
+configurable rate, and answers non-streaming requests (such as the summarizer's)
+with the whole reply after the same delay. Point the app at it with
+MISTRAL_ENDPOINT=http://127.0.0.1:PORT.
+
+Usage: python benchmarks/fake_mistral.py [--port 8001] [--latency 0.2] [--token-rate 50] [--reply-tokens 40]
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("the quick brown fox jumps over a lazy dog while an assistant writes a helpful answer about it").split()
+
+
+class FakeMistralHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Set on the server: latency, token_rate and reply_tokens
+    server_version = "FakeMistral"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        self.server.requests += 1
+        if not self.path.endswith("/chat/completions"):
+            self.send_json(404, {"message": f"Not found: {self.path}"})
+            return
+        time.sleep(self.server.latency)
+        tokens = [WORDS[i % len(WORDS)] + " " for i in range(self.server.reply_tokens)]
+        if body.get("stream"):
+            self.stream(body["model"], tokens)
+        else:
+            self.send_json(200, {
+                "id": "fake", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            })
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def stream(self, model, tokens):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        interval = 1 / self.server.token_rate if self.server.token_rate > 0 else 0
+        for i, token in enumerate(tokens):
+            if i and interval:
+                time.sleep(interval)
+            self.write_chunk("data: " + json.dumps({
+                "id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": {"role": "assistant", "content": token}, "finish_reason": None}],
+            }) + "\n\n")
+        self.write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+def start_server(port=0, latency=0.2, token_rate=50.0, reply_tokens=40):
+    """Serve on a background thread and return the server, its URL is server.url."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeMistralHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.token_rate = token_rate
+    server.reply_tokens = reply_tokens
+    server.requests = 0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, name="fake-mistral", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="Tokens streamed per second, 0 for no delay")
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.latency, args.token_rate, args.reply_tokens)
+    print(f"Serving fake completions on {server.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+Load-test the app end to end against a fake Mistral server and save the results as JSON.
+
+For every scale a throwaway chat.db is seeded with that many users, each with
+--chats chats of --messages messages. The app is then started as its own
+process, with MISTRAL_ENDPOINT pointed at benchmarks/fake_mistral.py, and
+--sessions browser sessions run at --concurrency at a time. Half of them are
+new users (register, login, start_chat, --posts POSTs to do_chat, reload) and
+half are seeded users coming back (login, reload a chat, POSTs, reload).
+
+Reports p50/p95/p99 latency per step, throughput, database statements from the
+app's /metrics, and the app's RSS. Pass --compare with an earlier result file
+to see how p95 latencies and throughput moved.
+
+Usage: python benchmarks/loadtest.py [--scales 10,1000] [--sessions 40] [--concurrency 8] [--posts 5]
+                                     [--latency 0.2] [--token-rate 50] [--server flask] [--output results.json]
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+from werkzeug.security import generate_password_hash
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_mistral import start_server  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+PASSWORD = "benchmark-1!"
+STARTUP_TIMEOUT = 60
+QUERY_COUNT = re.compile(r"^chatbot_db_query_seconds_count\{.*\} (\S+)$", re.MULTILINE)
+
+
+def seed(path, users, chats, messages, password_hash):
+    """Fill a new database; user n owns chats (n - 1) * chats + 1 to n * chats."""
+    migrate(path)
+    conn = sqlite3.connect(path)
+    try:
+        conn.executemany("INSERT INTO Users (username, password_hash) VALUES (?, ?)",
+                         ((f"seed{user_id}", password_hash) for user_id in range(1, users + 1)))
+        conn.executemany("INSERT INTO Chats (chat_name, user_id) VALUES (?, ?)",
+                         ((f"Chat {chat}", user_id) for user_id in range(1, users + 1) for chat in range(chats)))
+        conn.executemany("INSERT INTO Messages (chat_id, user_id, message_text, role) VALUES (?, ?, ?, ?)",
+                         ((chat_id, (chat_id - 1) // chats + 1, f"seeded message {i} " * 10,
+                           "user" if i % 2 == 0 else "assistant")
+                          for chat_id in range(1, users * chats + 1) for i in range(messages)))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_app(server, workdir, port, env):
+    if server == "uvicorn":
+        command = [sys.executable, "-m", "uvicorn", "--app-dir", ROOT, "--port", str(port), "--log-level", "warning",
+                   "asgi:application"]
+    else:
+        command = [sys.executable, "-m", "flask", "--app", os.path.join(ROOT, "app.py"), "run", "--port", str(port)]
+    log = open(os.path.join(workdir, "server.log"), "wb")
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited during startup, see {log.name}")
+        try:
+            if requests.get(base + "/login", timeout=1).ok:
+                return process, base
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"The app did not start within {STARTUP_TIMEOUT}s, see {log.name}")
+
+
+def memory(pid):
+    """Current and peak RSS of a process in MB, from /proc on Linux, or None elsewhere."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f)
+    except OSError:
+        return None, None
+    return int(fields["VmRSS"].split()[0]) / 1024, int(fields["VmHWM"].split()[0]) / 1024
+
+
+def query_count(base):
+    """Statements the app has run so far, summed over chatbot_db_query_seconds."""
+    return sum(float(value) for value in QUERY_COUNT.findall(requests.get(base + "/metrics", timeout=10).text))
+
+
+class Recorder:
+    def __init__(self):
+        self.timings = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def request(self, step, http, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = http.request(method, url, allow_redirects=False, timeout=120, **kwargs)
+        except requests.RequestException:
+            response = None
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.timings.setdefault(step, []).append(elapsed)
+            if response is None or response.status_code >= 400:
+                self.errors[step] = self.errors.get(step, 0) + 1
+        return response
+
+
+def new_user(recorder, base, number, posts):
+    http = requests.Session()
+    username = f"load{number}-{time.time_ns()}"
+    recorder.request("register", http, "POST", base + "/register",
+                     data={"username": username, "password": PASSWORD, "confirmation": PASSWORD})
+    recorder.request("login", http, "POST", base + "/login", data={"username": username, "password": PASSWORD})
+    response = recorder.request("start_chat", http, "GET", base + "/start_chat")
+    if response is None or "Location" not in response.headers:
+        return
+    chat = base + response.headers["Location"] if response.headers["Location"].startswith("/") \
+        else response.headers["Location"]
+    chat_session(recorder, http, chat, posts)
+
+
+def returning_user(recorder, base, number, posts, users, chats):
+    http = requests.Session()
+    user_id = number % users + 1
+    recorder.request("login", http, "POST", base + "/login", data={"username": f"seed{user_id}", "password": PASSWORD})
+    chat = f"{base}/chat/{(user_id - 1) * chats + 1}"
+    recorder.request("reload", http, "GET", chat)
+    chat_session(recorder, http, chat, posts)
+
+
+def chat_session(recorder, http, chat, posts):
+    for i in range(posts):
+        recorder.request("do_chat_post", http, "POST", chat, data={"user_input": f"Question {i}: what happened next?"})
+    recorder.request("reload", http, "GET", chat)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {"count": len(timings), "p50_ms": percentile(timings, 0.50) * 1000,
+            "p95_ms": percentile(timings, 0.95) * 1000, "p99_ms": percentile(timings, 0.99) * 1000,
+            "mean_ms": sum(timings) / len(timings) * 1000}
+
+
+def run_scale(args, users, password_hash, fake):
+    workdir = tempfile.mkdtemp(prefix=f"loadtest-{users}-")
+    database = os.path.join(workdir, "chat.db")
+    started = time.perf_counter()
+    seed(database, users, args.chats, args.messages, password_hash)
+    seed_seconds = time.perf_counter() - started
+
+    env = dict(os.environ, DATABASE=database, MISTRAL_API_KEY="benchmark", MISTRAL_ENDPOINT=fake.url,
+               RATE_LIMIT="off", LOG_LEVEL="WARNING")
+    env.update(item.split("=", 1) for item in args.env)
+    process, base = start_app(args.server, workdir, free_port(), env)
+    try:
+        queries_before = query_count(base)
+        recorder = Recorder()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            futures = [pool.submit(new_user, recorder, base, number, args.posts) if number % 2 == 0 else
+                       pool.submit(returning_user, recorder, base, number, args.posts, users, args.chats)
+                       for number in range(args.sessions)]
+            for future in futures:
+                future.result()
+        seconds = time.perf_counter() - started
+        # Scraping /metrics runs no statements, so the difference is what the sessions caused
+        queries = query_count(base) - queries_before
+        rss_mb, peak_rss_mb = memory(process.pid)
+    finally:
+        process.terminate()
+        process.wait(10)
+
+    count = sum(len(timings) for timings in recorder.timings.values())
+    return {
+        "users": users, "chats": users * args.chats, "messages": users * args.chats * args.messages,
+        "database_mb": os.path.getsize(database) / 1e6, "seed_seconds": seed_seconds,
+        "requests": count, "errors": sum(recorder.errors.values()), "errors_by_step": recorder.errors,
+        "seconds": seconds, "throughput_rps": count / seconds,
+        "db_queries": queries, "db_queries_per_request": queries / count if count else 0,
+        "rss_mb": rss_mb, "peak_rss_mb": peak_rss_mb,
+        "steps": {step: summarize(timings) for step, timings in recorder.timings.items()},
+        "all": summarize([t for timings in recorder.timings.values() for t in timings]),
+    }
+
+
+def print_result(result):
+    print(f"\n{result['users']} users, {result['messages']} messages ({result['database_mb']:.1f}MB): "
+          f"{result['requests']} requests in {result['seconds']:.1f}s, {result['throughput_rps']:.1f} req/s, "
+          f"{result['errors']} errors, {result['db_queries_per_request']:.1f} queries/request, "
+          f"RSS {result['rss_mb'] or 0:.0f}MB (peak {result['peak_rss_mb'] or 0:.0f}MB)")
+    print(f"  {'step':14s} {'count':>6s} {'p50':>9s} {'p95':>9s} {'p99':>9s}")
+    for step, stats in list(result["steps"].items()) + [("all", result["all"])]:
+        print(f"  {step:14s} {stats['count']:6d} {stats['p50_ms']:7.1f}ms {stats['p95_ms']:7.1f}ms "
+              f"{stats['p99_ms']:7.1f}ms")
+
+
+def compare(results, path):
+    with open(path) as f:
+        baseline = {result["users"]: result for result in json.load(f)["results"]}
+    print(f"\nCompared with {path}:")
+    for result in results:
+        old = baseline.get(result["users"])
+        if old is None:
+            continue
+        print(f"  {result['users']} users: throughput {change(old['throughput_rps'], result['throughput_rps'])}, "
+              f"queries/request {change(old['db_queries_per_request'], result['db_queries_per_request'])}")
+        for step, stats in result["steps"].items():
+            if step in old["steps"]:
+                print(f"    {step:14s} p95 {change(old['steps'][step]['p95_ms'], stats['p95_ms'])}")
+
+
+def change(old, new):
+    return f"{old:.1f} -> {new:.1f} ({(new - old) / old * 100:+.0f}%)" if old else f"{old:.1f} -> {new:.1f}"
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scales", default="10,1000", help="Comma-separated numbers of seeded users")
+    parser.add_argument("--chats", type=int, default=5, help="Chats per seeded user")
+    parser.add_argument("--messages", type=int, default=20, help="Messages per seeded chat")
+    parser.add_argument("--sessions", type=int, default=40, help="Browser sessions per scale")
+    parser.add_argument("--concurrency", type=int, default=8, help="Sessions running at once")
+    parser.add_argument("--posts", type=int, default=5, help="Messages sent per session")
+    parser.add_argument("--latency", type=float, default=0.2, help="Fake model's seconds to first token")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="Fake model's tokens per second, 0 for no delay")
+    parser.add_argument("--reply-tokens", type=int, default=40, help="Tokens per fake reply")
+    parser.add_argument("--server", choices=["flask", "uvicorn"], default="flask",
+                        help="flask run, or uvicorn serving asgi.py")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Extra environment for the app, e.g. DATABASE_CACHE_TTL=0. Repeatable")
+    parser.add_argument("--output", help="Result file. Defaults to loadtest-<time>.json")
+    parser.add_argument("--compare", metavar="RESULTS", help="Earlier result file to compare with")
+    args = parser.parse_args()
+
+    fake = start_server(latency=args.latency, token_rate=args.token_rate, reply_tokens=args.reply_tokens)
+    # Hashed once, seeding thousands of users with their own hash would take minutes
+    password_hash = generate_password_hash(PASSWORD)
+    results = []
+    for users in (int(scale) for scale in args.scales.split(",")):
+        result = run_scale(args, users, password_hash, fake)
+        print_result(result)
+        results.append(result)
+    fake.shutdown()
+
+    output = args.output or f"loadtest-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as f:
+        json.dump({"created_at": datetime.now(timezone.utc).isoformat(), "commit": git_commit(),
+                   "config": vars(args), "results": results}, f, indent=2)
+    print(f"\nSaved results to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
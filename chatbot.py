@@ -1,13 +1,19 @@
 import argparse
+import json
 import logging
 import os
 import readline
 import sys
 
-from cs50 import SQL
-from mistralai.client import MistralClient
 from mistralai.models.chat_completion import ChatMessage
 
+from batch import BatchRunner, DEFAULT_CONCURRENCY
+from context import CHARS_PER_TOKEN, ContextWindow
+from logs import Payload, configure_logging
+from metrics import StreamTimer
+from resilient import StreamInterrupted, open_client
+from response_cache import replay
+
 MODEL_LIST = [
     # Apache2
     "open-mistral-7b",
@@ -22,6 +28,17 @@ MODEL_LIST = [
     # MNPL
     "codestral-latest",
 ]
+# Context window of each model in tokens
+MODEL_CONTEXT_WINDOWS = {
+    "open-mistral-7b": 32000,
+    "open-mixtral-8x7b": 32000,
+    "open-mixtral-8x22b": 64000,
+    "mistral-small-latest": 32000,
+    "mistral-medium-latest": 32000,
+    "mistral-large-latest": 32000,
+    "codestral-latest": 32000,
+}
+DEFAULT_CONTEXT_WINDOW = 32000
 DEFAULT_MODEL = "open-mistral-7b"
 DEFAULT_TEMPERATURE = 0.7
 LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
@@ -37,12 +54,8 @@ COMMAND_LIST = {
     "/exit": {},
 }
 
-LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
-
 logger = logging.getLogger("chatbot")
 
-db = SQL("sqlite:///chat.db")
-
 
 def find_completions(command_dict, parts):
     if not parts:
@@ -71,15 +84,29 @@ readline.parse_and_bind("tab: complete")
 
 
 class ChatBot:
-    def __init__(self, api_key, model, system_message=None, temperature=DEFAULT_TEMPERATURE):
-        if not api_key:
+    def __init__(self, api_key, model, system_message=None, temperature=DEFAULT_TEMPERATURE, client=None, cache=None,
+                 semantic_cache=None, router=None):
+        if not api_key and client is None:
             raise ValueError("An API key must be provided to use the Mistral API.")
-        self.client = MistralClient(api_key=api_key)
+        # A client may be shared between bots so that they reuse one HTTP connection pool
+        self.client = client or open_client(api_key)
+        # Optional CompletionCache and SemanticCache shared between bots
+        self.cache = cache
+        self.semantic_cache = semantic_cache
+        # Optional ModelRouter, self.model is then only the preferred model and each turn may use another
+        self.router = router
         self.model = model
+        self.turn_model = model
+        # Estimated model tokens the last turn used, prompt and reply, for rate limiting
+        self.turn_tokens = 0
         self.temperature = temperature
         self.system_message = system_message
         self.messages = []
         self.message_list = []
+        self.context = ContextWindow()
+        # Rolling summary of self.messages[:summary_covers], kept up to date by the summarizer
+        self.summary = None
+        self.summary_covers = 0
         if self.system_message:
             self.messages.append(ChatMessage(role="system", content=self.system_message))
             self.message_list.append({"role": "system", "message_text": self.system_message})
@@ -105,6 +132,8 @@ To see this help: /help
         print("")
         self.messages = []
         self.message_list = []
+        self.summary = None
+        self.summary_covers = 0
         if self.system_message:
             self.messages.append(ChatMessage(role="system", content=self.system_message))
             self.message_list.append({"role": "system", "message_text": self.system_message})
@@ -113,18 +142,18 @@ To see this help: /help
         model = self.get_arguments(input)
         if model in MODEL_LIST:
             self.model = model
-            logger.info(f"Switching model: {model}")
+            logger.info("Switching model: %s", model)
         else:
-            logger.error(f"Invalid model name: {model}")
+            logger.error("Invalid model name: %s", model)
 
     def switch_system_message(self, input):
         system_message = self.get_arguments(input)
         if system_message:
             self.system_message = system_message
-            logger.info(f"Switching system message: {system_message}")
+            logger.info("Switching system message: %s", system_message)
             self.new_chat()
         else:
-            logger.error(f"Invalid system message: {system_message}")
+            logger.error("Invalid system message: %s", system_message)
 
     def switch_temperature(self, input):
         temperature = self.get_arguments(input)
@@ -133,9 +162,9 @@ To see this help: /help
             if temperature < 0 or temperature > 1:
                 raise ValueError
             self.temperature = temperature
-            logger.info(f"Switching temperature: {temperature}")
+            logger.info("Switching temperature: %s", temperature)
         except ValueError:
-            logger.error(f"Invalid temperature: {temperature}")
+            logger.error("Invalid temperature: %s", temperature)
 
     def show_config(self):
         print("")
@@ -153,22 +182,83 @@ To see this help: /help
         print("MISTRAL:")
         print("")
 
-        self.messages.append(ChatMessage(role="user", content=content))
-        self.message_list.append({"role": "user", "message_text": content})
+        for response in self.stream_inference(content):
+            print(response, end="", flush=True)
+        print("", flush=True)
+
+    def stream_inference(self, content):
+        """Yield the assistant's reply chunk by chunk, recording both turns once the stream ends."""
+        messages = self.begin_turn(content)
+        model = self.turn_model
+        use_cache = self.cache is not None and self.cache.applies(self.temperature)
+        # Similar prompts only share an answer when there is no earlier exchange they could depend on
+        use_semantic_cache = self.semantic_cache is not None and all(
+            message.role == "system" for message in self.messages[:-1])
+
+        cached = None
+        if use_cache:
+            cached = self.cache.get(model, self.temperature, messages)
+        if cached is None and use_semantic_cache:
+            cached = self.semantic_cache.lookup(model, self.system_message, content)
+        if cached is not None:
+            logger.debug("Replaying cached response")
+            yield from replay(cached)
+            self.end_turn(cached)
+            # Nothing was sent upstream
+            self.turn_tokens = 0
+            return
 
         assistant_response = ""
-        logger.debug(f"Running inference with model: {self.model}, temperature: {self.temperature}")
-        logger.debug(f"Sending messages: {self.messages}")
-        for chunk in self.client.chat_stream(model=self.model, temperature=self.temperature, messages=self.messages):
-            response = chunk.choices[0].delta.content
-            if response is not None:
-                print(response, end="", flush=True)
-                assistant_response += response
-        print("", flush=True)
+        timer = StreamTimer(model)
+        try:
+            for chunk in self.client.chat_stream(model=model, temperature=self.temperature, messages=messages):
+                first_token = timer.chunk()
+                if first_token is not None and self.router is not None:
+                    self.router.observe(model, first_token)
+                response = chunk.choices[0].delta.content
+                if response is not None:
+                    assistant_response += response
+                    yield response
+        except StreamInterrupted as e:
+            # Keep the part of the reply that did arrive, but never cache it
+            self.end_turn(e.partial)
+            raise
+        timer.finish(assistant_response)
+
+        if use_cache:
+            self.cache.put(model, self.temperature, messages, assistant_response)
+        if use_semantic_cache:
+            self.semantic_cache.add(model, self.system_message, content, assistant_response)
+        self.end_turn(assistant_response)
+
+    def begin_turn(self, content):
+        """Record the user's message and return the messages to send upstream."""
+        self.messages.append(ChatMessage(role="user", content=content))
+        self.message_list.append({"role": "user", "message_text": content})
 
+        history = self.messages
+        if self.summary:
+            # Summarized turns are replaced by the summary, their system messages still apply
+            history = [message for message in self.messages[:self.summary_covers] if message.role == "system"]
+            history += self.messages[self.summary_covers:]
+        self.turn_model = self.model
+        if self.router is not None:
+            self.turn_model = self.router.choose(self.context.total(history) + self.context.reserve,
+                                                 preferred=self.model)
+        # Older turns are left out once the conversation outgrows the model's context window
+        messages = self.context.fit(history, MODEL_CONTEXT_WINDOWS.get(self.turn_model, DEFAULT_CONTEXT_WINDOW),
+                                    summary=self.summary)
+        self.turn_tokens = self.context.total(messages)
+        logger.debug("Running inference with model: %s, temperature: %s", self.turn_model, self.temperature)
+        logger.debug("Sending %d of %d messages: %s", len(messages), len(self.messages), Payload(messages))
+        return messages
+
+    def end_turn(self, assistant_response):
+        """Record the assistant's completed reply."""
         if assistant_response:
             self.messages.append(ChatMessage(role="assistant", content=assistant_response))
             self.message_list.append({"role": "assistant", "message_text": assistant_response})
+            self.turn_tokens += (len(assistant_response) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
             # last_chat = db.execute("SELECT * FROM Chats ORDER BY created_at DESC LIMIT 1")
             # if not last_chat:
             #     db.execute("INSERT INTO Chats (chat_name, user_id) VALUES (?, ?)", "New Chat", 1)
@@ -179,7 +269,7 @@ To see this help: /help
             #     db.execute("INSERT INTO Messages (chat_id, user_id, message_text) VALUES (?, ?, ?)", last_chat_id[0]["chat_id"], 1,
             #                self.messages)
 
-        logger.debug(f"Current messages: {self.messages}")
+        logger.debug("Current messages: %s", Payload(self.messages))
 
     def get_command(self, input):
         return input.split()[0].strip()
@@ -252,27 +342,37 @@ if __name__ == "__main__":
         help="Optional temperature for chat inference. Defaults to %(default)s",
     )
     parser.add_argument("-d", "--debug", action="store_true", help="Enable debug logging")
+    parser.add_argument("--batch", metavar="INPUT", help="Answer every prompt of a JSONL file instead of chatting.")
+    parser.add_argument("--output", metavar="OUTPUT",
+                        help="JSONL file results are appended to in batch mode. Defaults to INPUT.out.jsonl; "
+                             "ids it already answers are skipped, so an interrupted run can be restarted.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Requests in flight at once in batch mode. Defaults to %(default)s")
+    parser.add_argument("--id-field", default="id", help="Field holding each prompt's id. Defaults to %(default)s")
+    parser.add_argument("--prompt-field", default="prompt",
+                        help="Field holding each prompt, unless the line has a messages list. Defaults to %(default)s")
 
     args = parser.parse_args()
 
-    if args.debug:
-        logger.setLevel(logging.DEBUG)
-    else:
-        logger.setLevel(logging.INFO)
-
-    formatter = logging.Formatter(LOG_FORMAT)
-
-    ch = logging.StreamHandler()
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    # Only the chatbot's own loggers are chatty, third-party ones stay at warnings
+    configure_logging(level=logging.WARNING, levels={"chatbot": logging.DEBUG if args.debug else logging.INFO},
+                      text_format=LOG_FORMAT)
 
     logger.debug(
-        f"Starting chatbot with model: {args.model}, "
-        f"temperature: {args.temperature}, "
-        f"system message: {args.system_message}"
+        "Starting chatbot with model: %s, temperature: %s, system message: %s",
+        args.model, args.temperature, args.system_message,
     )
 
     try:
+        if args.batch:
+            if not args.api_key:
+                raise ValueError("An API key must be provided to use the Mistral API.")
+            runner = BatchRunner(open_client(args.api_key), args.model, args.temperature,
+                                 system_message=args.system_message, concurrency=args.concurrency,
+                                 id_field=args.id_field, prompt_field=args.prompt_field)
+            stats = runner.run(args.batch, args.output or f"{os.path.splitext(args.batch)[0]}.out.jsonl")
+            print(json.dumps(stats, indent=2))
+            sys.exit(1 if stats["failed"] else 0)
         bot = ChatBot(args.api_key, args.model, args.system_message, args.temperature)
         bot.start()
     except Exception as e:
@@ -0,0 +1,71 @@
+from mistralai.models.chat_completion import ChatMessage
+
+# Rough English average for Mistral's tokenizer, close enough to budget requests
+CHARS_PER_TOKEN = 4
+# Role markers and separators the chat template adds around each message
+MESSAGE_OVERHEAD = 4
+# Tokens kept free for the model's reply
+DEFAULT_RESPONSE_RESERVE = 1024
+
+
+def estimate_tokens(message):
+    return MESSAGE_OVERHEAD + (len(message.content or "") + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+class ContextWindow:
+    """
+    Choose which messages of a conversation fit into a model's context window.
+
+    Token counts are estimated once per message and cached, so each turn only
+    counts the messages that are new since the previous one.
+    """
+
+    def __init__(self, reserve=DEFAULT_RESPONSE_RESERVE):
+        self.reserve = reserve
+        self._counts = {}
+
+    def count(self, message):
+        cached = self._counts.get(id(message))
+        if cached is not None and cached[0] is message:
+            return cached[1]
+        tokens = estimate_tokens(message)
+        self._counts[id(message)] = (message, tokens)
+        return tokens
+
+    def total(self, messages):
+        return sum(self.count(message) for message in messages)
+
+    def fit(self, messages, budget, summary=None):
+        """
+        Return the system messages plus as many of the newest other messages as fit in budget.
+
+        A summary of earlier turns, when given, is sent as a system message after
+        the conversation's own. The latest message is always kept, even when it
+        alone exceeds the budget.
+        """
+        # Drop cache entries for messages that are no longer part of the conversation
+        counts = {}
+        for message in messages:
+            counts[id(message)] = (message, self.count(message))
+        self._counts = counts
+
+        available = budget - self.reserve
+        system = [message for message in messages if message.role == "system"]
+        if summary:
+            system.append(ChatMessage(role="system", content=f"Summary of the earlier conversation: {summary}"))
+        available -= sum(self.count(message) for message in system)
+
+        tail = []
+        for message in reversed(messages):
+            if message.role == "system":
+                continue
+            tokens = counts[id(message)][1]
+            if tail and tokens > available:
+                break
+            tail.append(message)
+            available -= tokens
+        tail.reverse()
+        # Start the kept history on a user turn rather than half-way through an exchange
+        while len(tail) > 1 and tail[0].role == "assistant":
+            tail.pop(0)
+        return system + tail
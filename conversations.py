@@ -0,0 +1,141 @@
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+DEFAULT_MAX_CONVERSATIONS = 1024
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class Conversation:
+    """A live ChatBot together with the lock that serializes access to it."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.lock = threading.RLock()
+        # Set once the chat history has been read from the database
+        self.loaded = False
+        # High-water mark: bot.messages[:persisted] are stored, last_message_id is the newest stored row
+        self.persisted = 0
+        self.last_message_id = 0
+        # bot.messages[:queued] are stored or waiting in the write-behind queue
+        self.queued = 0
+        # message_id of each stored message, in the same order as bot.messages
+        self.message_ids = []
+        # The message list the marks above count in, commands such as /new replace bot.messages with a new one
+        self.marked_messages = bot.messages
+        # Guards the marks above, which the write-behind thread moves without holding the conversation
+        self.marks_lock = threading.Lock()
+        self.nbytes = 0
+
+    def follow_messages(self):
+        """Start the marks over when bot.messages was replaced, all of its messages are new. Needs marks_lock held."""
+        if self.marked_messages is not self.bot.messages:
+            self.marked_messages = self.bot.messages
+            self.persisted = self.queued = 0
+            self.message_ids = []
+
+    def measure(self):
+        self.nbytes = sum(len(message.content or "") for message in self.bot.messages)
+        return self.nbytes
+
+
+class ConversationStore:
+    """
+    Keep hot conversations resident, keyed by (user_id, chat_id).
+
+    Conversations are evicted least recently used first once either the
+    number of conversations or the total size of their messages exceeds
+    the configured limits. Evicted conversations are simply reloaded from
+    the database the next time they are opened.
+    """
+
+    def __init__(self, factory, max_conversations=DEFAULT_MAX_CONVERSATIONS, max_bytes=DEFAULT_MAX_BYTES):
+        self.factory = factory
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._conversations = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        # Kept apart from the conversations, so evicting one while a turn is in progress never splits its lock
+        self._turn_locks = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self._conversations)
+
+    def get(self, user_id, chat_id):
+        key = (user_id, chat_id)
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is not None:
+                self._conversations.move_to_end(key)
+                self.hits += 1
+                return conversation
+            self.misses += 1
+            conversation = Conversation(self.factory())
+            self._conversations[key] = conversation
+            self._evict()
+            return conversation
+
+    def turn_lock(self, user_id, chat_id):
+        """
+        The lock held from a chat's user message until its reply is stored, so turns on one chat never
+        interleave. Take it before checking the conversation out.
+        """
+        with self._lock:
+            lock = self._turn_locks.get((user_id, chat_id))
+            if lock is None:
+                lock = self._turn_locks[(user_id, chat_id)] = threading.Lock()
+            return lock
+
+    @contextmanager
+    def checkout(self, user_id, chat_id):
+        """Yield the conversation for exclusive use and re-account its size afterwards."""
+        conversation = self.get(user_id, chat_id)
+        with conversation.lock:
+            try:
+                yield conversation
+            finally:
+                self._resize((user_id, chat_id), conversation)
+
+    def discard(self, user_id, chat_id):
+        with self._lock:
+            conversation = self._conversations.pop((user_id, chat_id), None)
+            if conversation is not None:
+                self._nbytes -= conversation.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._conversations.clear()
+            self._nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "conversations": len(self._conversations),
+                "bytes": self._nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _resize(self, key, conversation):
+        with self._lock:
+            before = conversation.nbytes
+            after = conversation.measure()
+            if self._conversations.get(key) is conversation:
+                self._nbytes += after - before
+                self._evict()
+
+    def _evict(self):
+        # Called with self._lock held; the most recently used entry is never evicted
+        while len(self._conversations) > 1 and (
+                len(self._conversations) > self.max_conversations or self._nbytes > self.max_bytes):
+            _, conversation = self._conversations.popitem(last=False)
+            self._nbytes -= conversation.nbytes
+        if self.max_conversations <= 0 and self._conversations:
+            _, conversation = self._conversations.popitem(last=False)
+            self._nbytes -= conversation.nbytes
@@ -1,6 +1,5 @@
 import csv
 import datetime
-import sqlite3
 
 import pytz
 import requests
@@ -12,6 +11,9 @@ from functools import wraps
 
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from metrics import PASSWORD_HASH_SECONDS
+from repositories import DuplicateUserError
+
 
 # from google.auth.transport import requests as google_requests
 # from google.oauth2 import id_token
@@ -127,14 +129,18 @@ def login_via_form(db, request):
     password = request.form.get("password")
 
     # Query database for username
-    rows = db.execute("SELECT * FROM users WHERE username = ?", username)
+    user = db.get_user_by_username(username)
 
     # Ensure username exists and password is correct
-    if len(rows) != 1 or not check_password_hash(rows[0]["password_hash"], password):
+    if user is None:
+        return apology("invalid username and/or password", 403)
+    with PASSWORD_HASH_SECONDS.time(operation="check"):
+        valid = check_password_hash(user["password_hash"], password)
+    if not valid:
         return apology("invalid username and/or password", 403)
 
     # Remember which user has logged in
-    session["user_id"] = rows[0]["user_id"]
+    session["user_id"] = user["user_id"]
 
     # Redirect user to home page
     return redirect("/")
@@ -186,11 +192,12 @@ def register_via_form(db, request):
         return apology("Password Must Contain a special Character", 400)
     elif not any(c.isalnum() for c in password):
         return apology("Password must contain letters and numbers", 400)
-    password_hash = generate_password_hash(password)
+    with PASSWORD_HASH_SECONDS.time(operation="generate"):
+        password_hash = generate_password_hash(password)
     try:
         # Add username to the database
-        db.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", username, password_hash)
-    except sqlite3.IntegrityError:
+        db.create_user(username, password_hash)
+    except DuplicateUserError:
         return apology("Username or account already exists", 400)
     except Exception as e:
         return apology("Failed to register user: " + str(e), 400)
@@ -332,58 +339,6 @@ def register_via_form(db, request):
 #         return apology("Google token validation failed: " + str(e), 403)
 
 
-# Function to create tables if they don't exist
-def create_tables_if_not_exist(db):
-    # SQL statements for table creation
-
-    sql_queries = [
-        """CREATE TABLE IF NOT EXISTS Users (
-               user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-               username VARCHAR(50) UNIQUE,
-               email VARCHAR(100) UNIQUE,
-               password_hash VARCHAR(100),
-               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-           );""",
-
-        """CREATE TABLE IF NOT EXISTS Chats (
-               chat_id INTEGER PRIMARY KEY AUTOINCREMENT,
-               chat_name VARCHAR(100),
-               user_id INTEGER,
-               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-               FOREIGN KEY (user_id) REFERENCES Users (user_id)
-           );""",
-
-        """CREATE TABLE IF NOT EXISTS Messages (
-               message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-               chat_id INTEGER,
-               user_id INTEGER,
-               message_text TEXT,
-               role TEXT,
-               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-               FOREIGN KEY (chat_id) REFERENCES Chats (chat_id),
-               FOREIGN KEY (user_id) REFERENCES Users (user_id)
-           );"""
-    ]
-
-    try:
-        # Connect to SQLite database
-        conn = sqlite3.connect("sqlite:///chat.db")
-        cursor = conn.cursor()
-
-        # Execute each SQL statement
-        for query in sql_queries:
-            cursor.execute(query)
-
-        # Commit changes and close connection
-        conn.commit()
-        conn.close()
-
-        print("Tables created successfully!")
-
-    except sqlite3.Error as e:
-        print(f"Error creating tables: {e}")
-
-
 def index_helper(user_id):
 
     if user_id:
@@ -0,0 +1,166 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+DEFAULT_LEVEL = "INFO"
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
+# Longest log message kept, the rest is cut off
+DEFAULT_MAX_LENGTH = 2000
+# Characters of each chat message shown when payloads are logged
+PAYLOAD_PREVIEW = 80
+# Records queued for the writer thread before new ones are dropped rather than block a request
+QUEUE_SIZE = 10000
+
+# Attributes every LogRecord has, anything else was passed through extra= and is logged as a field
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+_settings = {"payloads": False}
+_traceback_formatter = logging.Formatter()
+_listener = None
+
+
+def parse_levels(value):
+    """Parse "logger=LEVEL,..." into a dictionary of logger names and levels."""
+    levels = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+class Payload:
+    """
+    Chat messages to log, rendered only if the record is actually emitted.
+
+    Message contents are redacted to their role and length unless payload
+    logging is switched on, and then each is cut to a short preview.
+    """
+
+    __slots__ = ("messages",)
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def __str__(self):
+        parts = []
+        for message in self.messages:
+            content = message.content or ""
+            if _settings["payloads"]:
+                preview = content[:PAYLOAD_PREVIEW] + ("…" if len(content) > PAYLOAD_PREVIEW else "")
+                parts.append(f"{message.role}: {preview!r}")
+            else:
+                parts.append(f"{message.role}: <{len(content)} chars>")
+        return "[" + ", ".join(parts) + "]"
+
+
+class SamplingFilter(logging.Filter):
+    """Let through only a fraction of DEBUG records, everything above DEBUG always passes."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with any extra= fields alongside the standard ones."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Hand records to a background writer thread without ever blocking the caller.
+
+    The message is formatted here, so arguments are rendered while they are still
+    current, and cut to max_length. A full queue drops the record.
+    """
+
+    def __init__(self, log_queue, max_length=DEFAULT_MAX_LENGTH):
+        super().__init__(log_queue)
+        self.max_length = max_length
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        message = record.getMessage()
+        if len(message) > self.max_length:
+            message = message[:self.max_length] + f"… ({len(message) - self.max_length} more chars)"
+        record.msg = record.message = message
+        record.args = None
+        # Tracebacks are rendered now, while the frames still exist, and never cut
+        if record.exc_info:
+            record.exc_text = _traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging(level=DEFAULT_LEVEL, levels=None, json_format=False, text_format=TEXT_FORMAT,
+                      max_length=DEFAULT_MAX_LENGTH, debug_sample_rate=1.0, payloads=False, stream=None):
+    """
+    Send all logging through a queue to one writer thread.
+
+    level applies to the root logger and levels maps logger names such as
+    "chatbot.storage" or "werkzeug" to their own level. Calling it again
+    replaces the previous configuration.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(text_format))
+    log_queue = queue.Queue(QUEUE_SIZE)
+    queue_handler = BoundedQueueHandler(log_queue, max_length=max_length)
+    queue_handler.addFilter(SamplingFilter(debug_sample_rate))
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    for name, name_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(name_level)
+    _settings["payloads"] = payloads
+
+    _listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    return queue_handler
+
+
+@atexit.register
+def _flush():
+    """Write out whatever is still queued when the process exits."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,132 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+# Chats whose newest message is older than this many days are archived, 0 keeps every chat in Messages
+DEFAULT_ARCHIVE_AFTER_DAYS = 90
+# Chats archived per run at most, so one run never holds the database for long
+DEFAULT_MAX_CHATS = 500
+DEFAULT_INTERVAL = 6 * 60 * 60
+
+logger = logging.getLogger("chatbot.maintenance")
+
+
+def cutoff(days, now=None):
+    """The timestamp days ago, in the format SQLite's CURRENT_TIMESTAMP writes."""
+    now = now or datetime.now(timezone.utc)
+    return (now - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def run_maintenance(db, archive_after_days=DEFAULT_ARCHIVE_AFTER_DAYS, max_chats=DEFAULT_MAX_CHATS):
+    """
+    Archive idle chats, give free pages back to the file system and refresh the planner's
+    statistics, then return a report of what was done and how much space was reclaimed.
+    """
+    started = time.perf_counter()
+    report = {"archived_chats": 0, "archived_messages": 0}
+    if archive_after_days > 0:
+        for chat in db.idle_chats(cutoff(archive_after_days), max_chats):
+            moved = db.archive_chat(chat["chat_id"], chat["user_id"])
+            if moved:
+                report["archived_chats"] += 1
+                report["archived_messages"] += moved
+    # Pages freed by archiving, by deleted chats and by expired rows since the last run
+    before = db.storage_stats()
+    incremental = db.reclaim_space()
+    db.analyze()
+    after = db.storage_stats()
+    report.update(
+        reclaimed_bytes=(before["page_count"] - after["page_count"]) * after["page_size"],
+        file_bytes=after["page_count"] * after["page_size"],
+        free_bytes=after["freelist_count"] * after["page_size"],
+        seconds=time.perf_counter() - started,
+    )
+    logger.info("Archived %d chats (%d messages), reclaimed %d bytes in %.2fs", report["archived_chats"],
+                report["archived_messages"], report["reclaimed_bytes"], report["seconds"])
+    if not incremental and report["free_bytes"]:
+        logger.warning("%d free bytes can only be reclaimed by a full VACUUM, run python maintenance.py --vacuum "
+                       "once to switch the database to incremental vacuuming", report["free_bytes"])
+    return report
+
+
+class MaintenanceScheduler:
+    """Runs run_maintenance every interval seconds on a background thread."""
+
+    def __init__(self, db, interval=DEFAULT_INTERVAL, archive_after_days=DEFAULT_ARCHIVE_AFTER_DAYS,
+                 max_chats=DEFAULT_MAX_CHATS):
+        self.db = db
+        self.interval = interval
+        self.archive_after_days = archive_after_days
+        self.max_chats = max_chats
+        # Chats and messages archived and bytes reclaimed since the process started, for metrics
+        self.totals = Counter()
+        self.last_report = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run()
+
+    def run(self):
+        try:
+            report = run_maintenance(self.db, self.archive_after_days, self.max_chats)
+        except Exception:
+            logger.exception("Database maintenance failed")
+            return None
+        for key in ("archived_chats", "archived_messages", "reclaimed_bytes"):
+            self.totals[key] += report[key]
+        self.last_report = report
+        return report
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+def open_scheduler(db, interval=DEFAULT_INTERVAL, archive_after_days=DEFAULT_ARCHIVE_AFTER_DAYS,
+                   max_chats=DEFAULT_MAX_CHATS):
+    """Start a MaintenanceScheduler for the repository, or return None when interval is not above zero."""
+    if interval <= 0:
+        return None
+    return MaintenanceScheduler(db, interval=interval, archive_after_days=archive_after_days,
+                                max_chats=max_chats).start()
+
+
+if __name__ == "__main__":
+    from repositories import open_repository
+
+    parser = argparse.ArgumentParser(description="Archive idle chats and reclaim space in the chat database")
+    parser.add_argument("database", nargs="?", default=os.environ.get("DATABASE", "chat.db"),
+                        help="SQLite database file or postgresql:// URL. Defaults to %(default)s")
+    parser.add_argument("--archive-after", type=float, default=DEFAULT_ARCHIVE_AFTER_DAYS, metavar="DAYS",
+                        help="Archive chats idle for this many days, 0 archives nothing. Defaults to %(default)s")
+    parser.add_argument("--max-chats", type=int, default=DEFAULT_MAX_CHATS,
+                        help="Chats archived at most. Defaults to %(default)s")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="Rebuild the whole database first, which blocks the app while it runs, and switch a "
+                             "SQLite file to incremental vacuuming")
+    args = parser.parse_args()
+
+    repository = open_repository(args.database)
+    try:
+        if args.vacuum:
+            stats = repository.storage_stats()
+            repository.vacuum()
+            after = repository.storage_stats()
+            print(f"VACUUM reclaimed {(stats['page_count'] - after['page_count']) * after['page_size']} bytes")
+        print(json.dumps(run_maintenance(repository, args.archive_after, args.max_chats), indent=2))
+    finally:
+        repository.close()
@@ -0,0 +1,225 @@
+import bisect
+import threading
+import time
+from contextlib import ContextDecorator
+
+from context import CHARS_PER_TOKEN
+
+# Default histogram buckets in seconds, from a cached SQLite read up to a long completion
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A named family of samples, one per combination of label values."""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        """Yield (suffix, label values, extra label, value) for the exposition format."""
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield "", key, "", value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labels, key, extra)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def track(self, **labels):
+        """Context manager and decorator that counts the calls in progress."""
+        return _InProgress(self, labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS, registry=None):
+        super().__init__(name, documentation, labels, registry)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts, then the sum of observed values
+                state = self._values[key] = [0] * len(self.buckets) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def time(self, **labels):
+        """Context manager and decorator that observes the seconds spent inside it."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(state)) for key, state in self._values.items()]
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                yield "_bucket", key, f'le="{format_value(bound)}"', cumulative
+            yield "_sum", key, "", state[-1]
+            yield "_count", key, "", cumulative
+
+
+class CallbackMetric(Metric):
+    """Samples read from elsewhere at scrape time, for counters that already exist such as cache hits."""
+
+    def __init__(self, name, documentation, kind, labels, collect, registry=None):
+        super().__init__(name, documentation, labels, registry)
+        self.kind = kind
+        # Returns a dictionary of label value tuples to values
+        self.collect = collect
+
+    def samples(self):
+        for key, value in self.collect().items():
+            yield "", key, "", value
+
+
+class _Timer(ContextDecorator):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class _InProgress(ContextDecorator):
+    def __init__(self, gauge, labels):
+        self.gauge = gauge
+        self.labels = labels
+
+    def __enter__(self):
+        self.gauge.inc(**self.labels)
+        return self
+
+    def __exit__(self, *exc):
+        self.gauge.dec(**self.labels)
+        return False
+
+
+class StreamTimer:
+    """Records the time to first token and the streaming rate of one completion."""
+
+    def __init__(self, model):
+        self.model = model
+        self.started = time.perf_counter()
+        self.first_chunk = None
+
+    def chunk(self):
+        """Call for every chunk received. Returns the time to first token on the first one, None after."""
+        if self.first_chunk is not None:
+            return None
+        self.first_chunk = time.perf_counter()
+        seconds = self.first_chunk - self.started
+        TIME_TO_FIRST_TOKEN_SECONDS.observe(seconds, model=self.model)
+        return seconds
+
+    def finish(self, text):
+        if self.first_chunk is None or not text:
+            return
+        elapsed = time.perf_counter() - self.first_chunk
+        if elapsed > 0:
+            TOKENS_PER_SECOND.observe(len(text) / CHARS_PER_TOKEN / elapsed, model=self.model)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric already registered: {metric.name}")
+            self._metrics[metric.name] = metric
+
+    def unregister(self, name):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = Histogram("chatbot_request_seconds", "Time to handle a request, by route.",
+                            ("method", "route", "status"))
+DB_QUERY_SECONDS = Histogram("chatbot_db_query_seconds", "Time to run a database statement.", ("statement",))
+TIME_TO_FIRST_TOKEN_SECONDS = Histogram("chatbot_time_to_first_token_seconds",
+                                        "Time from sending a completion request to its first chunk.", ("model",))
+TOKENS_PER_SECOND = Histogram("chatbot_tokens_per_second", "Estimated completion tokens streamed per second.",
+                              ("model",), buckets=THROUGHPUT_BUCKETS)
+PASSWORD_HASH_SECONDS = Histogram("chatbot_password_hash_seconds", "Time to hash or check a password.",
+                                  ("operation",))
+ACTIVE_STREAMS = Gauge("chatbot_active_streams", "Chat replies being streamed right now.")
+ACTIVE_STREAMS.set(0)
@@ -0,0 +1,193 @@
+import logging
+import sqlite3
+
+logger = logging.getLogger("chatbot.migrations")
+
+# Ordered schema steps, each applied once and recorded in SchemaVersion.
+# Every statement must also be safe to run against a database that predates the runner.
+MIGRATIONS = [
+    (1, "create tables", [
+        """CREATE TABLE IF NOT EXISTS Users (
+               user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+               username VARCHAR(50) UNIQUE,
+               email VARCHAR(100) UNIQUE,
+               password_hash VARCHAR(100),
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           );""",
+
+        """CREATE TABLE IF NOT EXISTS Chats (
+               chat_id INTEGER PRIMARY KEY AUTOINCREMENT,
+               chat_name VARCHAR(100),
+               user_id INTEGER,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               FOREIGN KEY (user_id) REFERENCES Users (user_id)
+           );""",
+
+        """CREATE TABLE IF NOT EXISTS Messages (
+               message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+               chat_id INTEGER,
+               user_id INTEGER,
+               message_text TEXT,
+               role TEXT,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               FOREIGN KEY (chat_id) REFERENCES Chats (chat_id),
+               FOREIGN KEY (user_id) REFERENCES Users (user_id)
+           );""",
+    ]),
+
+    # SQLite cannot alter a foreign key, so both tables are rebuilt and renamed into place
+    (2, "cascade deletes from users and chats", [
+        """CREATE TABLE Chats_new (
+               chat_id INTEGER PRIMARY KEY AUTOINCREMENT,
+               chat_name VARCHAR(100),
+               user_id INTEGER,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               FOREIGN KEY (user_id) REFERENCES Users (user_id) ON DELETE CASCADE
+           );""",
+        """INSERT INTO Chats_new (chat_id, chat_name, user_id, created_at)
+           SELECT chat_id, chat_name, user_id, created_at FROM Chats;""",
+
+        """CREATE TABLE Messages_new (
+               message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+               chat_id INTEGER,
+               user_id INTEGER,
+               message_text TEXT,
+               role TEXT,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               FOREIGN KEY (chat_id) REFERENCES Chats (chat_id) ON DELETE CASCADE,
+               FOREIGN KEY (user_id) REFERENCES Users (user_id) ON DELETE CASCADE
+           );""",
+        """INSERT INTO Messages_new (message_id, chat_id, user_id, message_text, role, created_at)
+           SELECT message_id, chat_id, user_id, message_text, role, created_at FROM Messages;""",
+
+        # Keep AUTOINCREMENT from reusing ids of rows deleted before the rebuild
+        """UPDATE sqlite_sequence SET seq = (SELECT seq FROM sqlite_sequence WHERE name = 'Chats')
+           WHERE name = 'Chats_new' AND EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'Chats');""",
+        """UPDATE sqlite_sequence SET seq = (SELECT seq FROM sqlite_sequence WHERE name = 'Messages')
+           WHERE name = 'Messages_new' AND EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'Messages');""",
+
+        "DROP TABLE Messages;",
+        "DROP TABLE Chats;",
+        "ALTER TABLE Chats_new RENAME TO Chats;",
+        "ALTER TABLE Messages_new RENAME TO Messages;",
+    ]),
+
+    (3, "index chat lists and message history", [
+        "CREATE INDEX IF NOT EXISTS idx_chats_user_created ON Chats (user_id, created_at);",
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_message ON Messages (chat_id, message_id);",
+        # Lets cascading deletes of a user find their messages without a scan
+        "CREATE INDEX IF NOT EXISTS idx_messages_user ON Messages (user_id);",
+    ]),
+
+    (4, "rolling chat summaries", [
+        """CREATE TABLE IF NOT EXISTS Summaries (
+               chat_id INTEGER PRIMARY KEY,
+               user_id INTEGER,
+               summary TEXT,
+               through_message_id INTEGER,
+               updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               FOREIGN KEY (chat_id) REFERENCES Chats (chat_id) ON DELETE CASCADE,
+               FOREIGN KEY (user_id) REFERENCES Users (user_id) ON DELETE CASCADE
+           );""",
+    ]),
+
+    # External-content index over Messages kept in sync by triggers and filled from the rows already stored, so the
+    # delete trigger never removes an entry that was not indexed. user_id is indexed too so queries are scoped to a
+    # user by the index itself.
+    (5, "full-text search over messages", [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS MessagesSearch USING fts5(
+               message_text,
+               user_id,
+               content='Messages',
+               content_rowid='message_id',
+               tokenize='unicode61 remove_diacritics 2'
+           );""",
+        """CREATE TRIGGER IF NOT EXISTS messages_search_insert AFTER INSERT ON Messages BEGIN
+               INSERT INTO MessagesSearch (rowid, message_text, user_id)
+               VALUES (new.message_id, new.message_text, new.user_id);
+           END;""",
+        """CREATE TRIGGER IF NOT EXISTS messages_search_delete AFTER DELETE ON Messages BEGIN
+               INSERT INTO MessagesSearch (MessagesSearch, rowid, message_text, user_id)
+               VALUES ('delete', old.message_id, old.message_text, old.user_id);
+           END;""",
+        """CREATE TRIGGER IF NOT EXISTS messages_search_update AFTER UPDATE OF message_text, user_id ON Messages BEGIN
+               INSERT INTO MessagesSearch (MessagesSearch, rowid, message_text, user_id)
+               VALUES ('delete', old.message_id, old.message_text, old.user_id);
+               INSERT INTO MessagesSearch (rowid, message_text, user_id)
+               VALUES (new.message_id, new.message_text, new.user_id);
+           END;""",
+        "INSERT INTO MessagesSearch (MessagesSearch) VALUES ('rebuild');",
+    ]),
+
+    # Without statistics the planner would rather seek idx_messages_user and scan every chat of the user,
+    # one index on all three columns makes a page of a chat's history a single seek
+    (6, "index message history pages", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_user_message ON Messages (chat_id, user_id, message_id);",
+        "DROP INDEX IF EXISTS idx_messages_chat_message;",
+    ]),
+
+    # Messages of chats idle for a long time, moved out of Messages by maintenance.py as one compressed blob per chat
+    (7, "archived chats", [
+        """CREATE TABLE IF NOT EXISTS ArchivedChats (
+               chat_id INTEGER PRIMARY KEY,
+               user_id INTEGER,
+               message_count INTEGER,
+               messages BLOB,
+               archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               FOREIGN KEY (chat_id) REFERENCES Chats (chat_id) ON DELETE CASCADE,
+               FOREIGN KEY (user_id) REFERENCES Users (user_id) ON DELETE CASCADE
+           );""",
+    ]),
+
+    # Id of the write-behind turn a message starts, set on its first message only, so replaying the journal after
+    # a crash can tell a committed turn from a repeated one
+    (8, "write-behind turn ids", [
+        "ALTER TABLE Messages ADD COLUMN turn_id TEXT;",
+        "CREATE INDEX IF NOT EXISTS idx_messages_turn ON Messages (turn_id) WHERE turn_id IS NOT NULL;",
+    ]),
+]
+
+
+def schema_version(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS SchemaVersion (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT,
+                        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );""")
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM SchemaVersion").fetchone()[0]
+
+
+def migrate(path, migrations=MIGRATIONS):
+    """Bring the database at path up to the latest schema version and return that version."""
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        # Table rebuilds must not trigger cascades, foreign keys are checked once at the end instead
+        conn.execute("PRAGMA foreign_keys=OFF")
+        # Only takes effect on a new file: freed pages can then be given back without a full VACUUM
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        current = schema_version(conn)
+        for version, name, statements in migrations:
+            if version <= current:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Another process may have applied this step while we waited for the lock
+                if version <= schema_version(conn):
+                    conn.execute("COMMIT")
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute("INSERT INTO SchemaVersion (version, name) VALUES (?, ?)", (version, name))
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+            logger.info("Applied migration %d: %s", version, name)
+        current = schema_version(conn)
+
+        violations = conn.execute("PRAGMA foreign_key_check").fetchall()
+        if violations:
+            logger.warning("Found %d rows with dangling foreign keys", len(violations))
+        return current
+    finally:
+        conn.close()
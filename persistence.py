@@ -0,0 +1,85 @@
+import bisect
+import logging
+
+from mistralai.models.chat_completion import ChatMessage
+
+logger = logging.getLogger("chatbot.persistence")
+
+
+def load_history(db, conversation, chat_id, user_id, writer=None):
+    """
+    Read a chat's stored messages into a conversation the first time it is opened.
+
+    Returns False when the chat does not belong to the user, in which case
+    nothing is loaded and nothing will be persisted for the conversation.
+    """
+    if conversation.loaded:
+        return True
+    if user_id is None or not db.chat_exists(chat_id, user_id):
+        return False
+    if writer is not None:
+        # An evicted conversation may still have turns on their way to the database
+        writer.wait(chat_id, user_id)
+    rows = db.list_messages(chat_id, user_id)
+    bot = conversation.bot
+    # Turns taken before the history was loaded have not been stored yet
+    pending = bot.messages[conversation.persisted:]
+    bot.messages = [ChatMessage(role=row["role"], content=row["message_text"]) for row in rows] + pending
+    with conversation.marks_lock:
+        conversation.marked_messages = bot.messages
+        conversation.persisted = conversation.queued = len(rows)
+        conversation.message_ids = [row["message_id"] for row in rows]
+    conversation.last_message_id = conversation.message_ids[-1] if rows else 0
+
+    summary = db.get_summary(chat_id, user_id)
+    if summary:
+        bot.summary = summary["summary"]
+        bot.summary_covers = bisect.bisect_right(conversation.message_ids, summary["through_message_id"])
+    conversation.loaded = True
+    return True
+
+
+def persist_new_messages(db, conversation, chat_id, user_id, writer=None, on_stored=None):
+    """
+    Append the conversation's messages past its high-water mark and return how many were handed over.
+
+    Without a writer they are stored before this returns. With a WriteBehindQueue
+    they are stored in the background and the marks move once they are committed.
+    on_stored() is called after that either way.
+    """
+    if not conversation.loaded:
+        return 0
+    bot = conversation.bot
+    with conversation.marks_lock:
+        conversation.follow_messages()
+        start = conversation.queued
+        messages = bot.messages
+    pending = messages[start:]
+    if not pending:
+        return 0
+
+    def stored(message_ids):
+        with conversation.marks_lock:
+            # The list was replaced, or an earlier turn is missing, so the ids no longer line up with it
+            if bot.messages is not messages or conversation.persisted != start:
+                return
+            del conversation.message_ids[start:]
+            conversation.message_ids.extend(message_ids)
+            # Ids first, so a reader never sees a mark without its id
+            conversation.persisted = start + len(message_ids)
+            conversation.last_message_id = message_ids[-1]
+        logger.info("Inserted %d messages: chat_id: %s for user: %s", len(message_ids), chat_id, user_id)
+        if on_stored is not None:
+            on_stored()
+
+    # Name the chat after the latest user message
+    user_messages = [message.content for message in pending if message.role == "user"]
+    chat_name = user_messages[-1] if user_messages else None
+    if writer is None:
+        message_ids = db.append_messages(chat_id, user_id, pending, chat_name=chat_name)
+        conversation.queued += len(pending)
+        stored(message_ids)
+    else:
+        writer.submit(chat_id, user_id, pending, chat_name=chat_name, callback=stored)
+        conversation.queued += len(pending)
+    return len(pending)
@@ -0,0 +1,167 @@
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from storage import open_database
+
+DEFAULT_REQUESTS_PER_MINUTE = 20
+DEFAULT_REQUEST_BURST = 10
+DEFAULT_TOKENS_PER_MINUTE = 40000
+DEFAULT_TOKEN_BURST = 80000
+# Buckets the memory backend keeps, the least recently used beyond that start over full
+DEFAULT_MAX_KEYS = 100000
+# The SQLite backend drops buckets that have refilled completely once every this many checks
+EVICT_EVERY = 1000
+
+
+def refill(tokens, updated, now, rate, capacity):
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+
+def spend(tokens, cost, rate, strict):
+    """Return (tokens left, seconds to wait); a strict spend the bucket cannot cover takes nothing."""
+    if strict and tokens < cost:
+        return tokens, (cost - tokens) / rate
+    return tokens - cost, 0.0
+
+
+class MemoryBackend:
+    """Token buckets in a dictionary, for a single worker process."""
+
+    def __init__(self, max_keys=DEFAULT_MAX_KEYS, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, cost, rate, capacity, strict=True):
+        with self._lock:
+            now = self.clock()
+            entry = self._buckets.get(key)
+            tokens = capacity if entry is None else refill(entry[0], entry[1], now, rate, capacity)
+            tokens, wait = spend(tokens, cost, rate, strict)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBackend:
+    """Token buckets in an on-disk SQLite table, shared by every worker process on the host."""
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.db = open_database(path)
+        self._checks = 0
+        self.db.execute("""CREATE TABLE IF NOT EXISTS RateLimits (
+                               bucket_key TEXT PRIMARY KEY,
+                               tokens REAL,
+                               updated REAL,
+                               full_at REAL
+                           ) WITHOUT ROWID;""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_rate_limits_full_at ON RateLimits (full_at);")
+
+    def consume(self, key, cost, rate, capacity, strict=True):
+        # The transaction takes the write lock up front, so two workers never spend the same tokens
+        with self.db.transaction():
+            now = self.clock()
+            rows = self.db.execute("SELECT tokens, updated FROM RateLimits WHERE bucket_key = ?", key)
+            tokens = capacity if not rows else refill(rows[0]["tokens"], rows[0]["updated"], now, rate, capacity)
+            tokens, wait = spend(tokens, cost, rate, strict)
+            self.db.execute("INSERT OR REPLACE INTO RateLimits (bucket_key, tokens, updated, full_at) "
+                            "VALUES (?, ?, ?, ?)", key, tokens, now, now + (capacity - tokens) / rate)
+        self._checks += 1
+        if self._checks % EVICT_EVERY == 0:
+            self.evict()
+        return wait
+
+    def evict(self):
+        """Drop buckets that are full again, they behave exactly like ones never seen."""
+        self.db.execute("DELETE FROM RateLimits WHERE full_at < ?", self.clock())
+
+    def clear(self):
+        self.db.execute("DELETE FROM RateLimits")
+
+
+class RateLimiter:
+    """
+    Per-user and per-IP budgets for requests and for estimated model tokens.
+
+    Every request takes one token from the request buckets of its user and its IP
+    address. Model tokens are only known once the reply is done, so they are
+    charged afterwards with charge() and may leave the bucket in debt; a request
+    is refused while either of its token buckets is in debt.
+    """
+
+    def __init__(self, backend, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, request_burst=DEFAULT_REQUEST_BURST,
+                 tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE, token_burst=DEFAULT_TOKEN_BURST):
+        self.backend = backend
+        self.request_rate = requests_per_minute / 60
+        self.request_burst = request_burst
+        self.token_rate = tokens_per_minute / 60
+        self.token_burst = token_burst
+        # Refused requests per budget, for metrics
+        self.limited = Counter()
+
+    @staticmethod
+    def keys(user_id, ip):
+        keys = []
+        if user_id is not None:
+            keys.append(f"user:{user_id}")
+        if ip:
+            keys.append(f"ip:{ip}")
+        return keys
+
+    def check(self, user_id, ip):
+        """Admit one request: return 0 when it may go ahead, or the seconds to wait before retrying."""
+        keys = self.keys(user_id, ip)
+        for key in keys:
+            wait = self.backend.consume(f"tokens:{key}", 0, self.token_rate, self.token_burst)
+            if wait:
+                self.limited["tokens"] += 1
+                return wait
+        taken = []
+        for key in keys:
+            wait = self.backend.consume(f"requests:{key}", 1, self.request_rate, self.request_burst)
+            if wait:
+                # Give back what the other keys already paid for a request that is not going ahead
+                for other in taken:
+                    self.backend.consume(other, -1, self.request_rate, self.request_burst, strict=False)
+                self.limited["requests"] += 1
+                return wait
+            taken.append(f"requests:{key}")
+        return 0.0
+
+    def charge(self, user_id, ip, tokens):
+        """Charge the model tokens a request used to the user's and the IP's token budgets."""
+        if tokens <= 0:
+            return
+        for key in self.keys(user_id, ip):
+            self.backend.consume(f"tokens:{key}", tokens, self.token_rate, self.token_burst, strict=False)
+
+
+def retry_after(wait):
+    """Whole seconds for a Retry-After header, never less than one."""
+    return str(max(1, math.ceil(wait)))
+
+
+def open_limiter(kind, path, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, request_burst=DEFAULT_REQUEST_BURST,
+                 tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE, token_burst=DEFAULT_TOKEN_BURST):
+    """Build a RateLimiter for kind "memory" or "sqlite", or return None when rate limiting is off."""
+    if kind == "memory":
+        backend = MemoryBackend()
+    elif kind == "sqlite":
+        backend = SQLiteBackend(path)
+    elif not kind or kind == "off":
+        return None
+    else:
+        raise ValueError(f"Unknown rate limiter: {kind}")
+    return RateLimiter(backend, requests_per_minute=requests_per_minute, request_burst=request_burst,
+                       tokens_per_minute=tokens_per_minute, token_burst=token_burst)
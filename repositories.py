@@ -0,0 +1,975 @@
+import base64
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from metrics import DB_QUERY_SECONDS
+from migrations import migrate
+from response_cache import MemoryBackend
+from search import DEFAULT_LIMIT, MATCH_END, MATCH_START, SNIPPET_TOKENS, fts_query
+from storage import (DEFAULT_CHUNK_SIZE, DEFAULT_POOL_SIZE, DEFAULT_POOL_TIMEOUT, PoolTimeout, open_database,
+                     statement_name)
+
+try:
+    import psycopg2
+    import psycopg2.extras
+    import psycopg2.pool
+except ImportError:  # PostgreSQL support is optional
+    psycopg2 = None
+else:
+    class TimedCursor(psycopg2.extras.RealDictCursor):
+        """Dict cursor that records each statement's latency like storage.Database does for SQLite."""
+
+        def execute(self, query, vars=None):
+            # execute_values sends the whole multi-row statement as bytes, its start is enough to name it
+            name = statement_name(query[:200].decode("utf-8", "replace") if isinstance(query, bytes) else query)
+            with DB_QUERY_SECONDS.time(statement=name):
+                return super().execute(query, vars)
+
+# Seconds between attempts to take a PostgreSQL connection while every pooled one is in use
+POOL_RETRY_DELAY = 0.05
+# Rows per multi-row INSERT, four bound parameters each keeps well under SQLite's variable limit
+BATCH_SIZE = 200
+# Chats or messages returned per page, and the most a client may ask for
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# How long CachedRepository serves users and chat lists before reading them again, which bounds how stale
+# they can be when another worker process changed them
+DEFAULT_CACHE_TTL = 30
+DEFAULT_CACHE_ENTRIES = 10000
+
+# Every chat with its messages, one row per message and a single row with NULL message columns for an empty chat.
+# A user's chats come in the order of the (user_id, created_at) index, all chats in chat_id order, so neither is sorted
+EXPORT_COLUMNS = ("SELECT Chats.chat_id, Chats.user_id, Chats.chat_name, Chats.created_at AS chat_created_at, "
+                  "Messages.role, Messages.message_text, Messages.created_at ")
+EXPORT_FROM = "FROM Chats LEFT JOIN Messages ON Messages.chat_id = Chats.chat_id AND Messages.user_id = Chats.user_id "
+EXPORT_USER_ORDER = "ORDER BY Chats.created_at, Chats.chat_id, Messages.message_id"
+EXPORT_ALL_ORDER = "ORDER BY Chats.chat_id, Messages.message_id"
+# Archived chats come with their compressed messages, which are unpacked into rows as they are read
+ARCHIVED_EXPORT_SQL = (EXPORT_COLUMNS + ", ArchivedChats.messages AS archived " + EXPORT_FROM
+                       + "LEFT JOIN ArchivedChats ON ArchivedChats.chat_id = Chats.chat_id ")
+
+ARCHIVE_COMPRESSION_LEVEL = 6
+# Free pages handed back to the file system per incremental_vacuum step, writers get the lock in between
+VACUUM_PAGES = 1000
+# Rows ANALYZE samples per index, enough for the planner at a fraction of the cost of reading every row
+ANALYSIS_LIMIT = 1000
+# PRAGMA auto_vacuum value of a file whose free pages can be given back with incremental_vacuum
+INCREMENTAL_AUTO_VACUUM = 2
+
+
+class DuplicateUserError(ValueError):
+    """Raised when registering a username that is already taken."""
+
+
+def encode_cursor(created_at, chat_id):
+    """Opaque cursor pointing just past a chat in the newest-first chat list."""
+    payload = json.dumps([str(created_at), chat_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor, raises ValueError for a cursor this module did not produce."""
+    try:
+        created_at, chat_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(created_at, str) or not isinstance(chat_id, int):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return created_at, chat_id
+
+
+def pack_messages(rows):
+    """Compress message rows into the blob an archived chat keeps them in."""
+    data = [[row["message_id"], row["role"], row["message_text"], row["created_at"]] for row in rows]
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+                         ARCHIVE_COMPRESSION_LEVEL)
+
+
+def unpack_messages(blob):
+    """Inverse of pack_messages."""
+    return [{"message_id": message_id, "role": role, "message_text": message_text, "created_at": created_at}
+            for message_id, role, message_text, created_at in json.loads(zlib.decompress(blob))]
+
+
+def unarchive(rows):
+    """Expand the archived messages of ARCHIVED_EXPORT_SQL rows into a row per message, ahead of the chat's others."""
+    chat_id = None
+    for row in rows:
+        archived = row.pop("archived")
+        if archived is not None and row["chat_id"] != chat_id:
+            for message in unpack_messages(archived):
+                yield dict(row, role=message["role"], message_text=message["message_text"],
+                           created_at=message["created_at"])
+        chat_id = row["chat_id"]
+        if archived is None or row["role"] is not None:
+            yield row
+
+
+def next_page(rows, limit, cursor_of):
+    """Split limit + 1 fetched rows into the page and the cursor for the page after it, or None."""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, cursor_of(rows[-1])
+
+
+class Repository:
+    """
+    Storage operations for users, chats and messages.
+
+    Messages passed to append_messages only need role and content attributes,
+    so ChatMessage objects can be handed over as they are.
+    """
+
+    @contextmanager
+    def transaction(self):
+        """Run the calls made inside it on this thread in one transaction."""
+        yield self
+
+    def after_commit(self, callback):
+        """Call callback once the transaction this thread is in commits, or right away outside one."""
+        callback()
+
+    def get_user(self, user_id):
+        raise NotImplementedError
+
+    def get_user_by_username(self, username):
+        raise NotImplementedError
+
+    def create_user(self, username, password_hash):
+        raise NotImplementedError
+
+    def list_chats(self, user_id):
+        raise NotImplementedError
+
+    def page_chats(self, user_id, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        Return one page of the user's chats, newest first, and the cursor of the next page.
+
+        Pages are found by seeking to (created_at, chat_id) of the last chat seen, so
+        every page costs the same however deep into the list it is.
+        """
+        raise NotImplementedError
+
+    def create_chat(self, user_id, chat_name):
+        raise NotImplementedError
+
+    def chat_exists(self, chat_id, user_id):
+        raise NotImplementedError
+
+    def latest_chat_id(self, user_id):
+        raise NotImplementedError
+
+    def delete_chat(self, chat_id, user_id):
+        raise NotImplementedError
+
+    def list_messages(self, chat_id, user_id):
+        raise NotImplementedError
+
+    def page_messages(self, chat_id, user_id, before=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        Return up to limit messages older than message_id before, oldest first, and the
+        message_id to pass as before for the page preceding them, or None at the start of the chat.
+        """
+        raise NotImplementedError
+
+    def append_messages(self, chat_id, user_id, messages, chat_name=None, turn_id=None):
+        """
+        Store messages and optionally rename the chat in one transaction, returns their message_ids.
+        A turn_id is stored with the first of them, for turn_stored().
+        """
+        raise NotImplementedError
+
+    def turn_stored(self, turn_id):
+        """Whether the messages appended with turn_id were committed."""
+        raise NotImplementedError
+
+    def search_messages(self, user_id, query, limit=DEFAULT_LIMIT):
+        """Return the user's messages best matching query, each with its chat and a highlighted snippet."""
+        raise NotImplementedError
+
+    def export_chats(self, user_id=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Yield every message of the user's chats, or of all chats when user_id is None, as rows
+        grouped by chat and in order within it. Rows are read chunk_size at a time.
+        """
+        raise NotImplementedError
+
+    def import_chat(self, user_id, chat_name, created_at=None):
+        """Create a chat as it was exported, keeping its creation time, and return its new chat_id."""
+        raise NotImplementedError
+
+    def import_messages(self, rows):
+        """Bulk insert (chat_id, user_id, message_text, role, created_at) tuples."""
+        raise NotImplementedError
+
+    def idle_chats(self, before, limit):
+        """Chats not archived yet whose newest message was written before the timestamp before."""
+        raise NotImplementedError
+
+    def archive_chat(self, chat_id, user_id):
+        """Move a chat's messages out of Messages into one compressed row, returns how many were moved."""
+        raise NotImplementedError
+
+    def restore_chat(self, chat_id, user_id):
+        """Move an archived chat's messages back into Messages, returns whether the chat was archived."""
+        return False
+
+    def storage_stats(self):
+        """Page size, pages in the database, pages on its free list and its auto_vacuum mode."""
+        raise NotImplementedError
+
+    def reclaim_space(self):
+        """Give free pages back to the file system, returns False when the file cannot do so incrementally."""
+        raise NotImplementedError
+
+    def vacuum(self):
+        """Rebuild the database without free pages."""
+        raise NotImplementedError
+
+    def analyze(self):
+        """Refresh the statistics the query planner chooses indexes by."""
+        raise NotImplementedError
+
+    def get_summary(self, chat_id, user_id):
+        raise NotImplementedError
+
+    def save_summary(self, chat_id, user_id, summary, through_message_id):
+        """Store the summary of a chat's messages up to and including through_message_id."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteRepository(Repository):
+    def __init__(self, path, pool_size=DEFAULT_POOL_SIZE, pool_timeout=DEFAULT_POOL_TIMEOUT):
+        migrate(path)
+        self.db = open_database(path, pool_size=pool_size, pool_timeout=pool_timeout)
+
+    @contextmanager
+    def transaction(self):
+        with self.db.transaction():
+            yield self
+
+    def after_commit(self, callback):
+        self.db.after_commit(callback)
+
+    def get_user(self, user_id):
+        rows = self.db.execute("SELECT user_id, username FROM Users WHERE user_id = ?", user_id)
+        return rows[0] if rows else None
+
+    def get_user_by_username(self, username):
+        rows = self.db.execute("SELECT * FROM Users WHERE username = ?", username)
+        return rows[0] if rows else None
+
+    def create_user(self, username, password_hash):
+        try:
+            return self.db.execute("INSERT INTO Users (username, password_hash) VALUES (?, ?)",
+                                   username, password_hash)
+        except sqlite3.IntegrityError as e:
+            raise DuplicateUserError(username) from e
+
+    def list_chats(self, user_id):
+        return self.db.execute("SELECT chat_id, chat_name FROM Chats WHERE user_id = ? ORDER BY created_at DESC",
+                               user_id)
+
+    def page_chats(self, user_id, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        if cursor is None:
+            rows = self.db.execute("SELECT chat_id, chat_name, created_at FROM Chats WHERE user_id = ? "
+                                   "ORDER BY created_at DESC, chat_id DESC LIMIT ?", user_id, limit + 1)
+        else:
+            created_at, chat_id = decode_cursor(cursor)
+            rows = self.db.execute("SELECT chat_id, chat_name, created_at FROM Chats "
+                                   "WHERE user_id = ? AND (created_at, chat_id) < (?, ?) "
+                                   "ORDER BY created_at DESC, chat_id DESC LIMIT ?",
+                                   user_id, created_at, chat_id, limit + 1)
+        return next_page(rows, limit, lambda row: encode_cursor(row["created_at"], row["chat_id"]))
+
+    def create_chat(self, user_id, chat_name):
+        return self.db.execute("INSERT INTO Chats (chat_name, user_id) VALUES (?, ?)", chat_name, user_id)
+
+    def chat_exists(self, chat_id, user_id):
+        return bool(self.db.execute("SELECT chat_id FROM Chats WHERE chat_id = ? AND user_id = ?", chat_id, user_id))
+
+    def latest_chat_id(self, user_id):
+        rows = self.db.execute("SELECT chat_id FROM Chats WHERE user_id = ? ORDER BY created_at DESC LIMIT 1",
+                               user_id)
+        return rows[0]["chat_id"] if rows else None
+
+    def delete_chat(self, chat_id, user_id):
+        # Messages go with the chat through ON DELETE CASCADE
+        return self.db.execute("DELETE FROM Chats WHERE chat_id = ? AND user_id = ?", chat_id, user_id)
+
+    def list_messages(self, chat_id, user_id):
+        rows = self._list_messages(chat_id, user_id)
+        # An archived chat has no rows in Messages, it is brought back the first time it is read
+        if not rows and self.restore_chat(chat_id, user_id):
+            rows = self._list_messages(chat_id, user_id)
+        return rows
+
+    def _list_messages(self, chat_id, user_id):
+        return self.db.execute("SELECT message_id, message_text, role FROM Messages WHERE chat_id = ? AND user_id = ? "
+                               "ORDER BY message_id", chat_id, user_id)
+
+    def page_messages(self, chat_id, user_id, before=None, limit=DEFAULT_PAGE_SIZE):
+        rows, before_id = self._page_messages(chat_id, user_id, before, limit)
+        if not rows and before is None and self.restore_chat(chat_id, user_id):
+            rows, before_id = self._page_messages(chat_id, user_id, before, limit)
+        return rows, before_id
+
+    def _page_messages(self, chat_id, user_id, before, limit):
+        if before is None:
+            rows = self.db.execute("SELECT message_id, message_text, role FROM Messages "
+                                   "WHERE chat_id = ? AND user_id = ? ORDER BY message_id DESC LIMIT ?",
+                                   chat_id, user_id, limit + 1)
+        else:
+            rows = self.db.execute("SELECT message_id, message_text, role FROM Messages "
+                                   "WHERE chat_id = ? AND user_id = ? AND message_id < ? "
+                                   "ORDER BY message_id DESC LIMIT ?", chat_id, user_id, before, limit + 1)
+        rows, before = next_page(rows, limit, lambda row: row["message_id"])
+        return rows[::-1], before
+
+    def append_messages(self, chat_id, user_id, messages, chat_name=None, turn_id=None):
+        message_ids = []
+        with self.db.transaction():
+            # A conversation kept in memory can outlive the archiving of its chat, its history goes back first
+            self.restore_chat(chat_id, user_id)
+            for start in range(0, len(messages), BATCH_SIZE):
+                batch = messages[start:start + BATCH_SIZE]
+                values = ", ".join(["(?, ?, ?, ?, ?)"] * len(batch))
+                args = [value for offset, message in enumerate(batch, start)
+                        for value in (chat_id, user_id, message.content, message.role, None if offset else turn_id)]
+                last_message_id = self.db.execute(
+                    f"INSERT INTO Messages (chat_id, user_id, message_text, role, turn_id) VALUES {values}", *args)
+                # Rows of one INSERT get consecutive ids while the transaction holds the write lock
+                message_ids.extend(range(last_message_id - len(batch) + 1, last_message_id + 1))
+            if chat_name is not None:
+                self.db.execute("UPDATE Chats SET chat_name = ? WHERE chat_id = ? AND user_id = ?",
+                                chat_name, chat_id, user_id)
+        return message_ids
+
+    def turn_stored(self, turn_id):
+        return bool(self.db.execute("SELECT message_id FROM Messages WHERE turn_id = ? LIMIT 1", turn_id))
+
+    def search_messages(self, user_id, query, limit=DEFAULT_LIMIT):
+        match = fts_query(query, user_id)
+        if match is None:
+            return []
+        return self.db.execute(
+            "SELECT Messages.message_id, Messages.chat_id, Chats.chat_name, Messages.role, "
+            f"snippet(MessagesSearch, 0, char(2), char(3), '…', {SNIPPET_TOKENS}) AS snippet "
+            "FROM MessagesSearch "
+            "JOIN Messages ON Messages.message_id = MessagesSearch.rowid "
+            "JOIN Chats ON Chats.chat_id = Messages.chat_id "
+            "WHERE MessagesSearch MATCH ? AND Messages.user_id = ? "
+            "ORDER BY bm25(MessagesSearch, 1.0, 0.0) LIMIT ?", match, user_id, limit)
+
+    def export_chats(self, user_id=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        if user_id is None:
+            rows = self.db.iterate(ARCHIVED_EXPORT_SQL + EXPORT_ALL_ORDER, chunk_size=chunk_size)
+        else:
+            rows = self.db.iterate(ARCHIVED_EXPORT_SQL + "WHERE Chats.user_id = ? " + EXPORT_USER_ORDER, user_id,
+                                   chunk_size=chunk_size)
+        return unarchive(rows)
+
+    def import_chat(self, user_id, chat_name, created_at=None):
+        return self.db.execute("INSERT INTO Chats (chat_name, user_id, created_at) "
+                               "VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))", chat_name, user_id, created_at)
+
+    def import_messages(self, rows):
+        return self.db.executemany("INSERT INTO Messages (chat_id, user_id, message_text, role, created_at) "
+                                   "VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))", rows)
+
+    def idle_chats(self, before, limit):
+        # Only the newest message of each chat is looked at, one seek into idx_messages_chat_user_message per chat
+        return self.db.execute("SELECT chat_id, user_id FROM Chats "
+                               "WHERE chat_id NOT IN (SELECT chat_id FROM ArchivedChats) "
+                               "AND (SELECT created_at FROM Messages WHERE Messages.chat_id = Chats.chat_id "
+                               "AND Messages.user_id = Chats.user_id ORDER BY message_id DESC LIMIT 1) < ? LIMIT ?",
+                               before, limit)
+
+    def archive_chat(self, chat_id, user_id):
+        with self.db.transaction():
+            rows = self.db.execute("SELECT message_id, role, message_text, created_at FROM Messages "
+                                   "WHERE chat_id = ? AND user_id = ? ORDER BY message_id", chat_id, user_id)
+            if not rows:
+                return 0
+            self.db.execute("INSERT INTO ArchivedChats (chat_id, user_id, message_count, messages) VALUES (?, ?, ?, ?)",
+                            chat_id, user_id, len(rows), pack_messages(rows))
+            # The search index drops them too, through the delete trigger
+            self.db.execute("DELETE FROM Messages WHERE chat_id = ? AND user_id = ?", chat_id, user_id)
+        return len(rows)
+
+    def restore_chat(self, chat_id, user_id):
+        # Checked outside a transaction first, so reading an empty chat does not take the write lock
+        if not self.db.execute("SELECT chat_id FROM ArchivedChats WHERE chat_id = ? AND user_id = ?", chat_id, user_id):
+            return False
+        with self.db.transaction():
+            rows = self.db.execute("SELECT messages FROM ArchivedChats WHERE chat_id = ? AND user_id = ?",
+                                   chat_id, user_id)
+            if not rows:
+                # Another worker restored it in the meantime
+                return True
+            # Messages keep their ids, so summaries and their through_message_id stay valid
+            self.db.executemany("INSERT INTO Messages (message_id, chat_id, user_id, message_text, role, created_at) "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                [(message["message_id"], chat_id, user_id, message["message_text"], message["role"],
+                                  message["created_at"]) for message in unpack_messages(rows[0]["messages"])])
+            self.db.execute("DELETE FROM ArchivedChats WHERE chat_id = ?", chat_id)
+        return True
+
+    def storage_stats(self):
+        return {name: self.db.execute(f"PRAGMA {name}")[0][name]
+                for name in ("page_size", "page_count", "freelist_count", "auto_vacuum")}
+
+    def reclaim_space(self):
+        stats = self.storage_stats()
+        if stats["auto_vacuum"] != INCREMENTAL_AUTO_VACUUM:
+            return False
+        # A step at a time, so a large free list never holds writers up for long. executescript() runs each
+        # step to completion, execute() would stop after the first page
+        for _ in range(stats["freelist_count"] // VACUUM_PAGES + 1):
+            with self.db.connection() as conn:
+                conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+        return True
+
+    def vacuum(self):
+        with self.db.connection() as conn:
+            # Switches an older file to incremental auto_vacuum, so later runs can use reclaim_space()
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+
+    def analyze(self):
+        with self.db.connection() as conn:
+            conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+            conn.execute("ANALYZE")
+
+    def get_summary(self, chat_id, user_id):
+        rows = self.db.execute("SELECT summary, through_message_id FROM Summaries WHERE chat_id = ? AND user_id = ?",
+                               chat_id, user_id)
+        return rows[0] if rows else None
+
+    def save_summary(self, chat_id, user_id, summary, through_message_id):
+        self.db.execute("INSERT INTO Summaries (chat_id, user_id, summary, through_message_id) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (chat_id) DO UPDATE SET summary = excluded.summary, "
+                        "through_message_id = excluded.through_message_id, updated_at = CURRENT_TIMESTAMP",
+                        chat_id, user_id, summary, through_message_id)
+
+    def close(self):
+        self.db.close()
+
+
+POSTGRES_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS Users (
+           user_id BIGSERIAL PRIMARY KEY,
+           username VARCHAR(50) UNIQUE,
+           email VARCHAR(100) UNIQUE,
+           password_hash VARCHAR(200),
+           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+       );""",
+    """CREATE TABLE IF NOT EXISTS Chats (
+           chat_id BIGSERIAL PRIMARY KEY,
+           chat_name VARCHAR(100),
+           user_id BIGINT REFERENCES Users (user_id) ON DELETE CASCADE,
+           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+       );""",
+    """CREATE TABLE IF NOT EXISTS Messages (
+           message_id BIGSERIAL PRIMARY KEY,
+           chat_id BIGINT REFERENCES Chats (chat_id) ON DELETE CASCADE,
+           user_id BIGINT REFERENCES Users (user_id) ON DELETE CASCADE,
+           message_text TEXT,
+           role TEXT,
+           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+       );""",
+    """CREATE TABLE IF NOT EXISTS Summaries (
+           chat_id BIGINT PRIMARY KEY REFERENCES Chats (chat_id) ON DELETE CASCADE,
+           user_id BIGINT REFERENCES Users (user_id) ON DELETE CASCADE,
+           summary TEXT,
+           through_message_id BIGINT,
+           updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+       );""",
+    """CREATE TABLE IF NOT EXISTS ArchivedChats (
+           chat_id BIGINT PRIMARY KEY REFERENCES Chats (chat_id) ON DELETE CASCADE,
+           user_id BIGINT REFERENCES Users (user_id) ON DELETE CASCADE,
+           message_count INTEGER,
+           messages BYTEA,
+           archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+       );""",
+    "CREATE INDEX IF NOT EXISTS idx_chats_user_created ON Chats (user_id, created_at);",
+    # Unlike SQLite, PostgreSQL indexes do not carry the primary key, the chat list seeks on both columns
+    "CREATE INDEX IF NOT EXISTS idx_chats_user_created_chat ON Chats (user_id, created_at, chat_id);",
+    "CREATE INDEX IF NOT EXISTS idx_messages_chat_message ON Messages (chat_id, message_id);",
+    "CREATE INDEX IF NOT EXISTS idx_messages_user ON Messages (user_id);",
+    "CREATE INDEX IF NOT EXISTS idx_messages_search ON Messages USING GIN (to_tsvector('simple', message_text));",
+    "ALTER TABLE Messages ADD COLUMN IF NOT EXISTS turn_id TEXT;",
+    "CREATE INDEX IF NOT EXISTS idx_messages_turn ON Messages (turn_id) WHERE turn_id IS NOT NULL;",
+]
+
+
+class PostgresRepository(Repository):
+    """Repository over a shared PostgreSQL database, so several app instances can serve the same users."""
+
+    def __init__(self, dsn, pool_size=DEFAULT_POOL_SIZE, pool_timeout=DEFAULT_POOL_TIMEOUT):
+        if psycopg2 is None:
+            raise RuntimeError("psycopg2 must be installed to use a PostgreSQL database.")
+        self.dsn = dsn
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size, dsn)
+        self.pool_timeout = pool_timeout
+        self._local = threading.local()
+        with self.cursor() as cursor:
+            for statement in POSTGRES_SCHEMA:
+                cursor.execute(statement)
+
+    def _getconn(self):
+        # The pool fails at once when every connection is out, wait for one like storage.Database does
+        deadline = time.monotonic() + self.pool_timeout
+        while True:
+            try:
+                return self.pool.getconn()
+            except psycopg2.pool.PoolError:
+                if self.pool.closed or time.monotonic() >= deadline:
+                    raise PoolTimeout(f"No PostgreSQL connection came free within {self.pool_timeout}s") from None
+                time.sleep(POOL_RETRY_DELAY)
+
+    @contextmanager
+    def cursor(self):
+        """Yield a dict cursor, committing on success. Nested calls share the outer transaction."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            with conn.cursor(cursor_factory=TimedCursor) as cursor:
+                yield cursor
+            return
+        conn = self._getconn()
+        self._local.conn = conn
+        self._local.after_commit = callbacks = []
+        try:
+            with conn.cursor(cursor_factory=TimedCursor) as cursor:
+                yield cursor
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._local.after_commit = None
+            self.pool.putconn(conn)
+        for callback in callbacks:
+            callback()
+
+    @contextmanager
+    def transaction(self):
+        with self.cursor():
+            yield self
+
+    def after_commit(self, callback):
+        if getattr(self._local, "conn", None) is None:
+            callback()
+        else:
+            self._local.after_commit.append(callback)
+
+    def _run_outside_transaction(self, *statements):
+        # VACUUM refuses to run inside a transaction block
+        conn = self._getconn()
+        try:
+            conn.autocommit = True
+            with conn.cursor(cursor_factory=TimedCursor) as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+        finally:
+            conn.autocommit = False
+            self.pool.putconn(conn)
+
+    def _fetch(self, sql, *args):
+        with self.cursor() as cursor:
+            cursor.execute(sql, args)
+            return [dict(row) for row in cursor.fetchall()]
+
+    def get_user(self, user_id):
+        rows = self._fetch("SELECT user_id, username FROM Users WHERE user_id = %s", user_id)
+        return rows[0] if rows else None
+
+    def get_user_by_username(self, username):
+        rows = self._fetch("SELECT * FROM Users WHERE username = %s", username)
+        return rows[0] if rows else None
+
+    def create_user(self, username, password_hash):
+        try:
+            return self._fetch("INSERT INTO Users (username, password_hash) VALUES (%s, %s) RETURNING user_id",
+                               username, password_hash)[0]["user_id"]
+        except psycopg2.IntegrityError as e:
+            raise DuplicateUserError(username) from e
+
+    def list_chats(self, user_id):
+        return self._fetch("SELECT chat_id, chat_name FROM Chats WHERE user_id = %s ORDER BY created_at DESC",
+                           user_id)
+
+    def page_chats(self, user_id, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        if cursor is None:
+            rows = self._fetch("SELECT chat_id, chat_name, created_at FROM Chats WHERE user_id = %s "
+                               "ORDER BY created_at DESC, chat_id DESC LIMIT %s", user_id, limit + 1)
+        else:
+            created_at, chat_id = decode_cursor(cursor)
+            rows = self._fetch("SELECT chat_id, chat_name, created_at FROM Chats "
+                               "WHERE user_id = %s AND (created_at, chat_id) < (%s::timestamp, %s) "
+                               "ORDER BY created_at DESC, chat_id DESC LIMIT %s",
+                               user_id, created_at, chat_id, limit + 1)
+        return next_page(rows, limit, lambda row: encode_cursor(row["created_at"], row["chat_id"]))
+
+    def create_chat(self, user_id, chat_name):
+        return self._fetch("INSERT INTO Chats (chat_name, user_id) VALUES (%s, %s) RETURNING chat_id",
+                           chat_name, user_id)[0]["chat_id"]
+
+    def chat_exists(self, chat_id, user_id):
+        return bool(self._fetch("SELECT chat_id FROM Chats WHERE chat_id = %s AND user_id = %s", chat_id, user_id))
+
+    def latest_chat_id(self, user_id):
+        rows = self._fetch("SELECT chat_id FROM Chats WHERE user_id = %s ORDER BY created_at DESC LIMIT 1", user_id)
+        return rows[0]["chat_id"] if rows else None
+
+    def delete_chat(self, chat_id, user_id):
+        with self.cursor() as cursor:
+            cursor.execute("DELETE FROM Chats WHERE chat_id = %s AND user_id = %s", (chat_id, user_id))
+            return cursor.rowcount
+
+    def list_messages(self, chat_id, user_id):
+        rows = self._list_messages(chat_id, user_id)
+        # An archived chat has no rows in Messages, it is brought back the first time it is read
+        if not rows and self.restore_chat(chat_id, user_id):
+            rows = self._list_messages(chat_id, user_id)
+        return rows
+
+    def _list_messages(self, chat_id, user_id):
+        return self._fetch("SELECT message_id, message_text, role FROM Messages WHERE chat_id = %s AND user_id = %s "
+                           "ORDER BY message_id", chat_id, user_id)
+
+    def page_messages(self, chat_id, user_id, before=None, limit=DEFAULT_PAGE_SIZE):
+        rows, before_id = self._page_messages(chat_id, user_id, before, limit)
+        if not rows and before is None and self.restore_chat(chat_id, user_id):
+            rows, before_id = self._page_messages(chat_id, user_id, before, limit)
+        return rows, before_id
+
+    def _page_messages(self, chat_id, user_id, before, limit):
+        if before is None:
+            rows = self._fetch("SELECT message_id, message_text, role FROM Messages "
+                               "WHERE chat_id = %s AND user_id = %s ORDER BY message_id DESC LIMIT %s",
+                               chat_id, user_id, limit + 1)
+        else:
+            rows = self._fetch("SELECT message_id, message_text, role FROM Messages "
+                               "WHERE chat_id = %s AND user_id = %s AND message_id < %s "
+                               "ORDER BY message_id DESC LIMIT %s", chat_id, user_id, before, limit + 1)
+        rows, before = next_page(rows, limit, lambda row: row["message_id"])
+        return rows[::-1], before
+
+    def append_messages(self, chat_id, user_id, messages, chat_name=None, turn_id=None):
+        message_ids = []
+        with self.cursor() as cursor:
+            # A conversation kept in memory can outlive the archiving of its chat, its history goes back first
+            self.restore_chat(chat_id, user_id)
+            if messages:
+                rows = psycopg2.extras.execute_values(
+                    cursor, "INSERT INTO Messages (chat_id, user_id, message_text, role, turn_id) VALUES %s "
+                    "RETURNING message_id",
+                    [(chat_id, user_id, message.content, message.role, None if offset else turn_id)
+                     for offset, message in enumerate(messages)],
+                    page_size=BATCH_SIZE, fetch=True)
+                message_ids = [row["message_id"] for row in rows]
+            if chat_name is not None:
+                cursor.execute("UPDATE Chats SET chat_name = %s WHERE chat_id = %s AND user_id = %s",
+                               (chat_name, chat_id, user_id))
+        return message_ids
+
+    def turn_stored(self, turn_id):
+        return bool(self._fetch("SELECT message_id FROM Messages WHERE turn_id = %s LIMIT 1", turn_id))
+
+    def search_messages(self, user_id, query, limit=DEFAULT_LIMIT):
+        if not query.strip():
+            return []
+        options = f"StartSel={MATCH_START}, StopSel={MATCH_END}, MaxWords={SNIPPET_TOKENS * 2}, MinWords={SNIPPET_TOKENS}"
+        return self._fetch(
+            "SELECT Messages.message_id, Messages.chat_id, Chats.chat_name, Messages.role, "
+            "ts_headline('simple', message_text, plainto_tsquery('simple', %s), %s) AS snippet "
+            "FROM Messages JOIN Chats ON Chats.chat_id = Messages.chat_id "
+            "WHERE to_tsvector('simple', message_text) @@ plainto_tsquery('simple', %s) AND Messages.user_id = %s "
+            "ORDER BY ts_rank(to_tsvector('simple', message_text), plainto_tsquery('simple', %s)) DESC LIMIT %s",
+            query, options, query, user_id, query, limit)
+
+    def export_chats(self, user_id=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        if user_id is None:
+            sql, args = ARCHIVED_EXPORT_SQL + EXPORT_ALL_ORDER, ()
+        else:
+            sql, args = ARCHIVED_EXPORT_SQL + "WHERE Chats.user_id = %s " + EXPORT_USER_ORDER, (user_id,)
+        return unarchive(self._stream(sql, args, chunk_size))
+
+    def _stream(self, sql, args, chunk_size):
+        # A download holds its connection for as long as the client takes, so it gets one outside the pool
+        conn = psycopg2.connect(self.dsn)
+        try:
+            # A named cursor lives on the server, which sends chunk_size rows per round trip
+            with conn.cursor(name="export_chats", cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.itersize = chunk_size
+                cursor.execute(sql, args)
+                for row in cursor:
+                    yield dict(row)
+        finally:
+            conn.close()
+
+    def import_chat(self, user_id, chat_name, created_at=None):
+        return self._fetch("INSERT INTO Chats (chat_name, user_id, created_at) "
+                           "VALUES (%s, %s, COALESCE(%s::timestamp, CURRENT_TIMESTAMP)) RETURNING chat_id",
+                           chat_name, user_id, created_at)[0]["chat_id"]
+
+    def import_messages(self, rows):
+        with self.cursor() as cursor:
+            psycopg2.extras.execute_values(
+                cursor, "INSERT INTO Messages (chat_id, user_id, message_text, role, created_at) VALUES %s", rows,
+                template="(%s, %s, %s, %s, COALESCE(%s::timestamp, CURRENT_TIMESTAMP))", page_size=BATCH_SIZE)
+        # rowcount only covers the last page execute_values sent
+        return len(rows)
+
+    def idle_chats(self, before, limit):
+        return self._fetch("SELECT chat_id, user_id FROM Chats "
+                           "WHERE NOT EXISTS (SELECT 1 FROM ArchivedChats WHERE ArchivedChats.chat_id = Chats.chat_id) "
+                           "AND (SELECT created_at FROM Messages WHERE Messages.chat_id = Chats.chat_id "
+                           "AND Messages.user_id = Chats.user_id ORDER BY message_id DESC LIMIT 1) < %s::timestamp "
+                           "LIMIT %s", before, limit)
+
+    def archive_chat(self, chat_id, user_id):
+        with self.cursor() as cursor:
+            cursor.execute("SELECT message_id, role, message_text, created_at::text AS created_at FROM Messages "
+                           "WHERE chat_id = %s AND user_id = %s ORDER BY message_id FOR UPDATE", (chat_id, user_id))
+            rows = cursor.fetchall()
+            if not rows:
+                return 0
+            cursor.execute("INSERT INTO ArchivedChats (chat_id, user_id, message_count, messages) "
+                           "VALUES (%s, %s, %s, %s) ON CONFLICT (chat_id) DO NOTHING",
+                           (chat_id, user_id, len(rows), psycopg2.Binary(pack_messages(rows))))
+            if not cursor.rowcount:
+                # Another instance archived it first
+                return 0
+            # Only the rows that were packed, one appended meanwhile stays in Messages
+            cursor.execute("DELETE FROM Messages WHERE message_id = ANY(%s)", ([row["message_id"] for row in rows],))
+        return len(rows)
+
+    def restore_chat(self, chat_id, user_id):
+        if not self._fetch("SELECT chat_id FROM ArchivedChats WHERE chat_id = %s AND user_id = %s", chat_id, user_id):
+            return False
+        with self.cursor() as cursor:
+            # Deleting the archive claims it, so two instances never restore the same chat
+            cursor.execute("DELETE FROM ArchivedChats WHERE chat_id = %s AND user_id = %s RETURNING messages",
+                           (chat_id, user_id))
+            rows = cursor.fetchall()
+            if rows:
+                psycopg2.extras.execute_values(
+                    cursor, "INSERT INTO Messages (message_id, chat_id, user_id, message_text, role, created_at) "
+                            "VALUES %s",
+                    [(message["message_id"], chat_id, user_id, message["message_text"], message["role"],
+                      message["created_at"]) for message in unpack_messages(rows[0]["messages"])],
+                    template="(%s, %s, %s, %s, %s, %s::timestamp)", page_size=BATCH_SIZE)
+        return True
+
+    def storage_stats(self):
+        # PostgreSQL reuses the space of dead rows inside its files, it keeps no free list to report
+        return self._fetch("SELECT current_setting('block_size')::int AS page_size, "
+                           "pg_database_size(current_database()) / current_setting('block_size')::int AS page_count, "
+                           "0 AS freelist_count, NULL AS auto_vacuum")[0]
+
+    def reclaim_space(self):
+        # Plain VACUUM makes the rows archiving deleted reusable and gives empty pages at the end of a table back
+        self._run_outside_transaction("VACUUM Messages", "VACUUM ArchivedChats")
+        return True
+
+    def vacuum(self):
+        self._run_outside_transaction("VACUUM FULL")
+
+    def analyze(self):
+        self._run_outside_transaction("ANALYZE")
+
+    def get_summary(self, chat_id, user_id):
+        rows = self._fetch("SELECT summary, through_message_id FROM Summaries WHERE chat_id = %s AND user_id = %s",
+                           chat_id, user_id)
+        return rows[0] if rows else None
+
+    def save_summary(self, chat_id, user_id, summary, through_message_id):
+        with self.cursor() as cursor:
+            cursor.execute("INSERT INTO Summaries (chat_id, user_id, summary, through_message_id) "
+                           "VALUES (%s, %s, %s, %s) ON CONFLICT (chat_id) DO UPDATE SET summary = EXCLUDED.summary, "
+                           "through_message_id = EXCLUDED.through_message_id, updated_at = CURRENT_TIMESTAMP",
+                           (chat_id, user_id, summary, through_message_id))
+
+    def close(self):
+        self.pool.closeall()
+
+
+class CachedRepository(Repository):
+    """
+    Read-through cache in front of another repository for what every page asks for:
+    whether the user exists, their chat list, and whether they own a chat.
+
+    Entries expire after ttl seconds. Writes that go through this repository drop
+    the entries they change as soon as they commit, so within one process a new,
+    renamed or deleted chat shows up on the next request.
+    """
+
+    def __init__(self, repository, ttl=DEFAULT_CACHE_TTL, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.repository = repository
+        self.ttl = ttl
+        # Values are wrapped in a tuple so that a cached None or False is told apart from a miss
+        self.cache = MemoryBackend(max_entries=max_entries)
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def transaction(self):
+        with self.repository.transaction():
+            yield self
+
+    def after_commit(self, callback):
+        self.repository.after_commit(callback)
+
+    def _read(self, key, load, keep=lambda value: True):
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        value = load()
+        if keep(value):
+            self.cache.put(key, (value,), self.ttl)
+        return value
+
+    def invalidate_chats(self, user_id, chat_id=None):
+        """
+        Forget the user's chat list, and what is known about chat_id, once the change is committed.
+        Dropping them earlier would let a request in between cache what the database held before it.
+        """
+        self.repository.after_commit(lambda: self._forget_chats(user_id, chat_id))
+
+    def _forget_chats(self, user_id, chat_id):
+        self.cache.delete(("chats", user_id))
+        self.cache.delete(("latest", user_id))
+        if chat_id is not None:
+            self.cache.delete(("chat", chat_id, user_id))
+
+    def get_user(self, user_id):
+        # Unknown users are not remembered, the id may be registered a moment later
+        return self._read(("user", user_id), lambda: self.repository.get_user(user_id),
+                          keep=lambda user: user is not None)
+
+    def get_user_by_username(self, username):
+        return self.repository.get_user_by_username(username)
+
+    def create_user(self, username, password_hash):
+        return self.repository.create_user(username, password_hash)
+
+    def list_chats(self, user_id):
+        return self.repository.list_chats(user_id)
+
+    def page_chats(self, user_id, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        pages = self.cache.get(("chats", user_id))
+        pages = dict(pages[0]) if pages is not None else {}
+        if (cursor, limit) in pages:
+            self.hits += 1
+            return pages[(cursor, limit)]
+        self.misses += 1
+        page = self.repository.page_chats(user_id, cursor, limit)
+        # Every page of a user is kept under one key, so a change to any chat drops them together
+        pages[(cursor, limit)] = page
+        self.cache.put(("chats", user_id), (pages,), self.ttl)
+        return page
+
+    def create_chat(self, user_id, chat_name):
+        chat_id = self.repository.create_chat(user_id, chat_name)
+        self.invalidate_chats(user_id, chat_id)
+        return chat_id
+
+    def chat_exists(self, chat_id, user_id):
+        return self._read(("chat", chat_id, user_id), lambda: self.repository.chat_exists(chat_id, user_id))
+
+    def latest_chat_id(self, user_id):
+        return self._read(("latest", user_id), lambda: self.repository.latest_chat_id(user_id))
+
+    def delete_chat(self, chat_id, user_id):
+        result = self.repository.delete_chat(chat_id, user_id)
+        self.invalidate_chats(user_id, chat_id)
+        return result
+
+    def list_messages(self, chat_id, user_id):
+        return self.repository.list_messages(chat_id, user_id)
+
+    def page_messages(self, chat_id, user_id, before=None, limit=DEFAULT_PAGE_SIZE):
+        return self.repository.page_messages(chat_id, user_id, before, limit)
+
+    def append_messages(self, chat_id, user_id, messages, chat_name=None, turn_id=None):
+        message_ids = self.repository.append_messages(chat_id, user_id, messages, chat_name=chat_name, turn_id=turn_id)
+        if chat_name is not None:
+            # The chat was renamed
+            self.invalidate_chats(user_id)
+        return message_ids
+
+    def turn_stored(self, turn_id):
+        return self.repository.turn_stored(turn_id)
+
+    def search_messages(self, user_id, query, limit=DEFAULT_LIMIT):
+        return self.repository.search_messages(user_id, query, limit)
+
+    def export_chats(self, user_id=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        return self.repository.export_chats(user_id, chunk_size)
+
+    def import_chat(self, user_id, chat_name, created_at=None):
+        chat_id = self.repository.import_chat(user_id, chat_name, created_at)
+        self.invalidate_chats(user_id, chat_id)
+        return chat_id
+
+    def import_messages(self, rows):
+        return self.repository.import_messages(rows)
+
+    def idle_chats(self, before, limit):
+        return self.repository.idle_chats(before, limit)
+
+    def archive_chat(self, chat_id, user_id):
+        return self.repository.archive_chat(chat_id, user_id)
+
+    def restore_chat(self, chat_id, user_id):
+        return self.repository.restore_chat(chat_id, user_id)
+
+    def storage_stats(self):
+        return self.repository.storage_stats()
+
+    def reclaim_space(self):
+        return self.repository.reclaim_space()
+
+    def vacuum(self):
+        self.repository.vacuum()
+
+    def analyze(self):
+        self.repository.analyze()
+
+    def get_summary(self, chat_id, user_id):
+        return self.repository.get_summary(chat_id, user_id)
+
+    def save_summary(self, chat_id, user_id, summary, through_message_id):
+        return self.repository.save_summary(chat_id, user_id, summary, through_message_id)
+
+    def close(self):
+        self.repository.close()
+
+
+def open_repository(url, pool_size=DEFAULT_POOL_SIZE, pool_timeout=DEFAULT_POOL_TIMEOUT, cache_ttl=0,
+                    cache_entries=DEFAULT_CACHE_ENTRIES):
+    """
+    Open a repository for a postgresql:// URL, or for a SQLite database file path, behind
+    a CachedRepository when cache_ttl is above zero. Taking a connection raises storage.PoolTimeout
+    after waiting pool_timeout seconds for one.
+    """
+    if url.startswith(("postgres://", "postgresql://")):
+        repository = PostgresRepository(url, pool_size=pool_size, pool_timeout=pool_timeout)
+    else:
+        repository = SQLiteRepository(url, pool_size=pool_size, pool_timeout=pool_timeout)
+    if cache_ttl > 0:
+        return CachedRepository(repository, ttl=cache_ttl, max_entries=cache_entries)
+    return repository
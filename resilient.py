@@ -0,0 +1,280 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import httpx
+from mistralai.async_client import MistralAsyncClient
+from mistralai.client import MistralClient
+from mistralai.constants import RETRY_STATUS_CODES
+from mistralai.exceptions import MistralAPIException, MistralConnectionException, MistralException
+
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 60.0
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 8.0
+# Consecutive failed attempts that open a model's circuit, and how long it stays open
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+
+logger = logging.getLogger("chatbot.resilient")
+
+
+class CircuitOpenError(MistralException):
+    """Raised without calling upstream while a model's circuit is open."""
+
+
+class StreamInterrupted(MistralException):
+    """Raised when a stream fails after part of the reply was received, which is kept in partial."""
+
+    def __init__(self, message, partial):
+        super().__init__(message)
+        self.partial = partial
+
+
+def is_retryable(error):
+    """Whether an upstream error is transient: rate limits, server errors, timeouts and dropped connections."""
+    if isinstance(error, MistralAPIException):
+        return error.http_status in RETRY_STATUS_CODES or (error.http_status or 0) >= 500
+    if isinstance(error, MistralConnectionException):
+        return True
+    if isinstance(error, MistralException):
+        # The client reports timeouts and other transport errors, and 5xx outside its retry list, as plain errors
+        return isinstance(error.__cause__, httpx.TransportError) or str(error).startswith("Status: 5")
+    # mistralai formats the body of a streamed 429/5xx without reading it first, so those surface as ResponseNotRead
+    return isinstance(error, (httpx.TransportError, httpx.ResponseNotRead))
+
+
+def retry_after(error):
+    """Seconds the upstream asked us to wait before retrying, if it said so."""
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Fail fast while a model keeps failing.
+
+    After failure_threshold consecutive failures the circuit opens and calls are
+    refused for reset_timeout seconds. Then a single trial call is let through:
+    success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+                self._trial = False
+
+
+class ResilientClient:
+    """
+    Wraps a MistralClient with retries, jittered exponential backoff and a circuit breaker per model.
+
+    Has the chat, chat_stream and embeddings methods of the client it wraps, so it
+    can be handed to ChatBot, the summarizer or the batch runner in its place.
+    """
+
+    def __init__(self, client, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT, sleep=time.sleep, share=None):
+        self.client = client
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.sleep = sleep
+        # Circuit breakers of another ResilientClient, so a model failing on one client is avoided on both
+        self._breakers = share._breakers if share is not None else {}
+        self._lock = share._lock if share is not None else threading.Lock()
+
+    def breaker(self, model):
+        with self._lock:
+            if model not in self._breakers:
+                self._breakers[model] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self._breakers[model]
+
+    def backoff(self, attempt, error):
+        """Full jitter: a random delay up to base_delay * 2^attempt, or what the upstream asked for."""
+        delay = retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return min(delay, self.max_delay)
+
+    def _failed(self, model, breaker, attempt, error):
+        """Record a failed attempt and return the delay before the next one, or None to give up."""
+        if not is_retryable(error):
+            # The request itself was rejected, the upstream is fine
+            breaker.record_success()
+            return None
+        breaker.record_failure()
+        if attempt + 1 == self.max_attempts:
+            return None
+        delay = self.backoff(attempt, error)
+        logger.warning("Request to %s failed (%s), retrying in %.2fs", model, error, delay)
+        return delay
+
+    def _call(self, model, request):
+        """Run request(), retrying transient failures, and return its result."""
+        breaker = self.breaker(model)
+        for attempt in range(self.max_attempts):
+            if not breaker.allow():
+                raise CircuitOpenError(f"Circuit for {model} is open after repeated failures")
+            try:
+                result = request()
+            except Exception as e:
+                delay = self._failed(model, breaker, attempt, e)
+                if delay is None:
+                    raise
+                self.sleep(delay)
+                continue
+            breaker.record_success()
+            return result
+
+    def chat(self, model, messages, **kwargs):
+        return self._call(model, lambda: self.client.chat(model=model, messages=messages, **kwargs))
+
+    def embeddings(self, model, input):
+        return self._call(model, lambda: self.client.embeddings(model=model, input=input))
+
+    def chat_stream(self, model, messages, **kwargs):
+        """
+        Yield stream chunks like MistralClient.chat_stream.
+
+        A request that fails before its first chunk is retried like any other. Once
+        chunks have been yielded a retry would repeat them, so a failure raises
+        StreamInterrupted carrying the text received so far instead.
+        """
+        def first_chunk():
+            stream = iter(self.client.chat_stream(model=model, messages=messages, **kwargs))
+            return stream, next(stream, None)
+
+        stream, chunk = self._call(model, first_chunk)
+        partial = ""
+        breaker = self.breaker(model)
+        try:
+            while chunk is not None:
+                partial += chunk.choices[0].delta.content or ""
+                yield chunk
+                chunk = next(stream, None)
+        except Exception as e:
+            if is_retryable(e):
+                breaker.record_failure()
+            raise StreamInterrupted(f"Stream from {model} was interrupted: {e}", partial) from e
+
+
+class AsyncResilientClient(ResilientClient):
+    """
+    ResilientClient for a MistralAsyncClient, with chat as a coroutine and chat_stream as an async generator.
+
+    Used by the async inference engine; pass share=ResilientClient to use the same
+    circuit breakers as the synchronous client, which the router reads.
+    """
+
+    def __init__(self, client, sleep=asyncio.sleep, **kwargs):
+        super().__init__(client, sleep=sleep, **kwargs)
+
+    async def _call(self, model, request):
+        """Await request(), retrying transient failures, and return its result."""
+        breaker = self.breaker(model)
+        for attempt in range(self.max_attempts):
+            if not breaker.allow():
+                raise CircuitOpenError(f"Circuit for {model} is open after repeated failures")
+            try:
+                result = await request()
+            except Exception as e:
+                delay = self._failed(model, breaker, attempt, e)
+                if delay is None:
+                    raise
+                await self.sleep(delay)
+                continue
+            breaker.record_success()
+            return result
+
+    async def chat(self, model, messages, **kwargs):
+        return await self._call(model, lambda: self.client.chat(model=model, messages=messages, **kwargs))
+
+    async def embeddings(self, model, input):
+        return await self._call(model, lambda: self.client.embeddings(model=model, input=input))
+
+    async def chat_stream(self, model, messages, **kwargs):
+        """Yield stream chunks like MistralAsyncClient.chat_stream, retrying and interrupting like ResilientClient."""
+        async def first_chunk():
+            stream = aiter(self.client.chat_stream(model=model, messages=messages, **kwargs))
+            return stream, await anext(stream, None)
+
+        stream, chunk = await self._call(model, first_chunk)
+        partial = ""
+        breaker = self.breaker(model)
+        try:
+            while chunk is not None:
+                partial += chunk.choices[0].delta.content or ""
+                yield chunk
+                chunk = await anext(stream, None)
+        except Exception as e:
+            if is_retryable(e):
+                breaker.record_failure()
+            raise StreamInterrupted(f"Stream from {model} was interrupted: {e}", partial) from e
+
+    async def close(self):
+        await self.client.close()
+
+
+def open_client(api_key, endpoint=None, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                **kwargs):
+    """A ResilientClient over a MistralClient with separate connect and read timeouts."""
+    options = {"endpoint": endpoint} if endpoint else {}
+    # The wrapper does the retrying, the client's own fixed backoff would only stack on top of it
+    client = MistralClient(api_key=api_key, max_retries=1,
+                           timeout=httpx.Timeout(read_timeout, connect=connect_timeout), **options)
+    return ResilientClient(client, **kwargs)
+
+
+def open_async_client(api_key, endpoint=None, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                      read_timeout=DEFAULT_READ_TIMEOUT, **kwargs):
+    """An AsyncResilientClient over a MistralAsyncClient with separate connect and read timeouts."""
+    options = {"endpoint": endpoint} if endpoint else {}
+    client = MistralAsyncClient(api_key=api_key, max_retries=1,
+                                timeout=httpx.Timeout(read_timeout, connect=connect_timeout), **options)
+    return AsyncResilientClient(client, **kwargs)
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from storage import open_database
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 10000
+# The SQLite backend trims itself back to max_entries once every this many stores
+EVICT_EVERY = 100
+
+
+def cache_key(model, temperature, messages):
+    """Stable hash of a completion request, ignoring surrounding whitespace in message content."""
+    payload = {
+        "model": model,
+        "temperature": round(float(temperature), 4),
+        "messages": [[message.role.lower(), (message.content or "").strip()] for message in messages],
+    }
+    encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def replay(response):
+    """Split a cached response into word-sized chunks so it streams like a live completion."""
+    return re.findall(r"\s*\S+|\s+", response)
+
+
+class MemoryBackend:
+    """LRU dictionary of responses with per-entry expiry."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            response, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return response
+
+    def put(self, key, response, ttl):
+        with self._lock:
+            self._entries[key] = (response, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteBackend:
+    """Responses in an on-disk SQLite table, shared by every worker process on the host."""
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.db = open_database(path)
+        self._puts = 0
+        self.db.execute("""CREATE TABLE IF NOT EXISTS ResponseCache (
+                               cache_key TEXT PRIMARY KEY,
+                               response TEXT,
+                               expires_at REAL,
+                               last_used REAL
+                           );""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON ResponseCache (last_used);")
+
+    def get(self, key):
+        now = time.time()
+        rows = self.db.execute("SELECT response, expires_at FROM ResponseCache WHERE cache_key = ?", key)
+        if not rows:
+            return None
+        if rows[0]["expires_at"] < now:
+            self.db.execute("DELETE FROM ResponseCache WHERE cache_key = ?", key)
+            return None
+        self.db.execute("UPDATE ResponseCache SET last_used = ? WHERE cache_key = ?", now, key)
+        return rows[0]["response"]
+
+    def put(self, key, response, ttl):
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO ResponseCache (cache_key, response, expires_at, last_used) "
+                        "VALUES (?, ?, ?, ?)", key, response, now + ttl, now)
+        self._puts += 1
+        if self._puts % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        self.db.execute("DELETE FROM ResponseCache WHERE expires_at < ?", time.time())
+        self.db.execute("DELETE FROM ResponseCache WHERE cache_key IN (SELECT cache_key FROM ResponseCache "
+                        "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", self.max_entries)
+
+    def delete(self, key):
+        self.db.execute("DELETE FROM ResponseCache WHERE cache_key = ?", key)
+
+    def clear(self):
+        self.db.execute("DELETE FROM ResponseCache")
+
+
+class CompletionCache:
+    """
+    Reuse completions for identical requests.
+
+    Only deterministic requests (temperature 0) are cached unless
+    allow_sampled is set, since caching a sampled reply would pin it.
+    """
+
+    def __init__(self, backend, ttl=DEFAULT_TTL, allow_sampled=False):
+        self.backend = backend
+        self.ttl = ttl
+        self.allow_sampled = allow_sampled
+        self.hits = 0
+        self.misses = 0
+
+    def applies(self, temperature):
+        return temperature == 0 or self.allow_sampled
+
+    def get(self, model, temperature, messages):
+        response = self.backend.get(cache_key(model, temperature, messages))
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return response
+
+    def put(self, model, temperature, messages, response):
+        if response:
+            self.backend.put(cache_key(model, temperature, messages), response, self.ttl)
+
+
+def open_cache(kind, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, allow_sampled=False):
+    """Build a CompletionCache for kind "memory" or "sqlite", or return None when caching is off."""
+    if kind == "memory":
+        backend = MemoryBackend(max_entries=max_entries)
+    elif kind == "sqlite":
+        backend = SQLiteBackend(path, max_entries=max_entries)
+    elif not kind or kind == "off":
+        return None
+    else:
+        raise ValueError(f"Unknown response cache: {kind}")
+    return CompletionCache(backend, ttl=ttl, allow_sampled=allow_sampled)
@@ -0,0 +1,197 @@
+import bisect
+import logging
+import threading
+import time
+from collections import Counter
+
+# Approximate list price in USD per million input tokens, used only to order models from cheapest
+MODEL_COSTS = {
+    "open-mistral-7b": 0.25,
+    "open-mixtral-8x7b": 0.7,
+    "mistral-small-latest": 1.0,
+    "codestral-latest": 1.0,
+    "open-mixtral-8x22b": 2.0,
+    "mistral-medium-latest": 2.7,
+    "mistral-large-latest": 4.0,
+}
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, float("inf"))
+DEFAULT_LATENCY_WINDOW = 300.0
+DEFAULT_LATENCY_THRESHOLD = 8.0
+# Observations needed in the window before a model can be judged slow
+DEFAULT_MIN_SAMPLES = 20
+
+logger = logging.getLogger("chatbot.router")
+
+
+def parse_rate_limits(value):
+    """Parse "model=requests per minute,..." into a dictionary of per-model limits."""
+    limits = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            model, limit = item.split("=", 1)
+            limits[model.strip()] = float(limit)
+    return limits
+
+
+class LatencyHistogram:
+    """
+    Latencies of the last window seconds, counted in fixed buckets.
+
+    The window is split into slices that are recycled as time moves on, so
+    recording and reading a percentile take constant time and memory.
+    """
+
+    def __init__(self, window=DEFAULT_LATENCY_WINDOW, slices=10, buckets=LATENCY_BUCKETS, clock=time.monotonic):
+        self.slice_seconds = window / slices
+        self.buckets = buckets
+        self.clock = clock
+        self._slices = [[None, [0] * len(buckets)] for _ in range(slices)]
+        self._lock = threading.Lock()
+
+    def _current(self):
+        index = int(self.clock() // self.slice_seconds)
+        entry = self._slices[index % len(self._slices)]
+        if entry[0] != index:
+            entry[0] = index
+            entry[1] = [0] * len(self.buckets)
+        return index, entry[1]
+
+    def observe(self, seconds):
+        with self._lock:
+            counts = self._current()[1]
+            counts[bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def counts(self):
+        """Observations per bucket over the window."""
+        with self._lock:
+            index = self._current()[0]
+            total = [0] * len(self.buckets)
+            for slice_index, counts in self._slices:
+                if slice_index is not None and index - slice_index < len(self._slices):
+                    total = [a + b for a, b in zip(total, counts)]
+            return total
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of observations, or None without any."""
+        counts = self.counts()
+        total = sum(counts)
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= fraction * total:
+                return bound
+        return self.buckets[-1]
+
+
+class TokenBucket:
+    """Allow rate requests per second on average, in bursts of up to capacity."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self.tokens >= 1
+
+    def acquire(self):
+        with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class ModelRouter:
+    """
+    Pick the model for each request.
+
+    The user's preferred model is used when it fits the conversation and is
+    healthy. Otherwise, or without a preference, the cheapest model that fits and
+    is healthy is used. A model is unhealthy while its circuit is open, its p95
+    latency is over latency_threshold, or its rate limit is used up.
+    """
+
+    def __init__(self, models, context_windows, costs=MODEL_COSTS, breaker=None,
+                 latency_threshold=DEFAULT_LATENCY_THRESHOLD, min_samples=DEFAULT_MIN_SAMPLES,
+                 latency_window=DEFAULT_LATENCY_WINDOW, rate_limits=None, clock=time.monotonic):
+        self.models = list(models)
+        self.context_windows = context_windows
+        self.costs = costs
+        # Called with a model name, returns its CircuitBreaker, e.g. ResilientClient.breaker
+        self.breaker = breaker
+        self.latency_threshold = latency_threshold
+        self.min_samples = min_samples
+        self.latency_window = latency_window
+        self.clock = clock
+        self.latency = {model: LatencyHistogram(latency_window, clock=clock) for model in self.models}
+        self.limits = {model: TokenBucket(limit / 60, max(1.0, limit / 60 * 10), clock=clock)
+                       for model, limit in (rate_limits or {}).items()}
+        # Requests routed per (model, reason), for logs and metrics
+        self.decisions = Counter()
+        self._lock = threading.Lock()
+
+    def observe(self, model, seconds):
+        """Record how long the model took to start answering."""
+        if model not in self.latency:
+            self.latency[model] = LatencyHistogram(self.latency_window, clock=self.clock)
+        self.latency[model].observe(seconds)
+
+    def unavailable(self, model):
+        """Why the model should be skipped right now, or None when it can take a request."""
+        if self.breaker is not None and self.breaker(model).state == "open":
+            return "circuit open"
+        histogram = self.latency.get(model)
+        if histogram is not None and sum(histogram.counts()) >= self.min_samples:
+            p95 = histogram.percentile(0.95)
+            if p95 > self.latency_threshold:
+                return f"p95 latency {p95}s"
+        if model in self.limits and not self.limits[model].available():
+            return "rate limited"
+        return None
+
+    def choose(self, tokens, preferred=None):
+        """Return the model to send a request of about tokens tokens to."""
+        fits = [model for model in self.models if tokens <= self.context_windows.get(model, 0)]
+        if not fits:
+            # Nothing holds the whole conversation, the largest window keeps the most of it
+            fits = [max(self.models, key=lambda model: self.context_windows.get(model, 0))]
+        candidates = sorted(fits, key=lambda model: self.costs.get(model, float("inf")))
+        if preferred in fits:
+            candidates.remove(preferred)
+            candidates.insert(0, preferred)
+
+        # A preferred model too small for the conversation is passed over like an unhealthy one
+        skipped = [f"{preferred}: context window"] if preferred is not None and preferred not in fits else []
+        with self._lock:
+            for model in candidates:
+                reason = self.unavailable(model)
+                if reason is None and (model not in self.limits or self.limits[model].acquire()):
+                    decision = "preferred" if model == preferred else "fallback" if skipped else "cheapest"
+                    break
+                skipped.append(f"{model}: {reason or 'rate limited'}")
+            else:
+                # Every candidate is unhealthy, send it to the first and let it fail fast
+                model = candidates[0]
+                decision = "unhealthy"
+
+        self.decisions[(model, decision)] += 1
+        if skipped:
+            logger.info("Routed %d tokens to %s (%s), skipped %s", tokens, model, decision, ", ".join(skipped))
+        else:
+            logger.debug("Routed %d tokens to %s (%s)", tokens, model, decision)
+        return model
@@ -0,0 +1,67 @@
+"""
+Full-text search over a user's messages.
+
+Migrations index the messages already stored when the MessagesSearch table is
+created and triggers keep it current afterwards. "python search.py --backfill
+[database]" rebuilds the index from scratch.
+"""
+import argparse
+import re
+import sqlite3
+import time
+
+from markupsafe import Markup, escape
+
+DEFAULT_LIMIT = 20
+# Words of context around the matched terms in each snippet
+SNIPPET_TOKENS = 12
+# Control characters mark matches in snippets, they cannot appear in the escaped text around them
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+
+def fts_query(text, user_id):
+    """
+    Turn free text into an FTS5 query for one user's messages containing every word, the last one as a prefix.
+
+    Words are quoted so that FTS5 operators typed by the user are searched for literally.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return f'user_id : "{int(user_id)}" AND message_text : ({" ".join(terms)})'
+
+
+def highlight(snippet):
+    """Escape a snippet for HTML and turn the match markers into <mark> tags."""
+    return Markup(str(escape(snippet)).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>"))
+
+
+def backfill(path):
+    """Rebuild the search index from every row in Messages and return how long it took."""
+    conn = sqlite3.connect(path)
+    try:
+        start = time.perf_counter()
+        conn.execute("INSERT INTO MessagesSearch (MessagesSearch) VALUES ('rebuild')")
+        conn.execute("INSERT INTO MessagesSearch (MessagesSearch) VALUES ('optimize')")
+        conn.commit()
+        return time.perf_counter() - start
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the full-text search index over chat messages")
+    parser.add_argument("database", nargs="?", default="chat.db", help="SQLite database. Defaults to %(default)s")
+    parser.add_argument("--backfill", action="store_true", help="Rebuild the index from every message in the database")
+    args = parser.parse_args()
+
+    if args.backfill:
+        from migrations import migrate
+
+        migrate(args.database)
+        print(f"Indexed messages in {backfill(args.database):.1f}s")
+    else:
+        parser.print_help()
@@ -0,0 +1,171 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_DIMENSIONS = 512
+DEFAULT_THRESHOLD = 0.92
+DEFAULT_MAX_ENTRIES = 5000
+# Write the cache to disk after this many new entries
+SAVE_EVERY = 50
+
+logger = logging.getLogger("chatbot.semantic_cache")
+
+
+def scope_id(model, system_message):
+    """64-bit id of the (model, system message) pair an answer is valid for."""
+    digest = hashlib.blake2b(f"{model}\0{system_message or ''}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+class HashingEmbedder:
+    """
+    Deterministic local embedding: hashed word unigrams and bigrams, L2 normalized.
+
+    Needs no model or network, which makes it suitable for tests and as a cheap default.
+    """
+
+    def __init__(self, dimensions=DEFAULT_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def _bucket(self, feature):
+        value = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+        return value % self.dimensions, 1.0 if value >> 63 else -1.0
+
+    def __call__(self, text):
+        words = re.findall(r"\w+", text.lower())
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            index, sign = self._bucket(feature)
+            vector[index] += sign
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class MistralEmbedder:
+    """Embed prompts with the Mistral embeddings endpoint."""
+
+    def __init__(self, client, model="mistral-embed"):
+        self.client = client
+        self.model = model
+
+    def __call__(self, text):
+        response = self.client.embeddings(model=self.model, input=[text])
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class SemanticCache:
+    """
+    Answers to past prompts, found again by cosine similarity of prompt embeddings.
+
+    Embeddings live in one preallocated float32 matrix so a lookup is a single
+    matrix-vector product. When full, the least recently used row is overwritten.
+    """
+
+    def __init__(self, embed, dimensions, threshold=DEFAULT_THRESHOLD, max_entries=DEFAULT_MAX_ENTRIES, path=None):
+        self.embed = embed
+        self.dimensions = dimensions
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._vectors = np.zeros((max_entries, dimensions), dtype=np.float32)
+        self._scopes = np.zeros(max_entries, dtype=np.int64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._prompts = [""] * max_entries
+        self._answers = [""] * max_entries
+        self._count = 0
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return self._count
+
+    def lookup(self, model, system_message, prompt):
+        """Return the stored answer to the most similar prompt in the same scope, or None."""
+        vector = self.embed(prompt)
+        scope = scope_id(model, system_message)
+        with self._lock:
+            if not self._count:
+                self.misses += 1
+                return None
+            similarities = self._vectors[:self._count] @ vector
+            similarities[self._scopes[:self._count] != scope] = -1.0
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self._last_used[best] = time.time()
+            self.hits += 1
+            return self._answers[best]
+
+    def add(self, model, system_message, prompt, answer):
+        if not answer:
+            return
+        vector = self.embed(prompt)
+        with self._lock:
+            if self._count < self.max_entries:
+                row = self._count
+                self._count += 1
+            else:
+                row = int(np.argmin(self._last_used))
+            self._vectors[row] = vector
+            self._scopes[row] = scope_id(model, system_message)
+            self._last_used[row] = time.time()
+            self._prompts[row] = prompt
+            self._answers[row] = answer
+            self._unsaved += 1
+            save = self.path and self._unsaved >= SAVE_EVERY
+        if save:
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            count = self._count
+            arrays = {
+                "vectors": self._vectors[:count].copy(),
+                "scopes": self._scopes[:count].copy(),
+                "last_used": self._last_used[:count].copy(),
+                "prompts": np.array(self._prompts[:count], dtype=str),
+                "answers": np.array(self._answers[:count], dtype=str),
+            }
+            self._unsaved = 0
+        # Write to a temporary file and rename it so a crash never leaves a half-written cache
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temporary = tempfile.mkstemp(dir=directory, suffix=".npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(temporary, self.path)
+
+    def load(self):
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                vectors = data["vectors"]
+                if vectors.shape[1] != self.dimensions:
+                    logger.warning("Ignoring semantic cache %s with %d dimensions", self.path, vectors.shape[1])
+                    return
+                # Keep the most recently used entries when the cache has shrunk
+                keep = np.argsort(data["last_used"])[::-1][:self.max_entries]
+                count = len(keep)
+                self._vectors[:count] = vectors[keep]
+                self._scopes[:count] = data["scopes"][keep]
+                self._last_used[:count] = data["last_used"][keep]
+                prompts, answers = data["prompts"], data["answers"]
+                for row, index in enumerate(keep):
+                    self._prompts[row] = str(prompts[index])
+                    self._answers[row] = str(answers[index])
+                self._count = count
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning("Could not load semantic cache %s: %s", self.path, e)
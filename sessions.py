@@ -0,0 +1,184 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from storage import open_database
+
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 100000
+# The SQLite store deletes expired sessions and gives their pages back to the file once every this many writes
+PURGE_EVERY = 1000
+# Pages handed back to the file system per purge
+VACUUM_PAGES = 1000
+
+serializer = TaggedJSONSerializer()
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data kept on the server, the cookie only carries its random id."""
+
+    def __init__(self, initial=None, sid=None, expires_at=None, cookie_sid=None, stored=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        # The id the browser sent, the cookie is only set again when it changes or the expiry moves
+        self.cookie_sid = cookie_sid
+        self.expires_at = expires_at
+        # The data as it was loaded, routes often set a key to the value it already has
+        self.stored = stored
+        self.modified = False
+        # Set when the session is cleared, e.g. on login and logout, so it continues under a new id
+        self.rotate = False
+
+    def clear(self):
+        super().clear()
+        self.rotate = True
+
+
+class MemorySessionStore:
+    """LRU dictionary of sessions with expiry, for a single worker process."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, clock=time.time):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            if entry[1] < self.clock():
+                del self._entries[sid]
+                return None
+            self._entries.move_to_end(sid)
+            return entry
+
+    def put(self, sid, data, expires_at):
+        with self._lock:
+            self._entries[sid] = (data, expires_at)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteSessionStore:
+    """Sessions in an SQLite table shared by every worker process on the host, expired ones purged as it goes."""
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        # auto_vacuum only takes effect on a new file: freed pages can then be given back without a full VACUUM
+        self.db = open_database(path, pragmas=["PRAGMA auto_vacuum=INCREMENTAL"])
+        self._writes = 0
+        self.db.execute("""CREATE TABLE IF NOT EXISTS Sessions (
+                               session_id TEXT PRIMARY KEY,
+                               data TEXT,
+                               expires_at REAL
+                           ) WITHOUT ROWID;""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON Sessions (expires_at);")
+
+    def get(self, sid):
+        rows = self.db.execute("SELECT data, expires_at FROM Sessions WHERE session_id = ? AND expires_at >= ?",
+                               sid, self.clock())
+        return (rows[0]["data"], rows[0]["expires_at"]) if rows else None
+
+    def put(self, sid, data, expires_at):
+        self.db.execute("INSERT OR REPLACE INTO Sessions (session_id, data, expires_at) VALUES (?, ?, ?)",
+                        sid, data, expires_at)
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            self.purge()
+
+    def delete(self, sid):
+        self.db.execute("DELETE FROM Sessions WHERE session_id = ?", sid)
+
+    def purge(self):
+        """Delete expired sessions through the expiry index and return some of the freed pages to the disk."""
+        deleted = self.db.execute("DELETE FROM Sessions WHERE expires_at < ?", self.clock())
+        with self.db.connection() as conn:
+            # executescript() runs the pragma to completion, execute() would only free its first page
+            conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+        return deleted
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) AS sessions FROM Sessions")[0]["sessions"]
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Flask session interface over a session store.
+
+    Sessions without data are never stored, so visitors who do not log in cost
+    nothing. Expiry slides with use, but an unchanged session is only written
+    back once less than half of its TTL is left, so most requests only read.
+    Clearing a session, as login and logout do, moves it to a new id.
+    """
+
+    def __init__(self, store, ttl=DEFAULT_TTL):
+        self.store = store
+        self.ttl = ttl
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            entry = self.store.get(sid)
+            if entry is not None:
+                data, expires_at = entry
+                try:
+                    return ServerSession(serializer.loads(data), sid=sid, expires_at=expires_at, cookie_sid=sid,
+                                         stored=data)
+                except ValueError:
+                    pass
+        return ServerSession(cookie_sid=sid)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        now = time.time()
+
+        if session.sid is not None and (session.rotate or not session):
+            self.store.delete(session.sid)
+            session.sid = None
+        if not session:
+            if session.cookie_sid:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        data = serializer.dumps(dict(session))
+        stale = session.expires_at is None or session.expires_at - now < self.ttl / 2
+        if session.sid is not None and data == session.stored and not stale:
+            return
+        session.sid = session.sid or secrets.token_urlsafe(32)
+        self.store.put(session.sid, data, now + self.ttl)
+        if session.sid != session.cookie_sid or session.permanent:
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+
+def open_session_interface(kind, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+    """Build a session interface for kind "memory" or "sqlite"."""
+    if kind == "memory":
+        store = MemorySessionStore(max_entries=max_entries)
+    elif kind == "sqlite":
+        store = SQLiteSessionStore(path)
+    else:
+        raise ValueError(f"Unknown session store: {kind}")
+    return ServerSessionInterface(store, ttl=ttl)
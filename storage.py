@@ -0,0 +1,205 @@
+import logging
+import queue
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
+from metrics import DB_QUERY_SECONDS
+
+DEFAULT_POOL_SIZE = 8
+# Seconds a thread waits for a pooled connection when all of them are in use
+DEFAULT_POOL_TIMEOUT = 10
+DEFAULT_BUSY_TIMEOUT = 5000
+# Rows iterate() fetches per round trip
+DEFAULT_CHUNK_SIZE = 1000
+# Prepared statements kept per connection, comfortably more than the queries the app issues
+STATEMENT_CACHE_SIZE = 256
+
+# Applied to every new connection. WAL lets readers run alongside a writer, and with WAL
+# synchronous=NORMAL only risks the last transactions on power loss, never corruption.
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA foreign_keys=ON",
+    f"PRAGMA busy_timeout={DEFAULT_BUSY_TIMEOUT}",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+]
+
+logger = logging.getLogger("chatbot.storage")
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+class PoolTimeout(RuntimeError):
+    """Raised when no pooled connection came free within the pool timeout, the database is overloaded."""
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def statement_kind(sql):
+    """Return the leading SQL keyword, e.g. SELECT or INSERT, cached per statement text."""
+    match = re.match(r"\s*(\w+)", sql)
+    return match.group(1).upper() if match else ""
+
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def statement_name(sql):
+    """Short label for a statement's metrics, its keyword and the table it works on, e.g. "SELECT Chats"."""
+    table = re.search(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+(\w+)", sql, re.IGNORECASE)
+    return f"{statement_kind(sql)} {table.group(1)}" if table else statement_kind(sql)
+
+
+class Database:
+    """
+    A thread-safe pool of tuned SQLite connections.
+
+    execute() mirrors the cs50 SQL wrapper the app used before: SELECT returns
+    a list of dicts, INSERT returns the new row id and UPDATE/DELETE return the
+    number of affected rows.
+    """
+
+    def __init__(self, path, pool_size=DEFAULT_POOL_SIZE, pool_timeout=DEFAULT_POOL_TIMEOUT, pragmas=()):
+        self.path = path
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        # Run before PRAGMAS, for settings such as auto_vacuum that must precede journal_mode=WAL
+        self.pragmas = list(pragmas) + PRAGMAS
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.pool_size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except sqlite3.Error:
+                    self._created -= 1
+                    raise
+        try:
+            return self._pool.get(timeout=self.pool_timeout)
+        except queue.Empty:
+            raise PoolTimeout(f"No connection to {self.path} came free within {self.pool_timeout}s") from None
+
+    def _release(self, conn):
+        self._pool.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Yield this thread's transaction connection, or borrow one from the pool."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Run every execute() on this thread inside one transaction, committing on success."""
+        if getattr(self._local, "conn", None) is not None:
+            # Nested transactions join the outer one
+            yield self
+            return
+        conn = self._acquire()
+        self._local.conn = conn
+        self._local.after_commit = callbacks = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            self._local.conn = None
+            self._local.after_commit = None
+            self._release(conn)
+        for callback in callbacks:
+            callback()
+
+    def after_commit(self, callback):
+        """Call callback once this thread's transaction commits, or right away outside one. A rollback drops it."""
+        if getattr(self._local, "conn", None) is None:
+            callback()
+        else:
+            self._local.after_commit.append(callback)
+
+    def execute(self, sql, *args):
+        kind = statement_kind(sql)
+        with self.connection() as conn, DB_QUERY_SECONDS.time(statement=statement_name(sql)):
+            cursor = conn.execute(sql, args)
+            if kind == "INSERT":
+                return cursor.lastrowid
+            if kind in ("UPDATE", "DELETE"):
+                return cursor.rowcount
+            return [dict(row) for row in cursor.fetchall()]
+
+    def iterate(self, sql, *args, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Yield the rows of a SELECT as dicts, fetching chunk_size at a time, so a large result
+        never sits in memory at once.
+
+        The connection is held until the generator is exhausted or closed, which for a download
+        is as long as the client takes. Outside a transaction it is therefore a connection of its
+        own, opened outside the pool, so slow readers never leave other requests waiting.
+        """
+        conn = getattr(self._local, "conn", None)
+        dedicated = conn is None
+        if dedicated:
+            conn = self._connect()
+        try:
+            with DB_QUERY_SECONDS.time(statement=statement_name(sql)):
+                cursor = conn.execute(sql, args)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield dict(row)
+        finally:
+            if dedicated:
+                conn.close()
+
+    def executemany(self, sql, rows):
+        with self.connection() as conn, DB_QUERY_SECONDS.time(statement=statement_name(sql)):
+            return conn.executemany(sql, rows).rowcount
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
+
+
+def open_database(path, pool_size=DEFAULT_POOL_SIZE, pool_timeout=DEFAULT_POOL_TIMEOUT, pragmas=()):
+    """Return the shared Database for path, creating it on first use."""
+    with _databases_lock:
+        if path not in _databases:
+            _databases[path] = Database(path, pool_size=pool_size, pool_timeout=pool_timeout, pragmas=pragmas)
+        return _databases[path]
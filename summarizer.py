@@ -0,0 +1,99 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from mistralai.models.chat_completion import ChatMessage
+
+# Newest stored messages that are always sent verbatim rather than summarized
+DEFAULT_RECENT_MESSAGES = 20
+# Messages beyond the recent tail that accumulate before the summary is refreshed
+DEFAULT_REFRESH_AFTER = 20
+SUMMARY_INSTRUCTIONS = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Rewrite the summary so that it also covers the new messages. Keep names, facts, decisions "
+    "and open questions, drop pleasantries, and answer with the summary only."
+)
+
+logger = logging.getLogger("chatbot.summarizer")
+
+
+class ConversationSummarizer:
+    """
+    Condense older turns of long chats into a stored rolling summary.
+
+    Refreshes run on a background thread and only send the previous summary
+    plus the messages that arrived since, so each refresh costs about the same
+    however long the chat is.
+    """
+
+    def __init__(self, client, db, model, recent_messages=DEFAULT_RECENT_MESSAGES,
+                 refresh_after=DEFAULT_REFRESH_AFTER, max_workers=1):
+        self.client = client
+        self.db = db
+        self.model = model
+        self.recent_messages = recent_messages
+        self.refresh_after = refresh_after
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summarizer")
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def needs_refresh(self, conversation):
+        unsummarized = conversation.persisted - conversation.bot.summary_covers
+        return unsummarized >= self.recent_messages + self.refresh_after
+
+    def schedule(self, conversation, chat_id, user_id):
+        """Queue a refresh for the conversation if enough new turns have been stored since the last one."""
+        if not self.needs_refresh(conversation):
+            return None
+        key = (user_id, chat_id)
+        with self._lock:
+            if key in self._pending:
+                return None
+            self._pending.add(key)
+        return self.executor.submit(self._run, key, conversation, chat_id, user_id)
+
+    def _run(self, key, conversation, chat_id, user_id):
+        try:
+            self.refresh(conversation, chat_id, user_id)
+        except Exception:
+            logger.exception("Summarizing chat_id: %s failed", chat_id)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def refresh(self, conversation, chat_id, user_id):
+        """Fold the stored messages older than the recent tail into the chat's summary."""
+        with conversation.lock:
+            bot = conversation.bot
+            messages = bot.messages
+            covers = bot.summary_covers
+            cut = conversation.persisted - self.recent_messages
+            if cut <= covers:
+                return False
+            previous = bot.summary
+            new_messages = messages[covers:cut]
+            through_message_id = conversation.message_ids[cut - 1]
+
+        # The upstream call happens without holding the conversation, new turns can keep arriving meanwhile
+        summary = self.summarize(previous, new_messages)
+        self.db.save_summary(chat_id, user_id, summary, through_message_id)
+
+        with conversation.lock:
+            # Skip if the chat was reset or another refresh got there first
+            if bot.messages is messages and bot.summary_covers == covers:
+                bot.summary = summary
+                bot.summary_covers = cut
+        logger.info("Summarized chat_id: %s through message: %s", chat_id, through_message_id)
+        return True
+
+    def summarize(self, previous, messages):
+        transcript = "\n".join(f"{message.role.upper()}: {message.content}" for message in messages
+                               if message.role != "system")
+        prompt = f"Current summary:\n{previous or '(none)'}\n\nNew messages:\n{transcript}"
+        response = self.client.chat(model=self.model, temperature=0,
+                                    messages=[ChatMessage(role="system", content=SUMMARY_INSTRUCTIONS),
+                                              ChatMessage(role="user", content=prompt)])
+        return response.choices[0].message.content.strip()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
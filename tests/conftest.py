@@ -0,0 +1,101 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+REPLY = ["Hello", " there", " friend"]
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    """
+    Answers chat completions like Mistral, one scripted behaviour per request.
+
+    "ok" answers normally, a status code such as "503" fails, "slow" waits before
+    answering, "drop" closes the connection and "stall" waits before the last chunk
+    of a stream.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        mode = self.server.script.pop(0) if self.server.script else "ok"
+        self.server.requests += 1
+        # Every response ends its connection, so no client reuses one across event loops
+        self.close_connection = True
+        if mode.isdigit():
+            self.send_body(int(mode), {"message": f"Scripted {mode}"})
+            return
+        if mode == "slow":
+            time.sleep(self.server.delay)
+        if not body.get("stream"):
+            self.send_body(200, {
+                "id": "fake", "object": "chat.completion", "created": 0, "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(REPLY)},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 3, "total_tokens": 4},
+            })
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, token in enumerate(REPLY):
+            if i == len(REPLY) - 1 and mode == "drop":
+                self.connection.shutdown(2)
+                return
+            if i == len(REPLY) - 1 and mode == "stall":
+                time.sleep(self.server.delay)
+            self.write_chunk("data: " + json.dumps({
+                "id": "fake", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                "choices": [{"index": 0, "delta": {"role": "assistant", "content": token}, "finish_reason": None}],
+            }) + "\n\n")
+        self.write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_body(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+class UpstreamServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that time out hang up halfway through a response, which is what those tests are after
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+@pytest.fixture
+def upstream():
+    """A local fake Mistral server; append behaviours to upstream.script and read upstream.requests."""
+    server = UpstreamServer(("127.0.0.1", 0), UpstreamHandler)
+    server.script = []
+    server.requests = 0
+    server.delay = 0.5
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from mistralai.models.chat_completion import ChatMessage
+
+from async_engine import AsyncInferenceEngine, FairScheduler, holding
+from conversations import ConversationStore
+from response_cache import CompletionCache, MemoryBackend
+
+MESSAGES = [ChatMessage(role="user", content="Hi")]
+
+
+class StubAsyncClient:
+    def __init__(self):
+        self.requests = 0
+
+    async def chat_stream(self, model, temperature, messages):
+        self.requests += 1
+        for text in ("Hello", " there"):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+class ThreadRecordingBackend(MemoryBackend):
+    """Remembers the thread each cache call ran on."""
+
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def get(self, key):
+        self.threads.append(threading.get_ident())
+        return super().get(key)
+
+    def put(self, key, response, ttl):
+        self.threads.append(threading.get_ident())
+        super().put(key, response, ttl)
+
+
+def collect(engine):
+    async def stream():
+        return "".join([delta async for delta in engine.stream("open-mistral-7b", 0, MESSAGES)])
+    return asyncio.run(stream())
+
+
+def test_cache_is_used_off_the_event_loop():
+    backend = ThreadRecordingBackend()
+    client = StubAsyncClient()
+    engine = AsyncInferenceEngine(client, cache=CompletionCache(backend))
+    assert collect(engine) == "Hello there"
+    assert collect(engine) == "Hello there"
+    # get and put on the miss, get on the hit, none of them on this thread, which ran the loop
+    assert len(backend.threads) == 3
+    assert threading.get_ident() not in backend.threads
+    assert client.requests == 1
+
+
+def test_fair_scheduler_takes_turns_between_users():
+    async def run():
+        scheduler = FairScheduler(1)
+        order = []
+        await scheduler.acquire("busy")
+
+        async def request(user_id, n):
+            await scheduler.acquire(user_id)
+            order.append(f"{user_id}{n}")
+            scheduler.release()
+
+        tasks = [asyncio.create_task(request("busy", n)) for n in range(3)]
+        tasks.append(asyncio.create_task(request("quiet", 0)))
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["busy0", "quiet0", "busy1", "busy2"]
+
+
+def test_turn_lock_is_shared_with_threads():
+    conversations = ConversationStore(lambda: None)
+    lock = conversations.turn_lock(1, 2)
+    assert conversations.turn_lock(1, 2) is lock
+    events = []
+
+    def sync_turn(started):
+        with conversations.turn_lock(1, 2):
+            started.set()
+            events.append("sync start")
+            threading.Event().wait(0.2)
+            events.append("sync end")
+
+    async def run():
+        started = threading.Event()
+        thread = threading.Thread(target=sync_turn, args=(started,))
+        thread.start()
+        await asyncio.to_thread(started.wait)
+        async with holding(lock):
+            events.append("async")
+        thread.join()
+
+    asyncio.run(run())
+    assert events == ["sync start", "sync end", "async"]
+    assert not lock.locked()
@@ -0,0 +1,80 @@
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from batch import BatchRunner
+
+
+class StubClient:
+    """Answers with the last message, uppercased, and fails prompts listed in fail."""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def chat(self, model, temperature, messages):
+        with self.lock:
+            self.requests.append((model, [(message.role, message.content) for message in messages]))
+        prompt = messages[-1].content
+        if prompt in self.fail:
+            raise RuntimeError(f"Cannot answer {prompt}")
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=prompt.upper()))],
+                               usage=SimpleNamespace(prompt_tokens=len(messages), completion_tokens=1))
+
+
+@pytest.fixture
+def prompts(tmp_path):
+    path = tmp_path / "prompts.jsonl"
+    records = [{"id": f"p{i}", "prompt": f"prompt {i}"} for i in range(20)]
+    records.append({"id": "chat", "messages": [{"role": "user", "content": "hi"},
+                                               {"role": "assistant", "content": "hello"},
+                                               {"role": "user", "content": "bye"}], "model": "other-model"})
+    records.append({"id": "none"})
+    path.write_text("".join(json.dumps(record) + "\n" for record in records) + "\n", encoding="utf-8")
+    return str(path)
+
+
+def results(path):
+    """The last result written for each id, past any line a crash cut short."""
+    written = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            written[record["id"]] = record
+    return written
+
+
+def test_batch_run(prompts, tmp_path):
+    output = str(tmp_path / "results.jsonl")
+    client = StubClient(fail={"prompt 3"})
+    stats = BatchRunner(client, "open-mistral-7b", 0, system_message="Be brief", concurrency=2).run(prompts, output)
+    assert (stats["succeeded"], stats["failed"], stats["skipped"]) == (20, 1, 0)
+    assert (stats["prompt_tokens"], stats["completion_tokens"]) == (19 * 2 + 3, 20)
+    written = results(output)
+    assert len(written) == 21
+    assert written["p0"]["response"] == "PROMPT 0" and written["p0"]["error"] is None
+    assert written["p3"]["response"] is None and "prompt 3" in written["p3"]["error"]
+    assert (written["chat"]["model"], written["chat"]["response"]) == ("other-model", "BYE")
+    requests = dict((messages[-1][1], (model, messages)) for model, messages in client.requests)
+    assert requests["prompt 0"] == ("open-mistral-7b", [("system", "Be brief"), ("user", "prompt 0")])
+    assert requests["bye"][0] == "other-model" and len(requests["bye"][1]) == 3
+
+
+def test_batch_run_resumes(prompts, tmp_path):
+    output = tmp_path / "results.jsonl"
+    BatchRunner(StubClient(fail={"prompt 3"}), "open-mistral-7b", 0).run(prompts, str(output))
+    # A crash in the middle of writing a line
+    with open(output, "a", encoding="utf-8") as f:
+        f.write('{"id": "p4", "resp')
+    client = StubClient()
+    stats = BatchRunner(client, "open-mistral-7b", 0).run(prompts, str(output))
+    # Only the failed prompt is asked again
+    assert [messages[-1][1] for _, messages in client.requests] == ["prompt 3"]
+    assert (stats["succeeded"], stats["failed"], stats["skipped"]) == (1, 0, 20)
+    assert results(output)["p3"]["response"] == "PROMPT 3"
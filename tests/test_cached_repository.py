@@ -0,0 +1,111 @@
+import threading
+
+import pytest
+from mistralai.models.chat_completion import ChatMessage
+
+import storage
+from repositories import CachedRepository, SQLiteRepository
+
+
+@pytest.fixture
+def sqlite_repository(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "chat.db"))
+    yield repository
+    repository.close()
+
+
+@pytest.fixture
+def statements(sqlite_repository, monkeypatch):
+    """Every statement run against the repository's database."""
+    statements = []
+    execute = storage.Database.execute
+
+    def counting_execute(self, sql, *args):
+        if self is sqlite_repository.db:
+            statements.append(sql)
+        return execute(self, sql, *args)
+
+    monkeypatch.setattr(storage.Database, "execute", counting_execute)
+    return statements
+
+
+def chat_page(repository, user_id, chat_id):
+    """The reads /chat/<chat_id> makes."""
+    user = repository.get_user(user_id)
+    chats, _ = repository.page_chats(user_id)
+    assert user and repository.chat_exists(chat_id, user_id)
+    messages, _ = repository.page_messages(chat_id, user_id)
+    return chats, messages
+
+
+def seed(repository):
+    user_id = repository.create_user("alice", "hash")
+    chat_id = repository.create_chat(user_id, "Chat")
+    repository.append_messages(chat_id, user_id, [ChatMessage(role="user", content="Hi"),
+                                                  ChatMessage(role="assistant", content="Hello")])
+    return user_id, chat_id
+
+
+def test_chat_page_queries_without_cache(sqlite_repository, statements):
+    user_id, chat_id = seed(sqlite_repository)
+    for _ in range(2):
+        statements.clear()
+        chat_page(sqlite_repository, user_id, chat_id)
+        assert len(statements) == 4
+
+
+def test_warm_chat_page_only_reads_messages(sqlite_repository, statements):
+    repository = CachedRepository(sqlite_repository)
+    user_id, chat_id = seed(repository)
+    statements.clear()
+    chat_page(repository, user_id, chat_id)
+    assert len(statements) == 4
+    statements.clear()
+    _, messages = chat_page(repository, user_id, chat_id)
+    assert len(statements) == 1
+    assert [message["message_text"] for message in messages] == ["Hi", "Hello"]
+
+
+def test_writes_show_up_on_the_next_read(sqlite_repository):
+    repository = CachedRepository(sqlite_repository)
+    user_id, chat_id = seed(repository)
+    chat_page(repository, user_id, chat_id)
+    new_id = repository.create_chat(user_id, "New")
+    assert [chat["chat_id"] for chat in repository.page_chats(user_id)[0]] == [new_id, chat_id]
+    assert repository.latest_chat_id(user_id) == new_id
+    repository.append_messages(chat_id, user_id, [ChatMessage(role="user", content="Renamed")], chat_name="Renamed")
+    assert [chat["chat_name"] for chat in repository.page_chats(user_id)[0]] == ["New", "Renamed"]
+    repository.delete_chat(new_id, user_id)
+    assert not repository.chat_exists(new_id, user_id)
+    assert repository.latest_chat_id(user_id) == chat_id
+
+
+def test_cache_is_dropped_after_commit(sqlite_repository):
+    repository = CachedRepository(sqlite_repository)
+    user_id, chat_id = seed(repository)
+
+    def read_chats():
+        # Another request, it sees what was committed before the transaction
+        chats.extend(chat["chat_name"] for chat in repository.page_chats(user_id)[0])
+
+    chats = []
+    with repository.transaction():
+        repository.append_messages(chat_id, user_id, [ChatMessage(role="user", content="Hi")], chat_name="Renamed")
+        reader = threading.Thread(target=read_chats)
+        reader.start()
+        reader.join()
+    assert chats == ["Chat"]
+    assert [chat["chat_name"] for chat in repository.page_chats(user_id)[0]] == ["Renamed"]
+
+
+def test_rollback_keeps_cache(sqlite_repository, statements):
+    repository = CachedRepository(sqlite_repository)
+    user_id, chat_id = seed(repository)
+    repository.page_chats(user_id)
+    with pytest.raises(RuntimeError):
+        with repository.transaction():
+            repository.create_chat(user_id, "Never")
+            raise RuntimeError
+    statements.clear()
+    assert [chat["chat_id"] for chat in repository.page_chats(user_id)[0]] == [chat_id]
+    assert statements == []
@@ -0,0 +1,87 @@
+from types import SimpleNamespace
+
+import pytest
+
+from chatbot import ChatBot
+from conversations import Conversation
+from persistence import load_history, persist_new_messages
+from repositories import SQLiteRepository
+from writebehind import open_writer
+
+
+class StubClient:
+    """Streams a reply naming the last message, so every turn stores distinct text."""
+
+    def chat_stream(self, model, temperature, messages):
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=f"re: {messages[-1].content}"))])
+
+
+@pytest.fixture
+def repository(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "chat.db"))
+    yield repository
+    repository.close()
+
+
+@pytest.fixture(params=["direct", "write-behind"])
+def writer(request, repository, tmp_path):
+    if request.param == "direct":
+        yield None
+        return
+    writer = open_writer(repository, str(tmp_path / "writebehind.journal"), fsync=False)
+    yield writer
+    writer.close()
+
+
+@pytest.fixture
+def chat(repository):
+    user_id = repository.create_user("alice", "hash")
+    return user_id, repository.create_chat(user_id, "New Chat")
+
+
+def send(repository, writer, conversation, chat, text):
+    """What the chat routes do with a message: run commands, or take a turn and store it."""
+    user_id, chat_id = chat
+    bot = conversation.bot
+    if bot.is_command(text):
+        bot.execute_command(text)
+        return
+    load_history(repository, conversation, chat_id, user_id, writer)
+    "".join(bot.stream_inference(text))
+    persist_new_messages(repository, conversation, chat_id, user_id, writer)
+    if writer is not None:
+        writer.wait(chat_id, user_id)
+
+
+def stored(repository, chat):
+    user_id, chat_id = chat
+    return [(row["role"], row["message_text"]) for row in repository.list_messages(chat_id, user_id)]
+
+
+def test_turns_are_stored_once(repository, writer, chat):
+    conversation = Conversation(ChatBot(None, "open-mistral-7b", client=StubClient()))
+    for text in ("one", "two", "two"):
+        send(repository, writer, conversation, chat, text)
+    assert stored(repository, chat) == [("user", "one"), ("assistant", "re: one"), ("user", "two"),
+                                        ("assistant", "re: two"), ("user", "two"), ("assistant", "re: two")]
+    assert conversation.persisted == 6
+    user_id, chat_id = chat
+    assert conversation.message_ids == [row["message_id"] for row in repository.list_messages(chat_id, user_id)]
+
+
+@pytest.mark.parametrize("command", ["/new", "/system Be brief"])
+def test_turn_after_replacing_messages_is_stored(repository, writer, chat, command):
+    conversation = Conversation(ChatBot(None, "open-mistral-7b", client=StubClient()))
+    for text in ("one", "two", command, "three", "four"):
+        send(repository, writer, conversation, chat, text)
+    assert [text for role, text in stored(repository, chat) if role == "user"] == ["one", "two", "three", "four"]
+    assert conversation.persisted == len(conversation.bot.messages)
+
+
+def test_history_is_loaded_once(repository, writer, chat):
+    send(repository, writer, Conversation(ChatBot(None, "open-mistral-7b", client=StubClient())), chat, "one")
+    # A cold conversation, as after eviction, reads the history before its first turn
+    conversation = Conversation(ChatBot(None, "open-mistral-7b", client=StubClient()))
+    send(repository, writer, conversation, chat, "two")
+    assert [message.content for message in conversation.bot.messages] == ["one", "re: one", "two", "re: two"]
+    assert len(stored(repository, chat)) == 4
@@ -0,0 +1,197 @@
+import os
+import uuid
+
+import pytest
+from mistralai.models.chat_completion import ChatMessage
+
+from maintenance import cutoff
+from repositories import CachedRepository, DuplicateUserError, PostgresRepository, SQLiteRepository
+
+
+@pytest.fixture(params=["sqlite", "cached", "postgres"])
+def repository(request, tmp_path):
+    """Every backend the app can run on. PostgreSQL only runs when DATABASE_URL points at a server."""
+    if request.param == "postgres":
+        if not os.environ.get("DATABASE_URL", "").startswith(("postgres://", "postgresql://")):
+            pytest.skip("DATABASE_URL does not point at a PostgreSQL database")
+        repository = PostgresRepository(os.environ["DATABASE_URL"])
+    else:
+        repository = SQLiteRepository(str(tmp_path / "chat.db"))
+        if request.param == "cached":
+            repository = CachedRepository(repository)
+    yield repository
+    repository.close()
+
+
+@pytest.fixture
+def user_id(repository):
+    # A shared PostgreSQL database keeps rows between runs, every test works on a user of its own
+    return repository.create_user(f"user-{uuid.uuid4().hex}", "hash")
+
+
+def messages(*texts):
+    return [ChatMessage(role="user" if i % 2 == 0 else "assistant", content=text) for i, text in enumerate(texts)]
+
+
+def texts(rows):
+    return [row["message_text"] for row in rows]
+
+
+def test_users(repository, user_id):
+    user = repository.get_user(user_id)
+    assert user["user_id"] == user_id
+    assert repository.get_user_by_username(user["username"])["password_hash"] == "hash"
+    assert repository.get_user_by_username(f"user-{uuid.uuid4().hex}") is None
+    with pytest.raises(DuplicateUserError):
+        repository.create_user(user["username"], "other")
+
+
+def test_chats_belong_to_their_user(repository, user_id):
+    other_id = repository.create_user(f"user-{uuid.uuid4().hex}", "hash")
+    assert repository.latest_chat_id(user_id) is None
+    chat_id = repository.create_chat(user_id, "First")
+    assert repository.chat_exists(chat_id, user_id)
+    assert not repository.chat_exists(chat_id, other_id)
+    assert repository.latest_chat_id(user_id) == chat_id
+    assert [chat["chat_name"] for chat in repository.list_chats(user_id)] == ["First"]
+    assert repository.delete_chat(chat_id, other_id) == 0
+    assert repository.delete_chat(chat_id, user_id) == 1
+    assert not repository.chat_exists(chat_id, user_id)
+    assert repository.list_chats(user_id) == []
+
+
+def test_page_chats(repository, user_id):
+    chat_ids = [repository.create_chat(user_id, f"Chat {i}") for i in range(5)]
+    seen, cursor = [], None
+    while True:
+        page, cursor = repository.page_chats(user_id, cursor, limit=2)
+        assert len(page) <= 2
+        seen.extend(chat["chat_id"] for chat in page)
+        if cursor is None:
+            break
+    # Chats made within the same second are ordered by chat_id, newest first
+    assert seen == chat_ids[::-1]
+    with pytest.raises(ValueError):
+        repository.page_chats(user_id, "not a cursor")
+
+
+def test_append_and_list_messages(repository, user_id):
+    chat_id = repository.create_chat(user_id, "New chat")
+    first = repository.append_messages(chat_id, user_id, messages("Hi", "Hello"), chat_name="Hi")
+    second = repository.append_messages(chat_id, user_id, messages("How are you?"))
+    assert len(first) == 2 and len(second) == 1
+    assert first[0] < first[1] < second[0]
+    rows = repository.list_messages(chat_id, user_id)
+    assert [row["message_id"] for row in rows] == first + second
+    assert texts(rows) == ["Hi", "Hello", "How are you?"]
+    assert [row["role"] for row in rows] == ["user", "assistant", "user"]
+    assert repository.list_chats(user_id)[0]["chat_name"] == "Hi"
+
+
+def test_append_many_messages(repository, user_id):
+    chat_id = repository.create_chat(user_id, "Long chat")
+    # More than one multi-row INSERT
+    message_ids = repository.append_messages(chat_id, user_id, messages(*map(str, range(450))))
+    rows = repository.list_messages(chat_id, user_id)
+    assert [row["message_id"] for row in rows] == message_ids
+    assert texts(rows) == list(map(str, range(450)))
+
+
+def test_turn_stored(repository, user_id):
+    chat_id = repository.create_chat(user_id, "Chat")
+    turn_id = uuid.uuid4().hex
+    assert not repository.turn_stored(turn_id)
+    repository.append_messages(chat_id, user_id, messages("Hi", "Hello"), turn_id=turn_id)
+    assert repository.turn_stored(turn_id)
+    assert texts(repository.list_messages(chat_id, user_id)) == ["Hi", "Hello"]
+
+
+def test_page_messages(repository, user_id):
+    chat_id = repository.create_chat(user_id, "Chat")
+    repository.append_messages(chat_id, user_id, messages(*map(str, range(5))))
+    page, before = repository.page_messages(chat_id, user_id, limit=2)
+    assert texts(page) == ["3", "4"]
+    page, before = repository.page_messages(chat_id, user_id, before, limit=2)
+    assert texts(page) == ["1", "2"]
+    page, before = repository.page_messages(chat_id, user_id, before, limit=2)
+    assert texts(page) == ["0"]
+    assert before is None
+
+
+def test_search_messages(repository, user_id):
+    other_id = repository.create_user(f"user-{uuid.uuid4().hex}", "hash")
+    chat_id = repository.create_chat(user_id, "Trip")
+    other_chat_id = repository.create_chat(other_id, "Trip")
+    repository.append_messages(chat_id, user_id, messages("Pack the umbrella", "And sunscreen"))
+    repository.append_messages(other_chat_id, other_id, messages("Umbrella for me too"))
+    results = repository.search_messages(user_id, "umbrella")
+    assert [(result["chat_id"], result["chat_name"]) for result in results] == [(chat_id, "Trip")]
+    assert "umbrella" in results[0]["snippet"].lower()
+    assert repository.search_messages(user_id, "") == []
+
+
+def test_summaries(repository, user_id):
+    chat_id = repository.create_chat(user_id, "Chat")
+    assert repository.get_summary(chat_id, user_id) is None
+    repository.save_summary(chat_id, user_id, "First", 1)
+    repository.save_summary(chat_id, user_id, "Second", 2)
+    summary = repository.get_summary(chat_id, user_id)
+    assert (summary["summary"], summary["through_message_id"]) == ("Second", 2)
+
+
+def test_export_and_import(repository, user_id):
+    chat_id = repository.create_chat(user_id, "Full")
+    empty_id = repository.create_chat(user_id, "Empty")
+    repository.append_messages(chat_id, user_id, messages("Hi", "Hello"))
+    rows = list(repository.export_chats(user_id, chunk_size=1))
+    assert [(row["chat_id"], row["message_text"]) for row in rows] == [(chat_id, "Hi"), (chat_id, "Hello"),
+                                                                       (empty_id, None)]
+    imported_id = repository.import_chat(user_id, "Imported", rows[0]["chat_created_at"])
+    assert repository.import_messages([(imported_id, user_id, row["message_text"], row["role"], row["created_at"])
+                                       for row in rows[:2]]) == 2
+    assert texts(repository.list_messages(imported_id, user_id)) == ["Hi", "Hello"]
+
+
+def test_archive_and_restore(repository, user_id):
+    chat_id = repository.create_chat(user_id, "Old chat")
+    message_ids = repository.append_messages(chat_id, user_id, messages("Hi", "Hello"))
+    # Every chat is idle as of tomorrow
+    idle = repository.idle_chats(cutoff(-1), 1000000)
+    assert (chat_id, user_id) in [(chat["chat_id"], chat["user_id"]) for chat in idle]
+    assert repository.archive_chat(chat_id, user_id) == 2
+    assert repository.archive_chat(chat_id, user_id) == 0
+    assert chat_id not in [chat["chat_id"] for chat in repository.idle_chats(cutoff(-1), 1000000)]
+    # Exports include archived messages without restoring them
+    assert [row["message_text"] for row in repository.export_chats(user_id)] == ["Hi", "Hello"]
+    # Reading the chat brings it back with the same ids
+    rows = repository.list_messages(chat_id, user_id)
+    assert [row["message_id"] for row in rows] == message_ids
+    assert not repository.restore_chat(chat_id, user_id)
+
+
+def test_append_to_archived_chat(repository, user_id):
+    chat_id = repository.create_chat(user_id, "Chat")
+    repository.append_messages(chat_id, user_id, messages("Hi", "Hello"))
+    repository.archive_chat(chat_id, user_id)
+    repository.append_messages(chat_id, user_id, messages("Still there?"))
+    assert texts(repository.list_messages(chat_id, user_id)) == ["Hi", "Hello", "Still there?"]
+
+
+def test_transaction_rolls_back(repository, user_id):
+    with pytest.raises(RuntimeError):
+        with repository.transaction():
+            repository.create_chat(user_id, "Never")
+            raise RuntimeError
+    assert repository.list_chats(user_id) == []
+
+
+def test_maintenance(repository, user_id):
+    chat_id = repository.create_chat(user_id, "Chat")
+    repository.append_messages(chat_id, user_id, messages(*["x" * 1000] * 100))
+    repository.delete_chat(chat_id, user_id)
+    stats = repository.storage_stats()
+    assert {"page_size", "page_count", "freelist_count", "auto_vacuum"} <= set(stats)
+    repository.reclaim_space()
+    repository.analyze()
+    repository.vacuum()
+    assert repository.storage_stats()["freelist_count"] == 0
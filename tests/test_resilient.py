@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+from mistralai.models.chat_completion import ChatMessage
+
+from resilient import CircuitOpenError, StreamInterrupted, open_async_client, open_client
+
+MODEL = "open-mistral-7b"
+MESSAGES = [ChatMessage(role="user", content="Hi")]
+OPTIONS = {"read_timeout": 0.2, "connect_timeout": 0.2, "base_delay": 0.01, "max_delay": 0.01}
+
+
+class SyncClient:
+    def __init__(self, url, **kwargs):
+        self.client = open_client("key", endpoint=url, **dict(OPTIONS, **kwargs))
+
+    def chat(self):
+        return self.client.chat(MODEL, MESSAGES).choices[0].message.content
+
+    def stream(self, received):
+        for chunk in self.client.chat_stream(MODEL, MESSAGES):
+            received.append(chunk.choices[0].delta.content)
+        return "".join(received)
+
+
+class AsyncClient:
+    def __init__(self, url, **kwargs):
+        self.client = open_async_client("key", endpoint=url, **dict(OPTIONS, **kwargs))
+
+    def chat(self):
+        async def chat():
+            return (await self.client.chat(MODEL, MESSAGES)).choices[0].message.content
+        return asyncio.run(chat())
+
+    def stream(self, received):
+        async def stream():
+            async for chunk in self.client.chat_stream(MODEL, MESSAGES):
+                received.append(chunk.choices[0].delta.content)
+            return "".join(received)
+        return asyncio.run(stream())
+
+
+@pytest.fixture(params=[SyncClient, AsyncClient], ids=["sync", "async"])
+def connect(request, upstream):
+    return lambda **kwargs: request.param(upstream.url, **kwargs)
+
+
+def test_retries_server_errors(connect, upstream):
+    upstream.script += ["503", "429"]
+    assert connect(max_attempts=3).chat() == "Hello there friend"
+    assert upstream.requests == 3
+
+
+def test_gives_up_after_max_attempts(connect, upstream):
+    upstream.script += ["503", "503", "503"]
+    with pytest.raises(Exception):
+        connect(max_attempts=2).chat()
+    assert upstream.requests == 2
+
+
+def test_client_errors_are_not_retried(connect, upstream):
+    upstream.script += ["400"]
+    with pytest.raises(Exception):
+        connect(max_attempts=3).chat()
+    assert upstream.requests == 1
+
+
+def test_read_timeout_is_retried(connect, upstream):
+    upstream.script += ["slow"]
+    assert connect(max_attempts=2).chat() == "Hello there friend"
+    assert upstream.requests == 2
+
+
+def test_stream_retried_before_first_chunk(connect, upstream):
+    upstream.script += ["slow"]
+    assert connect(max_attempts=2).stream([]) == "Hello there friend"
+    assert upstream.requests == 2
+
+
+def test_open_circuit_fails_fast(connect, upstream):
+    client = connect(max_attempts=1, failure_threshold=2)
+    upstream.script += ["503", "503"]
+    for _ in range(2):
+        with pytest.raises(Exception):
+            client.chat()
+    with pytest.raises(CircuitOpenError):
+        client.chat()
+    assert upstream.requests == 2
+    assert client.client.breaker(MODEL).state == "open"
+
+
+def test_circuit_closes_after_successful_trial(connect, upstream):
+    client = connect(max_attempts=1, failure_threshold=1, reset_timeout=0.05)
+    upstream.script += ["503"]
+    with pytest.raises(Exception):
+        client.chat()
+    assert client.client.breaker(MODEL).state == "open"
+    asyncio.run(asyncio.sleep(0.1))
+    assert client.chat() == "Hello there friend"
+    assert client.client.breaker(MODEL).state == "closed"
+
+
+@pytest.mark.parametrize("mode", ["drop", "stall"])
+def test_interrupted_stream_keeps_partial_reply(connect, upstream, mode):
+    upstream.script += [mode]
+    received = []
+    with pytest.raises(StreamInterrupted) as raised:
+        connect(max_attempts=3).stream(received)
+    assert raised.value.partial == "Hello there"
+    assert "".join(received) == "Hello there"
+    # Retrying would repeat the chunks already handed out
+    assert upstream.requests == 1
+
+
+def test_async_client_shares_circuits(upstream):
+    sync = open_client("key", endpoint=upstream.url, **dict(OPTIONS, max_attempts=1, failure_threshold=1))
+    client = open_async_client("key", endpoint=upstream.url, share=sync,
+                               **dict(OPTIONS, max_attempts=1, failure_threshold=1))
+    upstream.script += ["503"]
+    with pytest.raises(Exception):
+        asyncio.run(client.chat(MODEL, MESSAGES))
+    assert sync.breaker(MODEL).state == "open"
@@ -0,0 +1,145 @@
+from types import SimpleNamespace
+
+import pytest
+
+from chatbot import ChatBot
+from router import LatencyHistogram, ModelRouter, parse_rate_limits
+
+WINDOWS = {"small": 8000, "medium": 32000, "large": 128000}
+COSTS = {"small": 0.25, "medium": 1.0, "large": 4.0}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class StubBreakers:
+    """Stands in for ResilientClient.breaker, every circuit closed unless opened."""
+
+    def __init__(self):
+        self.open = set()
+
+    def __call__(self, model):
+        return SimpleNamespace(state="open" if model in self.open else "closed")
+
+
+class StubClient:
+    """Answers every stream with the same words and remembers which model each request went to."""
+
+    def __init__(self):
+        self.models = []
+
+    def chat_stream(self, model, temperature, messages):
+        self.models.append(model)
+        for text in ("Hello", " there"):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def breakers():
+    return StubBreakers()
+
+
+@pytest.fixture
+def router(clock, breakers):
+    return ModelRouter(["large", "small", "medium"], WINDOWS, costs=COSTS, breaker=breakers, min_samples=3,
+                       clock=clock)
+
+
+def test_cheapest_model_that_fits(router):
+    assert router.choose(1000) == "small"
+    assert router.choose(10000) == "medium"
+    assert router.choose(100000) == "large"
+    assert router.decisions == {("small", "cheapest"): 1, ("medium", "cheapest"): 1, ("large", "cheapest"): 1}
+
+
+def test_preferred_model(router):
+    assert router.choose(1000, preferred="large") == "large"
+    assert router.decisions == {("large", "preferred"): 1}
+
+
+def test_preferred_model_too_small(router):
+    assert router.choose(10000, preferred="small") == "medium"
+    assert router.decisions == {("medium", "fallback"): 1}
+
+
+def test_nothing_fits(router):
+    # The largest window keeps the most of the conversation
+    assert router.choose(500000) == "large"
+
+
+def test_open_circuit_falls_back(router, breakers):
+    breakers.open.add("large")
+    assert router.choose(1000, preferred="large") == "small"
+    breakers.open.add("small")
+    assert router.choose(1000) == "medium"
+    assert router.decisions == {("small", "fallback"): 1, ("medium", "fallback"): 1}
+    breakers.open.clear()
+    assert router.choose(1000, preferred="large") == "large"
+
+
+def test_every_model_unhealthy(router, breakers):
+    breakers.open.update(WINDOWS)
+    assert router.choose(1000, preferred="medium") == "medium"
+    assert router.decisions == {("medium", "unhealthy"): 1}
+
+
+def test_slow_model_falls_back(router, clock):
+    for _ in range(2):
+        router.observe("small", 20.0)
+    # Too few samples to judge yet
+    assert router.choose(1000) == "small"
+    router.observe("small", 20.0)
+    assert router.unavailable("small") == "p95 latency 32.0s"
+    assert router.choose(1000) == "medium"
+    # Slow samples age out of the window
+    clock.now += router.latency_window + 1
+    assert router.choose(1000) == "small"
+
+
+def test_rate_limited_model_falls_back(clock, breakers):
+    router = ModelRouter(["small", "medium"], WINDOWS, costs=COSTS, breaker=breakers,
+                         rate_limits=parse_rate_limits("small=6"), clock=clock)
+    # 6 requests a minute allow a burst of one
+    assert router.choose(1000) == "small"
+    assert router.unavailable("small") == "rate limited"
+    assert router.choose(1000) == "medium"
+    clock.now += 10
+    assert router.choose(1000) == "small"
+
+
+def test_parse_rate_limits():
+    assert parse_rate_limits("small=6, large = 0.5,bogus") == {"small": 6.0, "large": 0.5}
+    assert parse_rate_limits(None) == {}
+
+
+def test_latency_percentile(clock):
+    histogram = LatencyHistogram(window=60, clock=clock)
+    assert histogram.percentile(0.95) is None
+    for seconds in [0.03] * 18 + [3.0] * 2:
+        histogram.observe(seconds)
+    assert histogram.percentile(0.5) == 0.05
+    assert histogram.percentile(0.95) == 4.0
+
+
+def test_chatbot_sends_turn_to_routed_model(router, breakers):
+    client = StubClient()
+    bot = ChatBot(None, "large", client=client, router=router)
+    assert "".join(bot.stream_inference("Hi")) == "Hello there"
+    breakers.open.add("large")
+    assert "".join(bot.stream_inference("Again")) == "Hello there"
+    assert client.models == ["large", "small"]
+    assert bot.model == "large" and bot.turn_model == "small"
+    assert [message.role for message in bot.messages] == ["user", "assistant", "user", "assistant"]
+    # Time to first token of each stream is recorded for the model that answered
+    assert sum(router.latency["large"].counts()) == 1
+    assert sum(router.latency["small"].counts()) == 1
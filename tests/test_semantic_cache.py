@@ -0,0 +1,108 @@
+import itertools
+
+import pytest
+
+import semantic_cache
+from semantic_cache import HashingEmbedder, SemanticCache
+
+MODEL = "open-mistral-7b"
+QUESTION = "What is the capital of France?"
+PARAPHRASE = "what is the capital city of France"
+UNRELATED = "How do I bake sourdough bread at home?"
+
+
+@pytest.fixture
+def embed():
+    return HashingEmbedder(dimensions=256)
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    """A clock that ticks once per call, so the order entries were used in is never a tie."""
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(semantic_cache.time, "time", lambda: float(next(ticks)))
+
+
+def similarity(embed, a, b):
+    return float(embed(a) @ embed(b))
+
+
+def test_embedder_is_deterministic_and_normalized(embed):
+    vector = embed(QUESTION)
+    assert vector.shape == (256,)
+    assert similarity(embed, QUESTION, QUESTION) == pytest.approx(1.0)
+    assert (HashingEmbedder(dimensions=256)(QUESTION) == vector).all()
+    assert not embed("").any()
+
+
+def test_hit_above_threshold(embed):
+    score = similarity(embed, QUESTION, PARAPHRASE)
+    cache = SemanticCache(embed, 256, threshold=score - 0.01)
+    cache.add(MODEL, None, QUESTION, "Paris")
+    assert cache.lookup(MODEL, None, PARAPHRASE) == "Paris"
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_miss_below_threshold(embed):
+    score = similarity(embed, QUESTION, PARAPHRASE)
+    assert similarity(embed, QUESTION, UNRELATED) < score
+    cache = SemanticCache(embed, 256, threshold=score + 0.01)
+    assert cache.lookup(MODEL, None, QUESTION) is None
+    cache.add(MODEL, None, QUESTION, "Paris")
+    assert cache.lookup(MODEL, None, PARAPHRASE) is None
+    assert cache.lookup(MODEL, None, UNRELATED) is None
+    assert cache.lookup(MODEL, None, QUESTION) == "Paris"
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_answers_are_scoped_to_model_and_system_message(embed):
+    cache = SemanticCache(embed, 256)
+    cache.add(MODEL, "Be brief", QUESTION, "Paris")
+    assert cache.lookup(MODEL, "Be brief", QUESTION) == "Paris"
+    assert cache.lookup(MODEL, None, QUESTION) is None
+    assert cache.lookup("mistral-large-latest", "Be brief", QUESTION) is None
+
+
+def test_empty_answers_are_not_stored(embed):
+    cache = SemanticCache(embed, 256)
+    cache.add(MODEL, None, QUESTION, "")
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entry_is_replaced(embed):
+    cache = SemanticCache(embed, 256, max_entries=2)
+    cache.add(MODEL, None, "first question", "1")
+    cache.add(MODEL, None, "second question", "2")
+    # Using the first makes the second the least recently used
+    assert cache.lookup(MODEL, None, "first question") == "1"
+    cache.add(MODEL, None, "third question", "3")
+    assert len(cache) == 2
+    assert cache.lookup(MODEL, None, "second question") is None
+    assert cache.lookup(MODEL, None, "first question") == "1"
+    assert cache.lookup(MODEL, None, "third question") == "3"
+
+
+def test_save_and_load(embed, tmp_path):
+    path = str(tmp_path / "semantic.npz")
+    cache = SemanticCache(embed, 256, path=path)
+    for n in range(3):
+        cache.add(MODEL, None, f"question number {n}", str(n))
+    cache.save()
+    assert SemanticCache(embed, 256, path=path).lookup(MODEL, None, "question number 1") == "1"
+    # A smaller cache keeps the most recently used entries
+    smaller = SemanticCache(embed, 256, max_entries=2, path=path)
+    assert len(smaller) == 2
+    assert smaller.lookup(MODEL, None, "question number 0") is None
+    assert smaller.lookup(MODEL, None, "question number 2") == "2"
+    # A cache of another size of embedding is ignored
+    assert len(SemanticCache(HashingEmbedder(dimensions=128), 128, path=path)) == 0
+
+
+def test_saves_every_so_many_entries(embed, tmp_path, monkeypatch):
+    monkeypatch.setattr(semantic_cache, "SAVE_EVERY", 2)
+    path = tmp_path / "semantic.npz"
+    cache = SemanticCache(embed, 256, path=str(path))
+    cache.add(MODEL, None, "first question", "1")
+    assert not path.exists()
+    cache.add(MODEL, None, "second question", "2")
+    assert path.exists()
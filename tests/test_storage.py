@@ -0,0 +1,62 @@
+import pytest
+
+from storage import Database, PoolTimeout
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "test.db"), pool_size=1, pool_timeout=0.1)
+    db.execute("CREATE TABLE Numbers (n INTEGER)")
+    db.executemany("INSERT INTO Numbers (n) VALUES (?)", [(n,) for n in range(10)])
+    yield db
+    db.close()
+
+
+def test_execute_results(db):
+    assert db.execute("INSERT INTO Numbers (n) VALUES (?)", 10) == 11
+    assert db.execute("UPDATE Numbers SET n = n + 1 WHERE n >= ?", 8) == 3
+    assert db.execute("SELECT MAX(n) AS n FROM Numbers") == [{"n": 11}]
+
+
+def test_transaction_rolls_back(db):
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.execute("DELETE FROM Numbers")
+            raise RuntimeError
+    assert len(db.execute("SELECT n FROM Numbers")) == 10
+
+
+def test_after_commit(db):
+    called = []
+    with db.transaction():
+        db.after_commit(lambda: called.append("committed"))
+        assert called == []
+    assert called == ["committed"]
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.after_commit(lambda: called.append("rolled back"))
+            raise RuntimeError
+    db.after_commit(lambda: called.append("outside"))
+    assert called == ["committed", "outside"]
+
+
+def test_pool_timeout(db):
+    with db.connection():
+        # The only pooled connection is taken
+        with pytest.raises(PoolTimeout):
+            db.execute("SELECT n FROM Numbers")
+    assert len(db.execute("SELECT n FROM Numbers")) == 10
+
+
+def test_iterate_does_not_hold_the_pool(db):
+    rows = db.iterate("SELECT n FROM Numbers ORDER BY n", chunk_size=3)
+    assert next(rows) == {"n": 0}
+    # A slow reader halfway through does not keep others from the pool
+    assert db.execute("SELECT COUNT(*) AS count FROM Numbers") == [{"count": 10}]
+    assert [row["n"] for row in rows] == list(range(1, 10))
+
+
+def test_iterate_inside_transaction_sees_its_writes(db):
+    with db.transaction():
+        db.execute("DELETE FROM Numbers WHERE n >= ?", 5)
+        assert [row["n"] for row in db.iterate("SELECT n FROM Numbers ORDER BY n")] == list(range(5))
@@ -0,0 +1,66 @@
+import io
+
+import pytest
+from mistralai.models.chat_completion import ChatMessage
+
+import transfer
+from repositories import SQLiteRepository
+from transfer import check_format, format_of, import_chats, read_chats, stream_export
+
+
+@pytest.fixture
+def source(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "source.db"))
+    yield repository
+    repository.close()
+
+
+@pytest.fixture
+def target(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "target.db"))
+    yield repository
+    repository.close()
+
+
+@pytest.fixture(params=transfer.FORMATS)
+def fmt(request):
+    if request.param == "parquet" and transfer.pyarrow is None:
+        pytest.skip("pyarrow is not installed")
+    return request.param
+
+
+def chats(repository, user_id):
+    """Every chat of the user as (name, [(role, text), ...]), oldest first."""
+    return [(chat["chat_name"], [(row["role"], row["message_text"])
+                                 for row in repository.list_messages(chat["chat_id"], user_id)])
+            for chat in reversed(repository.list_chats(user_id))]
+
+
+def test_round_trip(source, target, fmt):
+    user_id = source.create_user("alice", "hash")
+    other_id = source.create_user("bob", "hash")
+    for name, texts in [("Trip", ["Pack the umbrella", "And sunscreen ☀"]), ("Empty", []),
+                        ("Long", [str(n) for n in range(25)])]:
+        chat_id = source.create_chat(user_id, name)
+        source.append_messages(chat_id, user_id, [ChatMessage(role="user" if n % 2 == 0 else "assistant", content=text)
+                                                  for n, text in enumerate(texts)])
+    source.create_chat(other_id, "Not exported")
+
+    # Small chunks, so the export and the import both span several of them
+    export = b"".join(stream_export(source, fmt, user_id, chunk_size=4))
+    new_id = target.create_user("carol", "hash")
+    counts = import_chats(target, read_chats(io.BytesIO(export), fmt, chunk_size=4), new_id, chunk_size=4)
+    assert counts == {"chats": 3, "messages": 27}
+    assert chats(target, new_id) == chats(source, user_id)
+
+
+def test_formats():
+    assert format_of("chats.PARQUET") == "parquet"
+    assert format_of("chats.csv") == "jsonl"
+    with pytest.raises(ValueError):
+        check_format("csv")
+
+
+def test_invalid_jsonl():
+    with pytest.raises(ValueError, match="line 2"):
+        list(read_chats(io.BytesIO(b'{"type": "chat", "chat_id": 1}\n{"type": "note"}\n'), "jsonl"))
@@ -0,0 +1,109 @@
+import json
+import os
+import uuid
+
+import pytest
+from mistralai.models.chat_completion import ChatMessage
+
+from repositories import SQLiteRepository
+from writebehind import Journal, WriteBehindQueue, open_writer
+
+
+class FailingRepository:
+    """Passes everything through, except that appending a turn starting with "fail" raises."""
+
+    def __init__(self, repository):
+        self.repository = repository
+
+    def __getattr__(self, name):
+        return getattr(self.repository, name)
+
+    def append_messages(self, chat_id, user_id, messages, **kwargs):
+        if messages[0].content == "fail":
+            raise RuntimeError("Scripted failure")
+        return self.repository.append_messages(chat_id, user_id, messages, **kwargs)
+
+
+@pytest.fixture
+def repository(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "chat.db"))
+    yield repository
+    repository.close()
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return str(tmp_path / "writebehind.journal")
+
+
+@pytest.fixture
+def chats(repository):
+    user_id = repository.create_user("alice", "hash")
+    return user_id, repository.create_chat(user_id, "First"), repository.create_chat(user_id, "Second")
+
+
+def turn(user, assistant):
+    return [ChatMessage(role="user", content=user), ChatMessage(role="assistant", content=assistant)]
+
+
+def texts(repository, chat_id, user_id):
+    return [row["message_text"] for row in repository.list_messages(chat_id, user_id)]
+
+
+def test_turns_are_stored_in_order(repository, journal, chats):
+    user_id, chat_id, _ = chats
+    writer = open_writer(repository, journal, batch_size=2, fsync=False)
+    stored = []
+    for i in range(5):
+        writer.submit(chat_id, user_id, turn(f"q{i}", f"a{i}"), callback=stored.append)
+    assert writer.wait(chat_id, user_id, timeout=5)
+    writer.close()
+    assert texts(repository, chat_id, user_id) == [text for i in range(5) for text in (f"q{i}", f"a{i}")]
+    assert [len(message_ids) for message_ids in stored] == [2] * 5
+    # Nothing was left to replay, so the journal went with the writer
+    assert not [name for name in os.listdir(os.path.dirname(journal)) if name.startswith("writebehind.journal")]
+
+
+def test_replay_skips_committed_turns_by_id(repository, journal, chats):
+    user_id, chat_id, _ = chats
+    entries = [{"seq": seq, "turn": uuid.uuid4().hex, "chat_id": chat_id, "user_id": user_id, "chat_name": None,
+                "messages": [["user", "Again"], ["assistant", "Same answer"]]} for seq in (1, 2)]
+    # The first turn was committed but the process died before writing its done line
+    repository.append_messages(chat_id, user_id, turn("Again", "Same answer"), turn_id=entries[0]["turn"])
+    with open(f"{journal}.999999", "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+    writer = open_writer(repository, journal, fsync=False)
+    writer.close()
+    # The second turn is identical, but it is a turn of its own
+    assert texts(repository, chat_id, user_id) == ["Again", "Same answer"] * 2
+    assert not os.path.exists(f"{journal}.999999")
+
+
+def test_failed_turn_holds_back_its_chat(repository, journal, chats):
+    user_id, chat_id, other_chat_id = chats
+    writer = WriteBehindQueue(FailingRepository(repository), Journal(journal, fsync=False), max_attempts=1).start()
+    writer.submit(chat_id, user_id, turn("one", "1"))
+    writer.submit(chat_id, user_id, turn("fail", "2"))
+    writer.submit(chat_id, user_id, turn("three", "3"))
+    writer.submit(other_chat_id, user_id, turn("other", "4"))
+    assert writer.flush(timeout=5)
+    writer.close()
+    assert texts(repository, chat_id, user_id) == ["one", "1"]
+    assert texts(repository, other_chat_id, user_id) == ["other", "4"]
+
+    # Once the turn can be stored, the next start writes it and the turn held behind it in order
+    writer = open_writer(repository, journal, fsync=False)
+    writer.close()
+    assert texts(repository, chat_id, user_id) == ["one", "1", "fail", "2", "three", "3"]
+    assert texts(repository, other_chat_id, user_id) == ["other", "4"]
+
+
+def test_close_twice(repository, journal, chats):
+    user_id, chat_id, _ = chats
+    writer = open_writer(repository, journal, fsync=False)
+    writer.submit(chat_id, user_id, turn("one", "1"))
+    writer.close()
+    writer.close()
+    writer.journal.close(remove=True)
+    assert texts(repository, chat_id, user_id) == ["one", "1"]
@@ -0,0 +1,238 @@
+import argparse
+import itertools
+import json
+import os
+
+from storage import DEFAULT_CHUNK_SIZE
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet support is optional
+    pyarrow = None
+
+FORMATS = ("jsonl", "parquet")
+CONTENT_TYPES = {"jsonl": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+# Row groups of Parquet exports are compressed with zstd, which keeps repeated chat names and roles small
+PARQUET_COMPRESSION = "zstd"
+
+
+def check_format(fmt):
+    """Raise ValueError for an unknown format and RuntimeError when the format needs a missing package."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    if fmt == "parquet" and pyarrow is None:
+        raise RuntimeError("pyarrow must be installed to use the parquet format.")
+
+
+def format_of(path, default="jsonl"):
+    """The format a file name's extension stands for."""
+    extension = os.path.splitext(path or "")[1].lstrip(".").lower()
+    return extension if extension in FORMATS else default
+
+
+def text(value):
+    # PostgreSQL returns datetimes where SQLite returns strings
+    return None if value is None else str(value)
+
+
+def jsonl_chunks(rows, chunk_size):
+    """
+    Encode export rows as JSONL: a chat line followed by a line per message, joined into
+    chunks of about chunk_size lines.
+    """
+    lines = []
+    chat_id = None
+    for row in rows:
+        if row["chat_id"] != chat_id:
+            chat_id = row["chat_id"]
+            lines.append(json.dumps({"type": "chat", "chat_id": chat_id, "user_id": row["user_id"],
+                                     "chat_name": row["chat_name"], "created_at": text(row["chat_created_at"])},
+                                    ensure_ascii=False))
+        if row["role"] is not None:
+            lines.append(json.dumps({"type": "message", "chat_id": chat_id, "role": row["role"],
+                                     "content": row["message_text"], "created_at": text(row["created_at"])},
+                                    ensure_ascii=False))
+        if len(lines) >= chunk_size:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def read_jsonl(stream):
+    """Turn JSONL export lines back into export rows."""
+    chat = None
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if record["type"] == "chat":
+                if chat is not None and not chat["has_messages"]:
+                    yield chat["row"]
+                chat = {"row": {"chat_id": record["chat_id"], "user_id": record.get("user_id"),
+                                "chat_name": record.get("chat_name"), "chat_created_at": record.get("created_at"),
+                                "role": None, "message_text": None, "created_at": None},
+                        "has_messages": False}
+            elif record["type"] == "message" and chat is not None:
+                chat["has_messages"] = True
+                yield dict(chat["row"], role=record["role"], message_text=record["content"],
+                           created_at=record.get("created_at"))
+            else:
+                raise ValueError(record["type"])
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid export record on line {number}") from e
+    if chat is not None and not chat["has_messages"]:
+        yield chat["row"]
+
+
+def parquet_schema():
+    return pyarrow.schema([("chat_id", pyarrow.int64()), ("user_id", pyarrow.int64()),
+                           ("chat_name", pyarrow.string()), ("chat_created_at", pyarrow.string()),
+                           ("role", pyarrow.string()), ("content", pyarrow.string()),
+                           ("created_at", pyarrow.string())])
+
+
+class ChunkSink:
+    """Write-only file object that hands out what was written since the last take(), so Parquet can be streamed."""
+
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def parquet_chunks(rows, chunk_size):
+    """Encode export rows as Parquet, one flat row per message and a row group per chunk_size rows."""
+    schema = parquet_schema()
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression=PARQUET_COMPRESSION)
+    try:
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            columns = [[row["chat_id"] for row in chunk], [row["user_id"] for row in chunk],
+                       [row["chat_name"] for row in chunk], [text(row["chat_created_at"]) for row in chunk],
+                       [row["role"] for row in chunk], [row["message_text"] for row in chunk],
+                       [text(row["created_at"]) for row in chunk]]
+            writer.write_batch(pyarrow.record_batch(columns, schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+def read_parquet(stream, chunk_size):
+    """Turn a Parquet export back into export rows, reading chunk_size rows at a time."""
+    try:
+        parquet = pyarrow.parquet.ParquetFile(stream)
+    except pyarrow.ArrowInvalid as e:
+        raise ValueError("Invalid Parquet export") from e
+    for batch in parquet.iter_batches(batch_size=chunk_size):
+        for row in batch.to_pylist():
+            row["message_text"] = row.pop("content")
+            yield row
+
+
+def stream_export(db, fmt, user_id=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield the user's chats, or every chat when user_id is None, encoded as fmt in chunks of bytes.
+
+    Rows come from the database chunk_size at a time and are encoded as they arrive,
+    so memory does not grow with the number of messages.
+    """
+    check_format(fmt)
+    rows = db.export_chats(user_id, chunk_size=chunk_size)
+    if fmt == "parquet":
+        return parquet_chunks(rows, chunk_size)
+    return jsonl_chunks(rows, chunk_size)
+
+
+def read_chats(stream, fmt, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield export rows from a binary file object holding an export in fmt."""
+    check_format(fmt)
+    if fmt == "parquet":
+        return read_parquet(stream, chunk_size)
+    return read_jsonl(line.decode("utf-8") for line in stream)
+
+
+def import_chats(db, rows, user_id=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Store exported rows as new chats and return how many chats and messages were created.
+
+    Chats get new ids and belong to user_id, or keep their exported owner when it is None.
+    Every chunk_size rows are stored in one transaction, messages with a single bulk insert.
+    A failure keeps the chunks stored before it.
+    """
+    counts = {"chats": 0, "messages": 0}
+    source_chat_id = chat_id = owner = None
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return counts
+        messages = []
+        with db.transaction():
+            for row in chunk:
+                if row["chat_id"] != source_chat_id:
+                    source_chat_id = row["chat_id"]
+                    owner = row["user_id"] if user_id is None else user_id
+                    chat_id = db.import_chat(owner, row["chat_name"], row["chat_created_at"])
+                    counts["chats"] += 1
+                if row["role"] is not None:
+                    messages.append((chat_id, owner, row["message_text"], row["role"], row["created_at"]))
+            if messages:
+                db.import_messages(messages)
+        counts["messages"] += len(messages)
+
+
+if __name__ == "__main__":
+    from repositories import open_repository
+
+    parser = argparse.ArgumentParser(description="Export chats with their messages to a file, or import such a file")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="File to write or read. Its extension picks the format unless --format is given")
+    parser.add_argument("--format", choices=FORMATS, help="File format, jsonl or parquet (needs pyarrow)")
+    parser.add_argument("--user", type=int,
+                        help="Only export this user's chats, or import every chat for this user. "
+                             "Defaults to all chats, imported for their exported owners")
+    parser.add_argument("--database", default=os.environ.get("DATABASE", "chat.db"),
+                        help="SQLite database file or postgresql:// URL. Defaults to %(default)s")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Rows read and written at a time. Defaults to %(default)s")
+    args = parser.parse_args()
+
+    fmt = args.format or format_of(args.path)
+    repository = open_repository(args.database)
+    try:
+        if args.command == "export":
+            with open(args.path, "wb") as f:
+                for data in stream_export(repository, fmt, args.user, args.chunk_size):
+                    f.write(data)
+            print(f"Exported to {args.path} ({os.path.getsize(args.path) / 1e6:.1f}MB)")
+        else:
+            with open(args.path, "rb") as f:
+                counts = import_chats(repository, read_chats(f, fmt, args.chunk_size), args.user, args.chunk_size)
+            print(f"Imported {counts['chats']} chats with {counts['messages']} messages")
+    finally:
+        repository.close()
@@ -0,0 +1,385 @@
+import glob
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import Counter
+
+from mistralai.models.chat_completion import ChatMessage
+
+try:
+    import fcntl
+except ImportError:  # No advisory file locks on Windows
+    fcntl = None
+
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_BATCH_SIZE = 100
+# How long a request waits for room in a full queue before it logs that it is still waiting
+DEFAULT_PUT_TIMEOUT = 5.0
+# Attempts at a single turn before it is left in the journal for the next start
+DEFAULT_MAX_ATTEMPTS = 5
+RETRY_DELAY = 0.5
+# The journal is started over once nothing is in flight and it has grown past this size
+COMPACT_BYTES = 1024 * 1024
+
+logger = logging.getLogger("chatbot.writebehind")
+
+
+def read_entries(lines):
+    """Entries of journal lines that were never marked done, oldest first."""
+    entries, done = {}, set()
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # The last line of a process that died mid-write
+            continue
+        if "done" in record:
+            done.update(record["done"])
+        else:
+            entries[record["seq"]] = record
+    return [entry for seq, entry in sorted(entries.items()) if seq not in done]
+
+
+def lock(f, wait=True):
+    """
+    Take an exclusive lock on an open journal, held until it is closed. Returns False when another
+    process holds it and wait is False, or when the file was replayed and removed before the lock was taken.
+    """
+    if fcntl is not None:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+    try:
+        return os.stat(f.name).st_ino == os.fstat(f.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+class Journal:
+    """
+    Append-only JSONL file of turns handed to the writer, so none is lost if the process dies.
+
+    Each process appends to its own file, the base path followed by its process
+    id, and holds a lock on it while it runs. Each turn is written and fsynced
+    before it is queued. Once stored, its sequence number is recorded in a done
+    line. Whatever has no done line is replayed when the process starts again,
+    or by any other process once no live process holds the file.
+    """
+
+    def __init__(self, base, fsync=True):
+        self.base = base
+        self.path = f"{base}.{os.getpid()}"
+        self.fsync = fsync
+        self.closed = False
+        self._lock = threading.Lock()
+        self._file = self._open(self.path)
+
+    @staticmethod
+    def _open(path):
+        while True:
+            f = open(path, "a", encoding="utf-8")
+            if lock(f):
+                return f
+            f.close()
+
+    def _write(self, record, sync):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def append(self, entry):
+        with self._lock:
+            self._write(entry, self.fsync)
+
+    def size(self):
+        with self._lock:
+            return self._file.tell()
+
+    def mark_done(self, seqs):
+        # A lost done line only means the turn is checked against the database again on replay
+        with self._lock:
+            self._write({"done": list(seqs)}, False)
+
+    def pending(self):
+        """Entries of this process's journal that were never marked done, oldest first."""
+        with self._lock, open(self.path, encoding="utf-8") as f:
+            return read_entries(f)
+
+    def orphans(self):
+        """
+        Yield (path, file) for the journals of processes that are gone, each locked so no other process
+        replays it at the same time. The caller removes the file once replayed, then closes it.
+
+        Without advisory locks (Windows) every other journal counts as left behind, which is only
+        safe while a single process uses the base path.
+        """
+        # The base path itself is where a single journal was kept before there was one per process
+        paths = [self.base] + sorted(glob.glob(glob.escape(self.base) + ".*"))
+        for path in paths:
+            suffix = path[len(self.base) + 1:]
+            if path == self.path or not (path == self.base or suffix.isdigit()):
+                continue
+            try:
+                f = open(path, encoding="utf-8")
+            except FileNotFoundError:
+                continue
+            if lock(f, wait=False):
+                yield path, f
+            else:
+                f.close()
+
+    def compact(self, entries):
+        """Replace the journal with just entries, dropping every finished turn."""
+        with self._lock:
+            temporary = self.path + ".tmp"
+            f = open(temporary, "w", encoding="utf-8")
+            # Locked before it takes the journal's place, so no other process can claim it in between
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+            os.replace(temporary, self.path)
+            self._file.close()
+            self._file = f
+
+    def close(self, remove=False):
+        """Release the journal, removing it first when nothing in it needs replaying. Later calls do nothing."""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            if remove:
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+            self._file.close()
+
+
+class WriteBehindQueue:
+    """
+    Store completed turns on a background thread, in batched transactions.
+
+    submit() journals the turn and queues it, so the request that produced it
+    does not wait for the database. The writer thread drains up to batch_size
+    turns per transaction and calls each turn's callback with its message_ids
+    once committed. When the queue is full, submit() waits for room, so turns
+    are always stored in the order they were submitted. A turn that keeps failing
+    is left in the journal together with every later turn of its chat, so the next
+    start stores them in order.
+    """
+
+    def __init__(self, db, journal, queue_size=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                 put_timeout=DEFAULT_PUT_TIMEOUT, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.db = db
+        self.journal = journal
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self.max_attempts = max_attempts
+        self.queue = queue.Queue(queue_size)
+        self._seq = itertools.count(1)
+        # Turns queued or being written per (chat_id, user_id), so readers can wait for their chat
+        self._outstanding = Counter()
+        # Turns given up on, kept in the journal for the next start, and the (chat_id, user_id) they belong to
+        self._abandoned = []
+        self._held = set()
+        self._closed = False
+        self._idle = threading.Condition()
+        self._thread = None
+        self.written = 0
+        self.batches = 0
+
+    def start(self):
+        """Replay what earlier processes left in their journals, then start the writer thread."""
+        # A journal under this process's id was left by an earlier process that had the same id
+        pending = self.journal.pending()
+        if pending:
+            self._seq = itertools.count(pending[-1]["seq"] + 1)
+        self._replay(pending, self.journal.path)
+        self.journal.compact(self._abandoned)
+        for path, f in self.journal.orphans():
+            with f:
+                entries = read_entries(f)
+                # Moved into this process's journal first, so a turn given up on is kept once its file is gone
+                for entry in entries:
+                    entry["seq"] = next(self._seq)
+                    self.journal.append(entry)
+                self._replay(entries, path)
+                os.remove(path)
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        return self
+
+    def _replay(self, entries, path):
+        replayed = 0
+        for entry in entries:
+            if not self.db.chat_exists(entry["chat_id"], entry["user_id"]):
+                logger.warning("Dropping journaled turn %d, chat_id: %s no longer exists", entry["seq"],
+                               entry["chat_id"])
+            elif not self._already_stored(entry):
+                with self._idle:
+                    self._outstanding[(entry["chat_id"], entry["user_id"])] += 1
+                self._write([(entry, None)])
+                replayed += 1
+                continue
+            self.journal.mark_done([entry["seq"]])
+        if entries:
+            logger.info("Replayed %d of %d turns journaled in %s", replayed, len(entries), path)
+
+    def _already_stored(self, entry):
+        """Whether a journaled turn was committed before its done line was written."""
+        # Turns journaled before they carried an id are stored again rather than guessed at
+        return "turn" in entry and self.db.turn_stored(entry["turn"])
+
+    def submit(self, chat_id, user_id, messages, chat_name=None, callback=None):
+        """Journal and queue a turn; callback(message_ids) runs on the writer thread once it is stored."""
+        entry = {"seq": next(self._seq), "turn": uuid.uuid4().hex, "chat_id": chat_id, "user_id": user_id,
+                 "chat_name": chat_name, "messages": [[message.role, message.content] for message in messages]}
+        # Under the same lock the writer holds to compact the journal, so no new entry is compacted away
+        with self._idle:
+            self.journal.append(entry)
+            self._outstanding[(chat_id, user_id)] += 1
+        # Backpressure: the writer is behind, so this request waits for it. Writing the turn here instead would
+        # store it before turns of the same chat that are still queued
+        while True:
+            try:
+                self.queue.put((entry, callback), timeout=self.put_timeout)
+                return
+            except queue.Full:
+                logger.warning("Write-behind queue is full, still waiting to queue a turn for chat_id: %s", chat_id)
+
+    def wait(self, chat_id, user_id, timeout=None):
+        """Block until every turn queued for the chat is stored, so a read sees it. Returns False on timeout."""
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._outstanding[(chat_id, user_id)], timeout)
+
+    def flush(self, timeout=None):
+        """Block until the queue is empty."""
+        with self._idle:
+            return self._idle.wait_for(lambda: not +self._outstanding, timeout)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._write(batch)
+                    return
+                batch.append(item)
+            self._write(batch)
+
+    def _write(self, batch):
+        if self._held:
+            for entry, _ in batch:
+                if (entry["chat_id"], entry["user_id"]) in self._held:
+                    self._hold(entry)
+            batch = [item for item in batch if (item[0]["chat_id"], item[0]["user_id"]) not in self._held]
+            if not batch:
+                return
+        try:
+            with self.db.transaction():
+                results = [self._store(entry) for entry, _ in batch]
+        except Exception:
+            if len(batch) > 1:
+                # Find the turn that fails, the others go through one by one
+                logger.exception("Storing a batch of %d turns failed, retrying them one at a time", len(batch))
+                for item in batch:
+                    self._write_one(item)
+                return
+            self._write_one(batch[0])
+            return
+        self.batches += 1
+        self._finish(batch, results)
+
+    def _write_one(self, item):
+        entry, callback = item
+        if (entry["chat_id"], entry["user_id"]) in self._held:
+            # An earlier turn of the chat is still waiting in the journal
+            self._hold(entry)
+            return
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                with self.db.transaction():
+                    message_ids = self._store(entry)
+            except Exception:
+                if attempt == self.max_attempts:
+                    logger.exception("Giving up on turn %d for chat_id: %s, it stays in the journal",
+                                     entry["seq"], entry["chat_id"])
+                    self._held.add((entry["chat_id"], entry["user_id"]))
+                    self._abandoned.append(entry)
+                    self._finish([], [], abandoned=[entry])
+                    return
+                time.sleep(RETRY_DELAY * attempt)
+                continue
+            self._finish([item], [message_ids])
+            return
+
+    def _hold(self, entry):
+        logger.warning("Keeping turn %d for chat_id: %s in the journal behind a turn that failed",
+                       entry["seq"], entry["chat_id"])
+        self._abandoned.append(entry)
+        self._finish([], [], abandoned=[entry])
+
+    def _store(self, entry):
+        messages = [ChatMessage(role=role, content=content) for role, content in entry["messages"]]
+        return self.db.append_messages(entry["chat_id"], entry["user_id"], messages, chat_name=entry["chat_name"],
+                                       turn_id=entry.get("turn"))
+
+    def _finish(self, batch, results, abandoned=()):
+        if batch:
+            self.journal.mark_done([entry["seq"] for entry, _ in batch])
+            self.written += len(batch)
+        for (entry, callback), message_ids in zip(batch, results):
+            if callback is not None:
+                try:
+                    callback(message_ids)
+                except Exception:
+                    logger.exception("Callback for turn %d failed", entry["seq"])
+        with self._idle:
+            for entry in [entry for entry, _ in batch] + list(abandoned):
+                key = (entry["chat_id"], entry["user_id"])
+                self._outstanding[key] -= 1
+                if not self._outstanding[key]:
+                    del self._outstanding[key]
+            self._idle.notify_all()
+            if not +self._outstanding and self.journal.size() > COMPACT_BYTES:
+                # Nothing in flight, start the journal over with only what was given up on
+                self.journal.compact(self._abandoned)
+
+    def close(self, timeout=10):
+        """Store what is still queued and stop the writer thread. Later calls do nothing."""
+        if self._closed:
+            return
+        self._closed = True
+        drained = True
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join(timeout)
+            drained = not self._thread.is_alive()
+            self._thread = None
+        # Nothing is left to replay, so the journal does not outlive the process
+        self.journal.close(remove=drained and not self._abandoned)
+
+
+def open_writer(db, path, queue_size=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE, fsync=True):
+    """
+    Start a WriteBehindQueue journaled to path followed by the process id, after replaying
+    anything processes that are gone left in journals under path.
+    """
+    return WriteBehindQueue(db, Journal(path, fsync=fsync), queue_size=queue_size, batch_size=batch_size).start()